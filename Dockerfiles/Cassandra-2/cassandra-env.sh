@@ -178,6 +178,12 @@ JVM_OPTS="$JVM_OPTS -javaagent:$CASSANDRA_HOME/lib/jamm-0.3.0.jar"
 # add jolokia java agent
 JVM_OPTS="$JVM_OPTS -javaagent:/opt/jolokia/jolokia-jvm-agent.jar=port=8778,host=$LISTEN_ADDRESS"
 
+# take over the tokens of a dead node, only honored when the node starts
+# with an empty data directory
+if [ -n "$REPLACE_ADDRESS" ]; then
+    JVM_OPTS="$JVM_OPTS -Dcassandra.replace_address_first_boot=$REPLACE_ADDRESS"
+fi
+
 # some JVMs will fill up their heap when accessed via JMX, see CASSANDRA-6541
 JVM_OPTS="$JVM_OPTS -XX:+CMSClassUnloadingEnabled"
 
@@ -8,9 +8,17 @@
 # CASSANDRA_DATA_DIR
 # TRUSTSTORE
 # KEYSTORE
+# TRUSTSTORE_PARAMETER
+# KEYSTORE_PARAMETER
 # ADMIN_PASSWORD
 # MEMTABLE_FLUSH_WRITERS
 # CONCURRENT_COMPACTORS
+# KEY_CACHE_SIZE_MB
+# ROW_CACHE_SIZE_MB
+# COUNTER_CACHE_SIZE_MB
+# FILE_CACHE_SIZE_MB
+# SYSTEM_AUTH_REPLICATION
+# REPLACE_ADDRESS
 
 if [ -z "$CLUSTER_NAME" ] ;
 then
@@ -57,6 +65,28 @@ echo "Broadcast IP address is $BROADCAST_ADDRESS ..."
 
 export CASSANDRA_DATA_DIR=${CASSANDRA_DATA_DIR:-/var/lib/cassandra}
 
+# the keystores are either in the environment, or in SSM Parameter Store
+fetch_parameter() {
+    region=$(curl -Ls -m 4 ${EC2_META_URL}/placement/availability-zone | sed 's/[a-z]$//')
+    for attempt in 1 2 3 4 5 6 7 8 9 10; do
+        if aws ssm get-parameter --region "$region" --with-decryption --name "$1" \
+               --query Parameter.Value --output text; then
+            return 0
+        fi
+        sleep 5
+    done
+    echo "Cannot fetch parameter $1." >&2
+    return 1
+}
+
+if [ -n "$TRUSTSTORE_PARAMETER" ]; then
+    export TRUSTSTORE=$(fetch_parameter "$TRUSTSTORE_PARAMETER")
+fi
+
+if [ -n "$KEYSTORE_PARAMETER" ]; then
+    export KEYSTORE=$(fetch_parameter "$KEYSTORE_PARAMETER")
+fi
+
 if [ -z "$TRUSTSTORE" ]; then
     echo "TRUSTSTORE must be set (base64 encoded)."
     exit 1
@@ -90,6 +120,13 @@ if [ -z "$CONCURRENT_COMPACTORS" ]; then
     export CONCURRENT_COMPACTORS=$ncores_4
 fi
 
+# cache sizes in MB, empty for the Cassandra defaults; planb tune-caches
+# finds better values, which planb update then passes in here
+export KEY_CACHE_SIZE_MB=${KEY_CACHE_SIZE_MB:-}
+export ROW_CACHE_SIZE_MB=${ROW_CACHE_SIZE_MB:-0}
+export COUNTER_CACHE_SIZE_MB=${COUNTER_CACHE_SIZE_MB:-}
+export FILE_CACHE_SIZE_MB=${FILE_CACHE_SIZE_MB:-}
+
 echo "Generating configuration from template ..."
 python -c "import sys, os; sys.stdout.write(os.path.expandvars(open('/etc/cassandra/cassandra_template.yaml').read()))" > /etc/cassandra/cassandra.yaml
 
@@ -100,18 +137,73 @@ fi
 
 echo "Starting Cassandra ..."
 /usr/sbin/cassandra -f &
+cassandra_pid=$!
+
+delay=1
+backoff() {
+    sleep $delay
+    delay=$(( delay * 2 ))
+    [ $delay -le 30 ] || delay=30
+}
 
 #
-# Try to create admin user and drop the default superuser (we don't care if it
-# fails, that would just mean we are not the first one to do that).
+# Wait for the native transport to accept connections.
 #
-sleep 60
-cqlsh -u cassandra -p cassandra \
-      -e "\
-ALTER KEYSPACE system_auth WITH replication = { 'class': 'NetworkTopologyStrategy' $(echo $REGIONS | sed "s/\([^ ]*\)-1/, '\1': $CLUSTER_SIZE/g") };\
-CREATE USER admin WITH PASSWORD '$ADMIN_PASSWORD' SUPERUSER;" \
-    && \
-    cqlsh -u admin -p "$ADMIN_PASSWORD" -e "DROP USER cassandra;"
+until python -c "import socket; socket.create_connection(('127.0.0.1', 9042), 2).close()" 2>/dev/null;
+do
+    if ! kill -0 $cassandra_pid 2>/dev/null; then
+        echo "Cassandra exited before accepting connections."
+        exit 1
+    fi
+    backoff
+done
+echo "Cassandra is accepting connections ..."
+
+#
+# Create the admin user and drop the default superuser, once per cluster:
+# only the first seed does it, in the background, as it needs a quorum of
+# the cluster, which may take the other seeds of all regions to come up.
+# The step is claimed with a lightweight transaction, so that no other
+# node runs it concurrently, e.g. after the seeds have changed.  It stops
+# as soon as the admin user can log in, which makes it safe to repeat
+# after a partial run or a restart, and gives up after an hour.
+#
+if [ -z "$SYSTEM_AUTH_REPLICATION" ]; then
+    # user data of clusters created before SYSTEM_AUTH_REPLICATION was set
+    SYSTEM_AUTH_REPLICATION="{ 'class': 'NetworkTopologyStrategy' $(echo $REGIONS | sed "s/\([^ ]*\)-1/, '\1': $CLUSTER_SIZE/g") }"
+fi
+
+bootstrap_auth() {
+    delay=1
+    attempts=0
+    until cqlsh -u admin -p "$ADMIN_PASSWORD" -e "DROP USER IF EXISTS cassandra;" 2>/dev/null;
+    do
+        kill -0 $cassandra_pid 2>/dev/null || return
+        attempts=$(( attempts + 1 ))
+        if [ $attempts -gt 120 ]; then
+            echo "Giving up bootstrapping authentication, is ADMIN_PASSWORD the password of the admin user?"
+            return
+        fi
+        echo "Bootstrapping authentication ..."
+        claim=$(cqlsh -u cassandra -p cassandra \
+                      -e "\
+ALTER KEYSPACE system_auth WITH replication = $SYSTEM_AUTH_REPLICATION;\
+CREATE KEYSPACE IF NOT EXISTS planb WITH replication = $SYSTEM_AUTH_REPLICATION;\
+CREATE TABLE IF NOT EXISTS planb.bootstrap (step text PRIMARY KEY, node text);\
+INSERT INTO planb.bootstrap (step, node) VALUES ('auth', '$BROADCAST_ADDRESS') IF NOT EXISTS;" 2>/dev/null)
+        # applied, or claimed by this node in an earlier attempt
+        if echo "$claim" | grep -q -e True -e " $BROADCAST_ADDRESS *\$"; then
+            cqlsh -u cassandra -p cassandra \
+                  -e "CREATE USER IF NOT EXISTS admin WITH PASSWORD '$ADMIN_PASSWORD' SUPERUSER;" 2>/dev/null
+        fi
+        backoff
+    done
+    echo "Authentication bootstrapped."
+}
+
+if [ "${SEEDS%%,*}" = "$BROADCAST_ADDRESS" ]; then
+    bootstrap_auth &
+fi
 
 # Make sure the script don't exit at this point, if cassandra is still there.
-wait
+wait $cassandra_pid
@@ -123,6 +123,12 @@ esac
 
 JVM_OPTS="$JVM_OPTS -javaagent:/opt/jolokia/jolokia-jvm-agent.jar=port=8778,host=$LISTEN_ADDRESS"
 
+# take over the tokens of a dead node, only honored when the node starts
+# with an empty data directory
+if [ -n "$REPLACE_ADDRESS" ]; then
+    JVM_OPTS="$JVM_OPTS -Dcassandra.replace_address_first_boot=$REPLACE_ADDRESS"
+fi
+
 #GC log path has to be defined here because it needs to access CASSANDRA_HOME
 JVM_OPTS="$JVM_OPTS -Xloggc:${CASSANDRA_HOME}/logs/gc.log"
 
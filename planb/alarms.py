@@ -0,0 +1,131 @@
+"""
+Reconciliation of the Auto-Recovery alarms of a cluster with its instances.
+
+Every live instance should have an alarm named
+{cluster_name}-{instance_id}-auto-recover, and the alarms of instances
+which are gone are stale.  The alarms of a region are listed with one
+paginated describe, and the missing ones are put and the stale ones
+deleted in parallel.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import re
+
+from botocore.exceptions import ClientError
+from clickclick import info, print_table
+
+from .common import ec2_client, autorecovery_client, create_auto_recovery_alarm, \
+    make_auto_recovery_alarm_actions, setup_sns_topics_for_alarm
+from .inventory import iter_instances, live_instance_states, chunks
+
+
+logger = logging.getLogger(__name__)
+
+# DeleteAlarms takes at most 100 names
+max_delete_batch = 100
+
+max_workers = 10
+
+
+def alarm_pattern(cluster_name: str):
+    return re.compile('^{}-(i-[0-9a-f]+)-auto-recover$'.format(re.escape(cluster_name)))
+
+
+def list_alarms(cw: object, cluster_name: str) -> dict:
+    """
+    Returns the Auto-Recovery alarms of the cluster by instance ID.  The
+    prefix alone would also match the alarms of other clusters whose
+    names start with this one's.
+    """
+    pattern = alarm_pattern(cluster_name)
+    result = {}
+    paginator = cw.get_paginator('describe_alarms')
+    for page in paginator.paginate(AlarmNamePrefix='{}-i-'.format(cluster_name)):
+        for alarm in page['MetricAlarms']:
+            match = pattern.match(alarm['AlarmName'])
+            if match:
+                result[match.group(1)] = alarm
+    return result
+
+
+def plan_sync(region: str, alarms: dict, instance_ids: set, alarm_sns_topic_arn: str) -> tuple:
+    """
+    Returns the instance IDs to put an alarm for and the names of the
+    alarms to delete.  Alarms missing the SNS topic are put again, but a
+    topic is never removed from an alarm.
+    """
+    actions = set(make_auto_recovery_alarm_actions(region, alarm_sns_topic_arn))
+    create = sorted(i for i in instance_ids
+                    if i not in alarms or not actions <= set(alarms[i]['AlarmActions']))
+    delete = sorted(a['AlarmName'] for i, a in alarms.items() if i not in instance_ids)
+    return create, delete
+
+
+def delete_alarms(cw: object, names: list):
+    try:
+        cw.delete_alarms(AlarmNames=names)
+    except ClientError as e:
+        # deleted concurrently by another sync
+        if e.response['Error']['Code'] != 'ResourceNotFound':
+            raise
+        logger.debug("Some of the alarms {} were already deleted".format(names))
+
+
+def apply_sync(region: str, cluster_name: str, alarm_sns_topic_arn: str, create: list, delete: list):
+    cw = autorecovery_client(region)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(create_auto_recovery_alarm, region, cluster_name, i, alarm_sns_topic_arn)
+                   for i in create]
+        futures.extend(executor.submit(delete_alarms, cw, batch)
+                       for batch in chunks(delete, max_delete_batch))
+        for f in futures:
+            f.result()
+
+
+def sync_alarms(region: str, cluster_name: str, alarm_sns_topic_arn: str = None,
+                dry_run: bool = False) -> tuple:
+    """
+    Puts the missing alarms of the live instances of the cluster and deletes
+    the stale ones.  Returns the instance IDs and alarm names affected.
+    """
+    ec2 = ec2_client(region)
+    instance_ids = {i['InstanceId'] for i in iter_instances(ec2, cluster_name, live_instance_states)}
+    alarms = list_alarms(autorecovery_client(region), cluster_name)
+    create, delete = plan_sync(region, alarms, instance_ids, alarm_sns_topic_arn)
+    if create or delete:
+        logger.info("{}: putting {} and deleting {} Auto-Recovery alarms{}".format(
+            region, len(create), len(delete), ' (dry run)' if dry_run else ''))
+    if not dry_run:
+        apply_sync(region, cluster_name, alarm_sns_topic_arn, create, delete)
+    return create, delete
+
+
+def sync_cluster_alarms(regions: list, cluster_name: str, alarm_topics: dict,
+                        dry_run: bool = False) -> dict:
+    with ThreadPoolExecutor(max_workers=max(len(regions), 1)) as executor:
+        futures = {
+            region: executor.submit(sync_alarms, region, cluster_name,
+                                    alarm_topics.get(region) if alarm_topics else None, dry_run)
+            for region in regions
+        }
+        return {region: f.result() for region, f in futures.items()}
+
+
+def delete_cluster_alarms(region: str, cluster_name: str):
+    cw = autorecovery_client(region)
+    names = [a['AlarmName'] for a in list_alarms(cw, cluster_name).values()]
+    for batch in chunks(names, max_delete_batch):
+        delete_alarms(cw, batch)
+
+
+def run_sync_alarms(options: dict):
+    if options['sns_topic'] or options['sns_email']:
+        alarm_topics = setup_sns_topics_for_alarm(options['regions'], options['sns_topic'], options['sns_email'])
+    else:
+        alarm_topics = {}
+    result = sync_cluster_alarms(options['regions'], options['cluster_name'], alarm_topics, options['dry_run'])
+    rows = [{'region': region, 'put': ' '.join(create), 'deleted': ' '.join(delete)}
+            for region, (create, delete) in sorted(result.items())]
+    print_table(['region', 'put', 'deleted'], rows)
+    if options['dry_run']:
+        info('Dry run, no alarms were changed.')
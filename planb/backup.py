@@ -0,0 +1,261 @@
+"""
+Backups of a cluster as EBS snapshots of the data volumes, and restore of
+lost nodes from them.
+
+All nodes are flushed at once and the snapshots of all volumes are started
+right after, so that the backup is as close to a single point in time as
+EBS allows.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import collections
+import logging
+import time
+
+from clickclick import Action, info
+
+from . import jolokia, journal
+from .common import ec2_client, setup_sns_topics_for_alarm
+from .inventory import iter_instances, iter_volumes
+from .replace_node import find_instance_spec, find_blocking_instance, launch_node, \
+    broadcast_address
+from .scale_out import read_ring_state, has_joined
+from .update_cluster import flush_cassandra, find_data_volume_id
+
+
+logger = logging.getLogger(__name__)
+
+backup_id_tag = 'planb:backup-id'
+
+
+def make_backup_id(cluster_name: str, now: float = None) -> str:
+    return '{}-{}'.format(cluster_name, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now)))
+
+
+def tags_as_dict(tags: list) -> dict:
+    return {t['Key']: t['Value'] for t in tags or []}
+
+
+def find_data_volumes(ec2: object, cluster_name: str, instances: list) -> dict:
+    """
+    Returns the data volumes attached to the instances, by instance ID.
+    Volumes are matched by their {cluster_name}-{private_ip} Name tag.
+    """
+    names = {'{}-{}'.format(cluster_name, i['PrivateIpAddress']): i for i in instances}
+    result = {}
+    for volume in iter_volumes(ec2, cluster_name):
+        instance = names.get(tags_as_dict(volume.get('Tags'))['Name'])
+        if instance and find_data_volume_id(ec2, instance) == volume['VolumeId']:
+            result[instance['InstanceId']] = volume
+    return result
+
+
+def flush_node(ip: str, url: str) -> bool:
+    try:
+        flush_cassandra(url)
+        return True
+    except Exception as e:
+        logger.error("Failed to flush {}: {}".format(ip, e))
+        return False
+
+
+def snapshot_tags(cluster_name: str, backup_id: str, instance: dict, volume: dict) -> list:
+    """
+    Everything needed to restore the node without its original volume.
+    Volume tags are not copied: Taupage:erase-on-boot would wipe the
+    restored volume.
+    """
+    tags = {
+        'Name': tags_as_dict(volume['Tags'])['Name'],
+        'planb:cluster-name': cluster_name,
+        backup_id_tag: backup_id,
+        'planb:private-ip': instance['PrivateIpAddress'],
+        'planb:volume-type': volume['VolumeType'],
+    }
+    if volume['VolumeType'] in ('io1', 'io2', 'gp3'):
+        tags['planb:volume-iops'] = str(volume['Iops'])
+    if volume['VolumeType'] == 'gp3':
+        tags['planb:volume-throughput'] = str(volume['Throughput'])
+    if instance.get('PublicIpAddress'):
+        tags['planb:public-ip'] = instance['PublicIpAddress']
+    return [{'Key': k, 'Value': v} for k, v in sorted(tags.items())]
+
+
+def snapshot_instance(region: str, instance: dict, tags: list) -> list:
+    """
+    CreateSnapshots takes the snapshots of all the data volumes of the
+    instance at the same moment.
+    """
+    ec2 = ec2_client(region)
+    resp = ec2.create_snapshots(
+        InstanceSpecification={'InstanceId': instance['InstanceId'], 'ExcludeBootVolume': True},
+        Description='Plan B backup of {}'.format(instance['PrivateIpAddress']),
+        TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': tags}]
+    )
+    return [s['SnapshotId'] for s in resp['Snapshots']]
+
+
+def list_backups(ec2: object, cluster_name: str) -> dict:
+    """
+    Returns the lists of snapshots by backup ID.
+    """
+    backups = collections.defaultdict(list)
+    paginator = ec2.get_paginator('describe_snapshots')
+    for page in paginator.paginate(OwnerIds=['self'], Filters=[
+            {'Name': 'tag:planb:cluster-name', 'Values': [cluster_name]}]):
+        for snapshot in page['Snapshots']:
+            backups[tags_as_dict(snapshot['Tags'])[backup_id_tag]].append(snapshot)
+    return backups
+
+
+def expired_backups(backup_ids: list, keep: int) -> list:
+    """
+    Backup IDs end with a UTC timestamp, so they sort by age.
+    """
+    return sorted(backup_ids, reverse=True)[keep:]
+
+
+def apply_retention(ec2: object, cluster_name: str, keep: int):
+    backups = list_backups(ec2, cluster_name)
+    for backup_id in expired_backups(list(backups), keep):
+        with Action('Deleting backup {}..'.format(backup_id)):
+            for snapshot in backups[backup_id]:
+                ec2.delete_snapshot(SnapshotId=snapshot['SnapshotId'])
+
+
+def backup_cluster(options: dict):
+    cluster_name = options['cluster_name']
+    backup_id = make_backup_id(cluster_name)
+
+    region_nodes = {}
+    for region in options['odd_hosts']:
+        ec2 = ec2_client(region)
+        instances = list(iter_instances(ec2, cluster_name, ['running']))
+        volumes = find_data_volumes(ec2, cluster_name, instances)
+        region_nodes[region] = [(i, volumes[i['InstanceId']])
+                                for i in instances if i['InstanceId'] in volumes]
+
+    with ExitStack() as stack:
+        urls = {}
+        for region, nodes in region_nodes.items():
+            urls.update(stack.enter_context(
+                jolokia.tunnels(options['odd_hosts'][region], [i for i, _ in nodes])
+            ))
+        with Action('Flushing {} nodes..'.format(len(urls))):
+            with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+                flushed = list(executor.map(lambda kv: flush_node(*kv), urls.items()))
+        if not all(flushed) and not options['allow_unflushed']:
+            raise Exception("Not all nodes could be flushed, not taking backup {}".format(backup_id))
+
+    jobs = [(region, instance, snapshot_tags(cluster_name, backup_id, instance, volume))
+            for region, nodes in region_nodes.items()
+            for instance, volume in nodes]
+    with Action('Taking backup {} of {} volumes..'.format(backup_id, len(jobs))):
+        with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+            list(executor.map(lambda job: snapshot_instance(*job), jobs))
+
+    if options['keep']:
+        for region in options['odd_hosts']:
+            apply_retention(ec2_client(region), cluster_name, options['keep'])
+
+    info('Backup {} started, snapshots complete in the background.'.format(backup_id))
+
+
+def wait_fast_restore_enabled(ec2: object, snapshot_id: str, zone: str):
+    with Action('Waiting for fast snapshot restore of {}..'.format(snapshot_id)) as act:
+        while True:
+            resp = ec2.describe_fast_snapshot_restores(Filters=[
+                {'Name': 'snapshot-id', 'Values': [snapshot_id]},
+                {'Name': 'availability-zone', 'Values': [zone]},
+            ])
+            states = [r['State'] for r in resp['FastSnapshotRestores']]
+            if states == ['enabled']:
+                return
+            time.sleep(30)
+            act.progress()
+
+
+def restore_volume(ec2: object, snapshot: dict, zone: str, fast_restore: bool) -> str:
+    tags = tags_as_dict(snapshot['Tags'])
+    if fast_restore:
+        ec2.enable_fast_snapshot_restores(AvailabilityZones=[zone],
+                                          SourceSnapshotIds=[snapshot['SnapshotId']])
+        wait_fast_restore_enabled(ec2, snapshot['SnapshotId'], zone)
+
+    params = {
+        'SnapshotId': snapshot['SnapshotId'],
+        'AvailabilityZone': zone,
+        'VolumeType': tags['planb:volume-type'],
+        'TagSpecifications': [{'ResourceType': 'volume',
+                               'Tags': [{'Key': 'Name', 'Value': tags['Name']}]}]
+    }
+    if 'planb:volume-iops' in tags:
+        params['Iops'] = int(tags['planb:volume-iops'])
+    if 'planb:volume-throughput' in tags:
+        params['Throughput'] = int(tags['planb:volume-throughput'])
+    return ec2.create_volume(**params)['VolumeId']
+
+
+def restore_nodes(options: dict):
+    """
+    Brings back lost nodes on their volumes as of the backup.  The nodes
+    keep their identity, so they rejoin the ring instead of replacing
+    themselves; run a repair afterwards to catch up on newer writes.
+    """
+    cluster_name = options['cluster_name']
+    region = options['region']
+    ec2 = ec2_client(region)
+
+    snapshots = {tags_as_dict(s['Tags'])['planb:private-ip']: s
+                 for s in list_backups(ec2, cluster_name).get(options['backup_id'], [])}
+    if not snapshots:
+        raise Exception("Backup {} not found in {}".format(options['backup_id'], region))
+
+    peers = list(iter_instances(ec2, cluster_name, ['running']))
+    ips = options['ip'] or [ip for ip in sorted(snapshots)
+                            if not find_blocking_instance(ec2, cluster_name, ip)]
+    for ip in ips:
+        if ip not in snapshots:
+            raise Exception("Backup {} has no volume of {}".format(options['backup_id'], ip))
+        blocking = find_blocking_instance(ec2, cluster_name, ip)
+        if blocking:
+            raise Exception("Instance {} still holds {}, please terminate it first".format(
+                blocking['InstanceId'], ip
+            ))
+
+    if options['sns_topic'] or options['sns_email']:
+        alarm_topics = setup_sns_topics_for_alarm([region], options['sns_topic'], options['sns_email'])
+    else:
+        alarm_topics = {}
+
+    db = journal.open_journal()
+    try:
+        specs = {}
+        for ip in ips:
+            public_ip = tags_as_dict(snapshots[ip]['Tags']).get('planb:public-ip')
+            specs[ip] = find_instance_spec(ec2, db, dict(options, ip=ip, public_ip=public_ip), peers)
+    finally:
+        db.close()
+
+    for ip in ips:
+        snapshot = snapshots[ip]
+        zone = ec2.describe_subnets(SubnetIds=[specs[ip]['SubnetId']])['Subnets'][0]['AvailabilityZone']
+        restore_volume(ec2, snapshot, zone, options['fast_restore'])
+        launch_node(ec2, specs[ip], dict(options, alarm_topics=alarm_topics))
+        if options['fast_restore']:
+            ec2.disable_fast_snapshot_restores(AvailabilityZones=[zone],
+                                               SourceSnapshotIds=[snapshot['SnapshotId']])
+
+    if peers:
+        with jolokia.tunnels(options['odd_host'], peers[:1]) as urls:
+            for url in urls.values():
+                addresses = {broadcast_address(specs[ip]) for ip in ips}
+                with Action('Waiting for restored nodes to rejoin the ring..') as act:
+                    while True:
+                        ring_state = read_ring_state(url)
+                        if ring_state and has_joined(ring_state, addresses):
+                            break
+                        time.sleep(10)
+                        act.progress()
+
+    info('Restored {} from backup {}'.format(', '.join(ips), options['backup_id']))
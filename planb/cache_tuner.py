@@ -0,0 +1,275 @@
+"""
+Live tuning of the key, row and counter cache capacities.
+
+Hits and requests of every cache are sampled from the Jolokia agents of all
+nodes and summed up over the cluster.  A cache which is full is grown step
+by step as long as every step still improves the hit rate noticeably; the
+capacity before the first step that did not pay off is kept.  A cache that
+is far from full is shrunk down to what it actually holds.
+
+Capacities are changed through the CacheService MBean on all nodes at once
+and recorded in a tag of every instance, from which the next update of the
+cluster writes them into the user data.  The chunk cache cannot be resized
+at runtime: its new capacity is only recorded, and used after the update.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import collections
+import logging
+import time
+import re
+
+from clickclick import info, print_table
+
+from . import jolokia
+from .common import ec2_client
+from .inventory import stream_instances
+from .update_cluster import tuned_environment, format_tuned_environment, \
+    tuned_environment_tag, create_tags
+
+
+logger = logging.getLogger(__name__)
+
+cache_service_mbean = 'org.apache.cassandra.db:type=Caches'
+cache_mbean = 'org.apache.cassandra.metrics:type=Cache,scope=*,name={}'
+
+cache_queries = [
+    {'type': 'read', 'mbean': cache_mbean.format('Hits'), 'attribute': 'Count'},
+    {'type': 'read', 'mbean': cache_mbean.format('Requests'), 'attribute': 'Count'},
+    {'type': 'read', 'mbean': cache_mbean.format('Size'), 'attribute': 'Value'},
+    {'type': 'read', 'mbean': cache_mbean.format('Capacity'), 'attribute': 'Value'},
+    {'type': 'read', 'mbean': 'java.lang:type=Memory', 'attribute': 'HeapMemoryUsage'},
+]
+
+# the CacheService attribute to resize the cache at runtime, and the
+# environment variable of the Docker image setting it at startup
+caches = collections.OrderedDict([
+    ('KeyCache', {'attribute': 'KeyCacheCapacityInMB', 'env': 'KEY_CACHE_SIZE_MB'}),
+    ('RowCache', {'attribute': 'RowCacheCapacityInMB', 'env': 'ROW_CACHE_SIZE_MB'}),
+    ('CounterCache', {'attribute': 'CounterCacheCapacityInMB', 'env': 'COUNTER_CACHE_SIZE_MB'}),
+    ('ChunkCache', {'attribute': None, 'env': 'FILE_CACHE_SIZE_MB'}),
+])
+
+# share of the heap the on-heap caches may take
+max_heap_share = {'KeyCache': 0.1, 'CounterCache': 0.05}
+
+# a cache holding more than this share of its capacity is full, and
+# evicting entries
+full_ratio = 0.9
+
+# a cache holding less than this share of its capacity is oversized
+shrink_ratio = 0.5
+
+growth_factor = 1.5
+min_capacity = 16
+
+# hit rates computed over fewer requests are noise
+min_requests = 1000
+
+# the chunk cache should serve at least this share of the reads
+target_chunk_hit_rate = 0.9
+
+
+def cache_scope(mbean: str) -> str:
+    return re.search('scope=([^,]+)', mbean).group(1)
+
+
+def parse_counters(values: list) -> dict:
+    """
+    Returns hits, requests, size and capacity by cache for one node, the
+    latter two in MiB.
+    """
+    hits, requests, size, capacity, heap = values
+    result = {}
+    for mbean, v in (hits or {}).items():
+        result[cache_scope(mbean)] = {'hits': v['Count'], 'requests': 0, 'size': 0, 'capacity': 0}
+    for field, values, attribute, scale in [('requests', requests, 'Count', 1),
+                                            ('size', size, 'Value', 1024 ** 2),
+                                            ('capacity', capacity, 'Value', 1024 ** 2)]:
+        for mbean, v in (values or {}).items():
+            if cache_scope(mbean) in result:
+                result[cache_scope(mbean)][field] = v[attribute] / scale
+    return result
+
+
+def sum_counters(nodes: list) -> dict:
+    """
+    Cluster-wide totals of the hits and requests, and the mean size and
+    capacity of the caches per node.
+    """
+    result = {}
+    for counters in nodes:
+        for scope, c in counters.items():
+            total = result.setdefault(scope, {'hits': 0, 'requests': 0, 'size': 0, 'capacity': 0})
+            for field in total:
+                total[field] += c[field]
+    for total in result.values():
+        total['size'] /= len(nodes)
+        total['capacity'] /= len(nodes)
+    return result
+
+
+def hit_rate(prev: dict, cur: dict) -> float:
+    """
+    Hit rate between two samples, or None if there were too few requests.
+    """
+    requests = cur['requests'] - prev['requests']
+    if requests < min_requests:
+        return None
+    return max(cur['hits'] - prev['hits'], 0) / requests
+
+
+class CacheController:
+    """
+    Finds the capacity of one cache beyond which growing it does not pay
+    off any more.  Every step gets the hit rate measured at the current
+    capacity and returns the capacity for the next step; `settled` is set
+    once the search is over.
+    """
+
+    def __init__(self, capacity: int, max_capacity: int, min_gain: float):
+        self.capacity = capacity
+        self.max_capacity = max_capacity
+        self.min_gain = min_gain
+        self.history = []
+        self.settled = None
+
+    def settle(self, capacity: int) -> int:
+        self.settled = self.capacity = capacity
+        return capacity
+
+    def step(self, rate: float, size: float) -> int:
+        if rate is None or self.capacity == 0:
+            # idle, or disabled on purpose
+            return self.settle(self.capacity)
+        if size < self.capacity * shrink_ratio and not self.history:
+            return self.settle(max(int(size * growth_factor), min_capacity))
+        if self.history:
+            prev_capacity, prev_rate = self.history[-1]
+            if rate - prev_rate < self.min_gain:
+                return self.settle(prev_capacity)
+        self.history.append((self.capacity, rate))
+        if size < self.capacity * full_ratio:
+            # not evicting, more room would not change the hit rate
+            return self.settle(self.capacity)
+        capacity = min(int(self.capacity * growth_factor), self.max_capacity)
+        if capacity <= self.capacity:
+            return self.settle(self.capacity)
+        self.capacity = capacity
+        return capacity
+
+
+def chunk_cache_capacity(rate: float, size: float, capacity: int, max_capacity: int) -> int:
+    """
+    The chunk cache cannot be resized at runtime, so it cannot be searched
+    like the others: it is grown once if it is evicting and misses too
+    often, or shrunk if it is mostly empty.
+    """
+    if rate is None or capacity == 0:
+        return capacity
+    if size < capacity * shrink_ratio:
+        return max(int(size * growth_factor), min_capacity)
+    if size >= capacity * full_ratio and rate < target_chunk_hit_rate:
+        return max(min(int(capacity * growth_factor), max_capacity), capacity)
+    return capacity
+
+
+def read_counters(urls: list) -> tuple:
+    """
+    Returns the cluster-wide counters and the smallest max heap in MiB.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        results = list(executor.map(lambda url: jolokia.query(url, cache_queries), urls))
+    nodes = []
+    heaps = []
+    for values in results:
+        if values and values[0]:
+            nodes.append(parse_counters(values))
+        if values and values[4]:
+            heaps.append(values[4]['max'] / 1024 ** 2)
+    if not nodes:
+        raise Exception("Could not read the cache metrics of any node")
+    return sum_counters(nodes), min(heaps) if heaps else 0
+
+
+def set_capacity(urls: list, scope: str, capacity: int):
+    query = {'type': 'write', 'mbean': cache_service_mbean,
+             'attribute': caches[scope]['attribute'], 'value': capacity}
+    logger.info("Setting the {} capacity to {} MiB".format(scope, capacity))
+    for url in urls:
+        result = jolokia.query(url, [query])
+        if not result or result == [None]:
+            logger.warning("Failed to set the {} capacity on {}".format(scope, url))
+
+
+def max_capacities(heap: float, options: dict) -> dict:
+    result = {scope: int(heap * share) for scope, share in max_heap_share.items()}
+    result['RowCache'] = options['max_row_cache']
+    result['ChunkCache'] = options['max_chunk_cache']
+    return result
+
+
+def persist_capacities(region_instances: dict, capacities: dict):
+    environment = {caches[scope]['env']: str(capacity) for scope, capacity in capacities.items()}
+    for region, instances in region_instances.items():
+        ec2 = ec2_client(region)
+        for i in instances:
+            tuned = dict(tuned_environment(i), **environment)
+            create_tags(ec2, i['InstanceId'], {tuned_environment_tag: format_tuned_environment(tuned)})
+
+
+def tune_caches(options: dict):
+    region_instances = collections.defaultdict(list)
+    for region, i in stream_instances(options['cluster_name'], list(options['odd_hosts']), ['running']):
+        region_instances[region].append(i)
+
+    with ExitStack() as stack:
+        urls = []
+        for region, instances in region_instances.items():
+            urls.extend(stack.enter_context(
+                jolokia.tunnels(options['odd_hosts'][region], instances)
+            ).values())
+
+        prev, heap = read_counters(urls)
+        initial = {scope: int(c['capacity']) for scope, c in prev.items()}
+        limits = max_capacities(heap, options)
+        controllers = {
+            scope: CacheController(initial[scope], limits[scope], options['min_gain'])
+            for scope in caches if scope in initial and caches[scope]['attribute']
+        }
+        rates = {}
+        for _ in range(options['max_steps']):
+            if all(c.settled is not None for c in controllers.values()):
+                break
+            time.sleep(options['interval'])
+            cur, _ = read_counters(urls)
+            for scope, controller in controllers.items():
+                if controller.settled is not None:
+                    continue
+                rates[scope] = hit_rate(prev[scope], cur[scope])
+                before = controller.capacity
+                capacity = controller.step(rates[scope], cur[scope]['size'])
+                if capacity != before:
+                    set_capacity(urls, scope, capacity)
+            prev = cur
+
+        capacities = {scope: c.capacity for scope, c in controllers.items()}
+        if 'ChunkCache' in initial:
+            rates['ChunkCache'] = hit_rate({'hits': 0, 'requests': 0}, prev['ChunkCache'])
+            capacities['ChunkCache'] = chunk_cache_capacity(
+                rates['ChunkCache'], prev['ChunkCache']['size'], initial['ChunkCache'], limits['ChunkCache']
+            )
+
+    rows = [{
+        'cache': scope,
+        'hit_rate': '{:.1%}'.format(rates[scope]) if rates.get(scope) is not None else '',
+        'before': initial[scope],
+        'after': capacity,
+        'applied': 'live' if caches[scope]['attribute'] else 'after update'
+    } for scope, capacity in sorted(capacities.items())]
+    print_table(['cache', 'hit_rate', 'before', 'after', 'applied'], rows,
+                titles={'before': 'Before MiB', 'after': 'After MiB'})
+
+    if options['persist']:
+        persist_capacities(region_instances, capacities)
+        info('Capacities recorded, the next planb update writes them into the user data.')
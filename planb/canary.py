@@ -0,0 +1,128 @@
+"""
+Latency and dropped messages sampling to decide whether a canary update
+has made the node perform worse.  The canary is compared to its peers
+sampled at the same time, so that it is neither diluted by them nor
+mistaken for a change of the load of the whole cluster.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+from . import jolokia
+
+
+logger = logging.getLogger(__name__)
+
+latency_mbean = 'org.apache.cassandra.metrics:type=ClientRequest,scope={},name=Latency'
+dropped_mbean = 'org.apache.cassandra.metrics:type=DroppedMessage,scope=*,name=Dropped'
+
+latency_keys = ['read_p50', 'read_p99', 'write_p50', 'write_p99']
+
+
+def sample_node(url: str) -> dict:
+    queries = [
+        {'type': 'read', 'mbean': latency_mbean.format(scope),
+         'attribute': ['50thPercentile', '99thPercentile']}
+        for scope in ['Read', 'Write']
+    ]
+    queries.append({'type': 'read', 'mbean': dropped_mbean, 'attribute': 'Count'})
+
+    values = jolokia.query(url, queries)
+    if not values or None in values:
+        return None
+    read, write, dropped = values
+    return {
+        'read_p50': read['50thPercentile'],
+        'read_p99': read['99thPercentile'],
+        'write_p50': write['50thPercentile'],
+        'write_p99': write['99thPercentile'],
+        'dropped': sum(v['Count'] for v in dropped.values())
+    }
+
+
+def sample_nodes(urls: dict) -> dict:
+    """
+    Samples all nodes at the same time, returns the samples by node IP,
+    leaving out the nodes which cannot be reached.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        samples = dict(zip(urls.keys(), executor.map(sample_node, urls.values())))
+    return {ip: s for ip, s in samples.items() if s}
+
+
+def select_nodes(samples: list, ips: set) -> list:
+    return [{ip: s for ip, s in nodes.items() if ip in ips} for nodes in samples]
+
+
+def aggregate_latency(samples: list) -> dict:
+    """
+    Averages latency percentiles over a list of samples of all nodes.
+    """
+    node_samples = [s for nodes in samples for s in nodes.values()]
+    if not node_samples:
+        return None
+    return {
+        k: sum(s[k] for s in node_samples) / len(node_samples)
+        for k in latency_keys
+    }
+
+
+def dropped_delta(first: dict, last: dict) -> int:
+    """
+    Counts messages dropped between two samples.  A node restarted in
+    between resets its counters, so only increments are taken into account.
+    """
+    return sum(
+        max(last[ip]['dropped'] - first[ip]['dropped'], 0)
+        for ip in first.keys() & last.keys()
+    )
+
+
+def find_regressions(baseline: dict, current: dict, dropped: int,
+                     options: dict) -> list:
+    regressions = []
+    max_increase = options['max_latency_increase']
+    for k in latency_keys:
+        if baseline[k] > 0 and current[k] > baseline[k] * (1 + max_increase):
+            regressions.append(
+                "{} is {:.0f} microseconds, against {:.0f} of the baseline"
+                .format(k, current[k], baseline[k])
+            )
+    if dropped > options['max_dropped_messages']:
+        regressions.append("{} messages were dropped".format(dropped))
+    return regressions
+
+
+def collect_samples(urls: dict, count: int, interval: int) -> list:
+    samples = [sample_nodes(urls)]
+    while len(samples) < count:
+        time.sleep(interval)
+        samples.append(sample_nodes(urls))
+    return samples
+
+
+def collect_baseline(urls: dict, options: dict) -> dict:
+    logger.info("Collecting baseline latency of {}".format(", ".join(urls)))
+    samples = collect_samples(urls, 3, options['sample_interval'])
+    return aggregate_latency(samples)
+
+
+def soak(urls: dict, canary_ip: str, baseline: dict, options: dict) -> list:
+    """
+    Samples the canary and its peers for the soak time and returns the list
+    of regressions of the canary compared to its peers, or to the baseline
+    taken before the update if none of the peers could be sampled.
+    """
+    logger.info("Soaking canary for {} seconds".format(options['soak_time']))
+    count = max(options['soak_time'] // options['sample_interval'], 2)
+    samples = collect_samples(urls, count, options['sample_interval'])
+
+    canary_samples = select_nodes(samples, {canary_ip})
+    current = aggregate_latency(canary_samples)
+    if not current:
+        return ["No latency metrics of the canary could be collected"]
+    peers = aggregate_latency(select_nodes(samples, urls.keys() - {canary_ip}))
+    if not peers:
+        logger.warning("No latency metrics of the peers, comparing the canary to its baseline")
+    dropped = dropped_delta(canary_samples[0], canary_samples[-1])
+    return find_regressions(peers or baseline, current, dropped, options)
@@ -0,0 +1,199 @@
+"""
+Capacity planner: sizes a cluster for a workload by evaluating every
+combination of instance type and EBS volume type of a small catalog.
+
+The model is deliberately simple and conservative.  Every data center is
+sized on its own for the full workload, with enough headroom to carry the
+load with one node down, and only configurations that `planb create` can
+launch are considered.
+"""
+import itertools
+import math
+
+from clickclick import print_table
+
+
+# Rough on-demand prices in eu-central-1, USD per hour.  EBS bandwidth is
+# the sustained (baseline) one, in MB/s, and bounds the disk throughput.
+instance_types = [
+    {'name': 'm5.large', 'vcpus': 2, 'memory': 8, 'ebs_mbps': 81, 'ebs_iops': 3600, 'price': 0.115},
+    {'name': 'm5.xlarge', 'vcpus': 4, 'memory': 16, 'ebs_mbps': 144, 'ebs_iops': 6000, 'price': 0.23},
+    {'name': 'm5.2xlarge', 'vcpus': 8, 'memory': 32, 'ebs_mbps': 287, 'ebs_iops': 12000, 'price': 0.46},
+    {'name': 'm5.4xlarge', 'vcpus': 16, 'memory': 64, 'ebs_mbps': 593, 'ebs_iops': 18750, 'price': 0.92},
+    {'name': 'r5.large', 'vcpus': 2, 'memory': 16, 'ebs_mbps': 81, 'ebs_iops': 3600, 'price': 0.152},
+    {'name': 'r5.xlarge', 'vcpus': 4, 'memory': 32, 'ebs_mbps': 144, 'ebs_iops': 6000, 'price': 0.304},
+    {'name': 'r5.2xlarge', 'vcpus': 8, 'memory': 64, 'ebs_mbps': 287, 'ebs_iops': 12000, 'price': 0.608},
+    {'name': 'r5.4xlarge', 'vcpus': 16, 'memory': 128, 'ebs_mbps': 593, 'ebs_iops': 18750, 'price': 1.216},
+    {'name': 'c5.xlarge', 'vcpus': 4, 'memory': 8, 'ebs_mbps': 144, 'ebs_iops': 6000, 'price': 0.194},
+    {'name': 'c5.2xlarge', 'vcpus': 8, 'memory': 16, 'ebs_mbps': 287, 'ebs_iops': 12000, 'price': 0.388},
+]
+
+# USD per GB-month and per provisioned IOPS-month
+volume_types = [
+    {'name': 'gp2', 'price_gb': 0.119, 'max_size': 16384},
+    {'name': 'io1', 'price_gb': 0.149, 'price_iops': 0.078, 'max_size': 16384,
+     'max_iops': 64000, 'max_iops_per_gb': 50},
+]
+
+hours_per_month = 730
+
+# replica operations a core can serve at full load
+reads_per_core = 3000
+writes_per_core = 6000
+
+# fraction of the resources to plan for, leaving room for spikes, repair
+# and streaming
+target_utilization = 0.7
+
+# size-tiered compaction needs up to the size of the data as free space
+max_disk_utilization = 0.5
+
+# more data per node makes streaming, repair and replacement too slow
+max_data_per_node = 1024
+
+# disk reads per replica read, taking bloom filters and caches into account
+disk_reads_per_read = 1.5
+
+# bytes written to disk per byte written by clients: the commit log, the
+# flush and the rewrites by compaction
+write_amplification = 1 + 1 + 5
+
+min_memory = 8
+
+
+def workload_per_dc(options: dict) -> dict:
+    """
+    Replica level load of every data center, with reads at LOCAL_QUORUM.
+    """
+    rf = options['replication_factor']
+    growth = (1 + options['growth']) ** options['years']
+    replica_writes = options['writes'] * rf
+    return {
+        'replica_reads': options['reads'] * (rf // 2 + 1),
+        'replica_writes': replica_writes,
+        'write_mbps': replica_writes * options['row_size'] * write_amplification / 1e6,
+        'data_gb': options['data_size'] * growth * rf
+    }
+
+
+def gp2_iops(size: int) -> int:
+    return min(max(3 * size, 100), 16000)
+
+
+def size_volume(volume_type: dict, data_gb: float, iops: float) -> tuple:
+    """
+    Returns (size, provisioned IOPS) of the cheapest volume holding the data
+    with compaction headroom and delivering the IOPS, or None.
+    """
+    size = int(math.ceil(data_gb / max_disk_utilization / 10.0)) * 10
+    if volume_type['name'] == 'gp2':
+        # gp2 IOPS grow with the size
+        size = max(size, int(math.ceil(iops / 3.0)))
+        if size > volume_type['max_size'] or gp2_iops(size) < iops:
+            return None
+        return size, None
+    provisioned = int(math.ceil(iops / 100.0)) * 100
+    size = max(size, int(math.ceil(provisioned / float(volume_type['max_iops_per_gb']))))
+    if size > volume_type['max_size'] or provisioned > volume_type['max_iops']:
+        return None
+    return size, provisioned
+
+
+def volume_price(volume_type: dict, size: int, iops: int) -> float:
+    return size * volume_type['price_gb'] + (iops or 0) * volume_type.get('price_iops', 0)
+
+
+def evaluate(instance: dict, volume_type: dict, nodes: int, workload: dict) -> dict:
+    """
+    Checks whether a data center of the given number of nodes can carry
+    the workload with one node down.  Returns the configuration, or None.
+    """
+    if instance['memory'] < min_memory:
+        return None
+    serving = nodes - 1
+    data_per_node = workload['data_gb'] / nodes
+    if data_per_node > max_data_per_node:
+        return None
+
+    cpu = (workload['replica_reads'] / reads_per_core +
+           workload['replica_writes'] / writes_per_core) / serving / instance['vcpus']
+    if cpu > target_utilization:
+        return None
+
+    iops = workload['replica_reads'] * disk_reads_per_read / serving / target_utilization
+    if iops > instance['ebs_iops']:
+        return None
+    mbps = workload['write_mbps'] / serving
+    if mbps > instance['ebs_mbps'] * target_utilization:
+        return None
+
+    volume = size_volume(volume_type, data_per_node, iops)
+    if not volume:
+        return None
+    size, provisioned = volume
+
+    monthly = nodes * (instance['price'] * hours_per_month + volume_price(volume_type, size, provisioned))
+    return {
+        'instance_type': instance['name'],
+        'nodes': nodes,
+        'volume_type': volume_type['name'],
+        'volume_size': size,
+        'volume_iops': provisioned,
+        'cpu': cpu,
+        'disk': data_per_node / size,
+        'monthly_cost': monthly
+    }
+
+
+def plan(options: dict) -> list:
+    """
+    Returns the feasible configurations, cheapest first.  For every
+    combination of instance and volume type only the smallest number of
+    nodes that works is considered.
+    """
+    workload = workload_per_dc(options)
+    min_nodes = max(3, options['replication_factor'] + 1)
+    configs = []
+    for instance, volume_type in itertools.product(instance_types, volume_types):
+        for nodes in range(min_nodes, options['max_nodes'] + 1):
+            config = evaluate(instance, volume_type, nodes, workload)
+            if config:
+                configs.append(config)
+                break
+    return sorted(configs, key=lambda c: c['monthly_cost'])
+
+
+def create_command(config: dict, options: dict) -> str:
+    args = [
+        'planb', 'create',
+        '--cluster-name', options['cluster_name'],
+        '--cluster-size', str(config['nodes']),
+        '--instance-type', config['instance_type'],
+        '--volume-type', config['volume_type'],
+        '--volume-size', str(config['volume_size']),
+    ]
+    if config['volume_iops']:
+        args += ['--volume-iops', str(config['volume_iops'])]
+    if len(options['regions']) > 1:
+        args.append('--use-dmz')
+    return ' '.join(args + list(options['regions']))
+
+
+def run_plan(options: dict):
+    configs = plan(options)[:options['top']]
+    regions = len(options['regions'])
+    rows = [dict(
+        c,
+        rank=rank,
+        volume_iops=c['volume_iops'] or '',
+        cpu='{:.0%}'.format(c['cpu']),
+        disk='{:.0%}'.format(c['disk']),
+        monthly_cost='{:,.0f}'.format(c['monthly_cost'] * regions)
+    ) for rank, c in enumerate(configs, 1)]
+    print_table(['rank', 'instance_type', 'nodes', 'volume_type', 'volume_size',
+                 'volume_iops', 'cpu', 'disk', 'monthly_cost'], rows,
+                titles={'nodes': 'Nodes/Region', 'volume_size': 'Size GB', 'volume_iops': 'IOPS',
+                        'cpu': 'CPU', 'disk': 'Disk', 'monthly_cost': 'USD/Month'})
+    print()
+    for rank, c in enumerate(configs, 1):
+        print('{}: {}'.format(rank, create_command(c, options)))
@@ -1,11 +1,12 @@
 import re
+import sys
 import click
 import logging
+import collections
 
-from .common import ec2_client, list_instances
-from .show_cluster import show_instances
-from .create_cluster import create_cluster
-from .update_cluster import update_cluster
+# Commands import their implementation only when they run: boto3, requests,
+# yaml and netaddr take hundreds of milliseconds to load, which --help and
+# usage errors should not pay.
 
 
 def configure_logging(level):
@@ -34,11 +35,21 @@ def cli(debug: bool):
 @click.option('--use-dmz', is_flag=True, default=False, help='deploy into DMZ subnets using Public IP addresses')
 @click.option('--hosted-zone', help='create SRV records in this Hosted Zone')
 @click.option('--scalyr-key')
-@click.option('--artifact-name', help='Pierone artifact name to use (default: planb-cassandra-3.0)')
-@click.option('--docker-image', help='Docker image to use (default: latest planb-cassandra-3.0)')
+@click.option('--engine', default='cassandra', type=click.Choice(['cassandra', 'scylla']),
+              help='default: cassandra')
+@click.option('--artifact-name', help='Pierone artifact name to use (default: planb-cassandra-3.0, '
+                                      'or planb-scylla-1.3 for --engine scylla)')
+@click.option('--docker-image', help='Docker image to use (default: latest of the artifact)')
 @click.option('--environment', '-e', multiple=True)
 @click.option('--sns-topic', help='SNS topic name to send Auto-Recovery notifications to')
 @click.option('--sns-email', help='Email address to subscribe to Auto-Recovery SNS topic')
+@click.option('--inline-keystores', is_flag=True, default=False,
+              help='embed the keystores in the user data instead of SSM Parameter Store, '
+                   'for Docker images which cannot fetch them')
+@click.option('--gzip-user-data', is_flag=True, default=False,
+              help='gzip compress the user data of the instances')
+@click.option('--skip-preflight', is_flag=True, default=False,
+              help='do not check quotas and capacity in all regions before creating anything')
 def create(regions: list,
            cluster_name: str,
            cluster_size: int,
@@ -51,11 +62,15 @@ def create(regions: list,
            use_dmz: bool,
            hosted_zone: str,
            scalyr_key: str,
+           engine: str,
            artifact_name: str,
            docker_image: str,
            environment: list,
            sns_topic: str,
-           sns_email: str):
+           sns_email: str,
+           inline_keystores: bool,
+           gzip_user_data: bool,
+           skip_preflight: bool):
 
     if not cluster_name:
         raise click.UsageError('You must specify the cluster name')
@@ -75,7 +90,12 @@ def create(regions: list,
     if len(regions) > 1 and not(use_dmz):
         raise click.UsageError('Multi-region deployment requires --use-dmz')
 
-    create_cluster(options=locals())
+    if engine == 'scylla' and use_dmz:
+        raise click.UsageError('Scylla can only be deployed into internal subnets, without --use-dmz')
+
+    options = locals()
+    from .create_cluster import create_cluster
+    create_cluster(options)
 
 
 sns_topic_help = 'SNS topic name to send Auto-Recovery notifications to'
@@ -84,21 +104,53 @@ sns_email_help = 'Email address to subscribe to Auto-Recovery SNS topic'
 
 @cli.command()
 @click.option('--cluster-name', type=str, required=True)
-@click.option('--odd-host', '-O', type=str, required=True)
-@click.option('--region', type=str, required=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--concurrency', default=1, type=int,
+              help='number of nodes to update at a time in every region, default: 1')
+@click.option('--parallel-regions', is_flag=True, default=False,
+              help='update all regions at the same time instead of one by one')
+@click.option('--canary', is_flag=True, default=False,
+              help='update a single node first and compare its latency to the baseline')
+@click.option('--soak-time', default=600, type=int,
+              help='seconds to watch the canary node before proceeding, default: 600')
+@click.option('--sample-interval', default=10, type=int,
+              help='seconds between metrics samples, default: 10')
+@click.option('--canary-peers', default=2, type=int,
+              help='number of peer nodes to sample besides the canary, default: 2')
+@click.option('--max-latency-increase', default=0.2, type=float,
+              help='allowed relative increase of latency percentiles, default: 0.2')
+@click.option('--max-dropped-messages', default=100, type=int,
+              help='allowed number of dropped messages during soak, default: 100')
+@click.option('--rollback', is_flag=True, default=False,
+              help='roll back the canary node if a regression is found')
 @click.option('--force-termination', is_flag=True, default=False)
 @click.option('--docker-image', type=str)
 @click.option('--taupage-ami-id', type=str)
 @click.option('--instance-type', type=str)
+@click.option('--move-keystores', is_flag=True, default=False,
+              help='move keystores embedded in the user data to SSM Parameter Store, '
+                   'requires a Docker image which can fetch them')
 @click.option('--sns-topic', help=sns_topic_help)
 @click.option('--sns-email', help=sns_email_help)
 def update(cluster_name: str,
-           odd_host: str,
-           region: str,
+           odd_host: list,
+           region: list,
+           concurrency: int,
+           parallel_regions: bool,
+           canary: bool,
+           soak_time: int,
+           sample_interval: int,
+           canary_peers: int,
+           max_latency_increase: float,
+           max_dropped_messages: int,
+           rollback: bool,
            force_termination: bool,
            docker_image: str,
            taupage_ami_id: str,
            instance_type: str,
+           move_keystores: bool,
            sns_topic: str,
            sns_email: str):
 
@@ -106,15 +158,381 @@ def update(cluster_name: str,
         msg = "Please specify at least one of --docker-image or --taupage-ami-id"
         raise click.UsageError(msg)
 
-    update_cluster(options=locals())
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    if concurrency < 1:
+        raise click.UsageError('--concurrency must be at least 1')
+
+    if sample_interval < 1:
+        raise click.UsageError('--sample-interval must be at least 1')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .update_cluster import update_cluster
+    update_cluster(options)
+
+
+@cli.command()
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, multiple=True,
+              help='can be repeated, default: all regions the cluster is deployed to')
+@click.option('--hosted-zone', help='find the regions from SRV records in this Hosted Zone')
+@click.option('--status', is_flag=True, default=False,
+              help='show live health and load of every node, requires --odd-host')
+@click.option('--odd-host', '-O', type=str, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--cache-ttl', default=10, type=int,
+              help='seconds to reuse the last fetched status, default: 10')
+def nodes(region: list, cluster_name: str, hosted_zone: str, status: bool,
+          odd_host: list, cache_ttl: int):
+    if status and len(odd_host) != len(region):
+        raise click.UsageError('Please specify --region and one --odd-host for every region')
+
+    from .inventory import discover_regions, stream_instances
+    from .node_status import fetch_cluster_status, load_cached_status, save_cached_status
+    from .show_cluster import show_region_instances, show_node_status
+
+    regions = list(region) or discover_regions(cluster_name, hosted_zone)
+    if not status:
+        show_region_instances(stream_instances(cluster_name, regions, elastic_ips=True))
+        return
+
+    rows = load_cached_status(cluster_name, regions, cache_ttl)
+    if rows is None:
+        region_instances = collections.defaultdict(list)
+        for r, i in stream_instances(cluster_name, regions, ['running']):
+            region_instances[r].append(i)
+        rows = fetch_cluster_status(dict(zip(region, odd_host)), region_instances)
+        save_cached_status(cluster_name, regions, rows)
+    show_node_status(rows)
+
+
+@cli.command()
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--port', default=9500, type=int, help='HTTP port to serve metrics on, default: 9500')
+@click.option('--interval', default=30, type=int, help='seconds between metrics collections, default: 30')
+@click.option('--discovery-interval', default=300, type=int,
+              help='seconds between looking for new or gone nodes, default: 300')
+def exporter(cluster_name: str, region: list, odd_host: list, port: int,
+             interval: int, discovery_interval: int):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .exporter import run_exporter
+    run_exporter(options)
+
+
+@cli.command()
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--interval', default=5, type=int, help='seconds between refreshes, default: 5')
+@click.option('--history', default=60, type=int,
+              help='number of samples to average rates over, default: 60')
+@click.option('--tables', default=10, type=int, help='number of busiest tables to show, default: 10')
+def top(cluster_name: str, region: list, odd_host: list, interval: int,
+        history: int, tables: int):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    if history < 2:
+        raise click.UsageError('--history must be at least 2')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .top import run_top
+    run_top(options)
+
+
+@cli.command()
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--keyspace', type=str, multiple=True, help='default: all non-system keyspaces')
+@click.option('--partitions-per-range', default=100000, type=int,
+              help='estimated number of partitions to repair at once, default: 100000')
+@click.option('--node-parallelism', default=1, type=int,
+              help='number of repairs involving the same node at a time, default: 1')
+@click.option('--dc-parallelism', default=2, type=int,
+              help='number of repairs involving the same data center at a time, default: 2')
+@click.option('--parallelism', default='sequential',
+              type=click.Choice(['sequential', 'parallel', 'dc_parallel']))
+@click.option('--max-pending-compactions', default=20, type=int,
+              help='back off while any node has more pending compactions, default: 20')
+@click.option('--poll-interval', default=10, type=int, help='default: 10 seconds')
+@click.option('--max-backoff', default=600, type=int, help='default: 600 seconds')
+@click.option('--range-timeout', default=3600, type=int,
+              help='seconds after which a subrange repair is considered failed, default: 3600')
+@click.option('--max-attempts', default=3, type=int, help='attempts to repair every subrange, default: 3')
+@click.option('--restart', is_flag=True, default=False, help='discard the progress of a previous run')
+def repair(cluster_name: str, region: list, odd_host: list, keyspace: list,
+           partitions_per_range: int, node_parallelism: int, dc_parallelism: int,
+           parallelism: str, max_pending_compactions: int, poll_interval: int,
+           max_backoff: int, range_timeout: int, max_attempts: int, restart: bool):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .repair import run_repair
+    if not run_repair(options):
+        sys.exit(1)
+
+
+@cli.command('scale-out')
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True,
+              help='region to add nodes to, can be repeated')
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--add', default=1, type=int, help='number of nodes to add per region, default: 1')
+@click.option('--join-concurrency', default=1, type=int,
+              help='number of nodes to bootstrap at a time, default: 1')
+@click.option('--join-timeout', default=7200, type=int,
+              help='seconds to wait for a node to join the ring, default: 7200')
+@click.option('--cleanup-concurrency', default=1, type=int,
+              help='number of existing nodes to clean up at a time, default: 1')
+@click.option('--max-pending-compactions', default=20, type=int,
+              help='wait before cleaning up a node with more pending compactions, default: 20')
+@click.option('--hosted-zone', help='update the DNS records in this Route53 Hosted Zone')
+@click.option('--sns-topic', help=sns_topic_help)
+@click.option('--sns-email', help=sns_email_help)
+def scale_out(cluster_name: str, region: list, odd_host: list, add: int,
+              join_concurrency: int, join_timeout: int, cleanup_concurrency: int,
+              max_pending_compactions: int, hosted_zone: str, sns_topic: str,
+              sns_email: str):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    if add < 1:
+        raise click.UsageError('--add must be at least 1')
+
+    if hosted_zone and not hosted_zone.endswith('.'):
+        hosted_zone += '.'
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .scale_out import scale_out as run_scale_out
+    run_scale_out(options)
+
+
+@cli.command('replace-node')
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True)
+@click.option('--odd-host', '-O', type=str, required=True)
+@click.option('--ip', type=str, required=True, help='private IP address of the dead node')
+@click.option('--public-ip', type=str,
+              help='Elastic IP of the dead node, if not known from a previous update')
+@click.option('--stream-throughput', default=400, type=int,
+              help='outbound streaming throughput of the other nodes while replacing, '
+                   'in megabits per second, default: 400')
+@click.option('--join-timeout', default=86400, type=int,
+              help='seconds to wait for the new node to finish streaming, default: 86400')
+@click.option('--sns-topic', help=sns_topic_help)
+@click.option('--sns-email', help=sns_email_help)
+def replace_node(cluster_name: str, region: str, odd_host: str, ip: str, public_ip: str,
+                 stream_throughput: int, join_timeout: int, sns_topic: str, sns_email: str):
+    options = dict(locals())
+    from .replace_node import replace_node as run_replace_node
+    run_replace_node(options)
+
+
+@cli.command()
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--keep', default=7, type=int,
+              help='number of backups to keep, 0 to keep all, default: 7')
+@click.option('--allow-unflushed', is_flag=True, default=False,
+              help='take the backup even if some nodes could not be flushed')
+def backup(cluster_name: str, region: list, odd_host: list, keep: int, allow_unflushed: bool):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .backup import backup_cluster
+    backup_cluster(options)
+
+
+@cli.command()
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True)
+@click.option('--odd-host', '-O', type=str, required=True)
+@click.option('--backup-id', type=str, required=True)
+@click.option('--ip', type=str, multiple=True,
+              help='private IP of a node to restore, can be repeated, '
+                   'default: all nodes of the backup which are gone')
+@click.option('--fast-restore/--no-fast-restore', default=True,
+              help='enable fast snapshot restore while creating the volumes, default: enabled')
+@click.option('--sns-topic', help=sns_topic_help)
+@click.option('--sns-email', help=sns_email_help)
+def restore(cluster_name: str, region: str, odd_host: str, backup_id: str, ip: list,
+            fast_restore: bool, sns_topic: str, sns_email: str):
+    options = dict(locals())
+    from .backup import restore_nodes
+    restore_nodes(options)
+
+
+@cli.command('resize-volumes')
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--size', type=int, help='new size of the data volumes in GiB')
+@click.option('--volume-type', type=click.Choice(['gp2', 'gp3', 'io1', 'io2', 'st1']))
+@click.option('--iops', type=int, help='provisioned IOPS for io1, io2 and gp3 volumes')
+@click.option('--throughput', type=int, help='throughput in MiB/s for gp3 volumes')
+@click.option('--concurrency', default=3, type=int,
+              help='number of volumes to modify at a time, default: 3')
+def resize_volumes(cluster_name: str, region: list, odd_host: list, size: int,
+                   volume_type: str, iops: int, throughput: int, concurrency: int):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    if not (size or volume_type or iops or throughput):
+        raise click.UsageError('Please specify at least one of --size, --volume-type, --iops, --throughput')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .resize_volumes import resize_volumes as run_resize_volumes
+    if not run_resize_volumes(options):
+        sys.exit(1)
 
 
 @cli.command()
+@click.argument('regions', nargs=-1)
+@click.option('--cluster-name', default='mycluster', help='used in the suggested create commands')
+@click.option('--reads', type=int, required=True, help='client reads per second in every region')
+@click.option('--writes', type=int, required=True, help='client writes per second in every region')
+@click.option('--row-size', default=1024, type=int, help='average row size in bytes, default: 1024')
+@click.option('--data-size', type=float, required=True, help='size of the data in GB, not replicated')
+@click.option('--replication-factor', default=3, type=int, help='in every region, default: 3')
+@click.option('--growth', default=0.0, type=float, help='yearly data growth, e.g. 0.5 for 50%, default: 0')
+@click.option('--years', default=1, type=int, help='years of growth to plan for, default: 1')
+@click.option('--max-nodes', default=30, type=int, help='per region, default: 30')
+@click.option('--top', default=5, type=int, help='number of configurations to show, default: 5')
+def plan(regions: list, cluster_name: str, reads: int, writes: int, row_size: int,
+         data_size: float, replication_factor: int, growth: float, years: int,
+         max_nodes: int, top: int):
+    if not regions:
+        raise click.UsageError('Please specify at least one region')
+
+    options = locals()
+    from .capacity import run_plan
+    run_plan(options)
+
+
+@cli.command('advise-tables')
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--repair-interval', default=7, type=int,
+              help='days between repairs of every table, default: 7')
+@click.option('--repair-duration', default=1, type=int,
+              help='days a repair of the whole cluster takes, default: 1')
+@click.option('--top', default=20, type=int, help='number of recommendations to show, default: 20')
+def advise_tables(cluster_name: str, region: list, odd_host: list, repair_interval: int, repair_duration: int,
+                  top: int):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .table_advisor import run_advise_tables
+    run_advise_tables(options)
+
+
+@cli.command('tune-caches')
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--interval', default=300, type=int,
+              help='seconds to measure the hit rates at every capacity, default: 300')
+@click.option('--max-steps', default=6, type=int, help='capacity changes to try at most, default: 6')
+@click.option('--min-gain', default=0.01, type=float,
+              help='hit rate increase a step must bring to keep growing, default: 0.01')
+@click.option('--max-row-cache', default=1024, type=int, help='in MiB, default: 1024')
+@click.option('--max-chunk-cache', default=2048, type=int, help='in MiB, default: 2048')
+@click.option('--persist/--no-persist', default=True,
+              help='record the capacities for the next update of the cluster, default: enabled')
+def tune_caches(cluster_name: str, region: list, odd_host: list, interval: int, max_steps: int,
+                min_gain: float, max_row_cache: int, max_chunk_cache: int, persist: bool):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .cache_tuner import tune_caches as run_tune_caches
+    run_tune_caches(options)
+
+
+@cli.command('autotune-compaction')
 @click.option('--cluster-name', type=str, required=True)
-@click.option('--region', type=str)
-def nodes(region: str, cluster_name: str):
-    # TODO: we should extend it to list of regions
-    # TODO: we could derive the regions a cluster is deployed to from SRV DNS record
-    ec2 = ec2_client(region)
-    instances = list_instances(ec2, cluster_name)
-    show_instances(instances)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--odd-host', '-O', type=str, required=True, multiple=True,
+              help='Odd host for each of the regions, in the same order')
+@click.option('--interval', default=60, type=int, help='seconds between control steps, default: 60')
+@click.option('--min-throughput', default=16, type=int, help='in MB/s, default: 16')
+@click.option('--max-throughput', default=256, type=int, help='in MB/s, default: 256')
+@click.option('--min-compactors', default=1, type=int, help='default: 1')
+@click.option('--max-compactors', default=4, type=int, help='default: 4')
+@click.option('--target-pending', default=20, type=int,
+              help='pending compactions per node to aim for, default: 20')
+@click.option('--max-read-latency', default=50.0, type=float,
+              help='read p99 in ms above which compaction is slowed down, default: 50')
+@click.option('--max-disk-util', default=0.8, type=float,
+              help='disk utilization above which compaction is slowed down, default: 0.8')
+@click.option('--kp', default=0.3, type=float, help='proportional gain, default: 0.3')
+@click.option('--ki', default=0.002, type=float, help='integral gain per second, default: 0.002')
+@click.option('--kd', default=10.0, type=float, help='derivative gain in seconds, default: 10')
+@click.option('--decision-log',
+              help='JSON lines file to append every decision to, '
+                   'default: ~/.planb/compaction-decisions.jsonl')
+@click.option('--restore/--no-restore', default=True,
+              help='restore the original settings on exit, default: enabled')
+@click.option('--dry-run', is_flag=True, default=False, help='log the decisions without applying them')
+@click.option('--replay', type=click.Path(exists=True),
+              help='replay a decision log with these settings instead of controlling the cluster')
+def autotune_compaction(cluster_name: str, region: list, odd_host: list, interval: int,
+                        min_throughput: int, max_throughput: int, min_compactors: int, max_compactors: int,
+                        target_pending: int, max_read_latency: float, max_disk_util: float,
+                        kp: float, ki: float, kd: float, decision_log: str, restore: bool,
+                        dry_run: bool, replay: str):
+    if len(odd_host) != len(region):
+        raise click.UsageError('Please specify one --odd-host for every --region')
+
+    if not (0 < min_throughput <= max_throughput and 0 < min_compactors <= max_compactors):
+        raise click.UsageError('Please specify positive bounds with the minimum not above the maximum')
+
+    if target_pending <= 0 or max_read_latency <= 0:
+        raise click.UsageError('Please specify a positive --target-pending and --max-read-latency')
+
+    if not 0 < max_disk_util < 1:
+        raise click.UsageError('Please specify a --max-disk-util between 0 and 1')
+
+    options = dict(locals(), odd_hosts=dict(zip(region, odd_host)))
+    from .compaction_tuner import autotune_compaction as run_autotune_compaction, run_replay
+    if replay:
+        run_replay(replay, options)
+    else:
+        run_autotune_compaction(options)
+
+
+@cli.group()
+def alarms():
+    pass
+
+
+@alarms.command('sync')
+@click.option('--cluster-name', type=str, required=True)
+@click.option('--region', type=str, required=True, multiple=True)
+@click.option('--sns-topic', help=sns_topic_help)
+@click.option('--sns-email', help=sns_email_help)
+@click.option('--dry-run', is_flag=True, default=False, help='only show the alarms to put and delete')
+def sync_alarms(cluster_name: str, region: list, sns_topic: str, sns_email: str, dry_run: bool):
+    options = dict(locals(), regions=list(region))
+    from .alarms import run_sync_alarms
+    run_sync_alarms(options)
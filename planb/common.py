@@ -1,12 +1,22 @@
 import boto3
 import botocore
+import functools
+import base64
+import gzip
 import yaml
 import json
 import copy
 import time
+import io
 import os
 from datetime import datetime
 
+from .inventory import iter_instances
+
+# Taupage mounts the data volume here on the host, the container sees it
+# as /var/lib/cassandra
+host_data_mount_point = '/mounts/var/lib/cassandra'
+
 
 def ec2_client(region: str) -> object:
     return boto3.client('ec2', region)
@@ -36,16 +46,99 @@ def load_dict_from_file(filename: str) -> dict:
             return json.load(f)
 
 
-def dump_user_data_for_taupage(user_data: dict) -> str:
-    return '#taupage-ami-config\n{}'.format(yaml.safe_dump(user_data))
+def dump_user_data_for_taupage(user_data: dict, gzipped: bool = False):
+    """
+    Returns the user data as text, or as gzip compressed bytes.
+    """
+    text = '#taupage-ami-config\n{}'.format(yaml.safe_dump(user_data))
+    if gzipped:
+        return gzip.compress(text.encode('UTF-8'))
+    return text
+
+
+def is_gzipped(raw: bytes) -> bool:
+    return raw[:2] == b'\x1f\x8b'
+
+
+def decode_user_data(value: str) -> tuple:
+    """
+    Decodes the base64 user data of an instance.  Returns the user data
+    and whether it was gzip compressed.
+    """
+    raw = base64.b64decode(value)
+    gzipped = is_gzipped(raw)
+    if gzipped:
+        raw = gzip.decompress(raw)
+    return yaml.safe_load(io.StringIO(str(raw, 'UTF-8'))), gzipped
+
+
+def template_user_data(user_data: dict) -> dict:
+    """
+    Returns the user data of a node to launch another node with.  The
+    address a replacement node took over only applies to that node: any
+    other empty node started with it would try to replace a live node.
+    """
+    if 'REPLACE_ADDRESS' not in user_data.get('environment', {}):
+        return user_data
+    environment = dict(user_data['environment'])
+    del environment['REPLACE_ADDRESS']
+    return dict(user_data, environment=environment)
+
+
+def secret_parameter_name(cluster_name: str, name: str) -> str:
+    return '/planb/{}/{}'.format(cluster_name, name.lower())
+
+
+def store_secret_parameters(regions: list, cluster_name: str, secrets: dict) -> dict:
+    """
+    Stores the secrets once per cluster as SecureString parameters in SSM
+    Parameter Store of every region, as parameters are regional.  Returns
+    the environment variables referencing them, e.g. KEYSTORE_PARAMETER.
+    """
+    environment = {}
+    for name, value in sorted(secrets.items()):
+        parameter = secret_parameter_name(cluster_name, name)
+        for region in regions:
+            boto3.client('ssm', region).put_parameter(
+                Name=parameter,
+                Value=value,
+                Type='SecureString',
+                Overwrite=True,
+                # keystores may exceed the 4 KB of the standard tier
+                Tier='Intelligent-Tiering'
+            )
+        environment['{}_PARAMETER'.format(name)] = parameter
+    return environment
+
+
+def delete_secret_parameters(regions: list, cluster_name: str, names: list):
+    for region in regions:
+        ssm = boto3.client('ssm', region)
+        ssm.delete_parameters(Names=[secret_parameter_name(cluster_name, n) for n in names])
+
+
+def ensure_secrets_policy(cluster_name: str):
+    """
+    Allows the nodes to read the secret parameters of their cluster.  The
+    role may predate the parameters, so the policy is put every time.
+    """
+    iam = boto3.client('iam')
+    iam.put_role_policy(
+        RoleName='role-{}'.format(cluster_name),
+        PolicyName='policy-{}-secrets'.format(cluster_name),
+        PolicyDocument=json.dumps({
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Action': ['ssm:GetParameter'],
+                'Resource': 'arn:aws:ssm:*:*:parameter{}'.format(secret_parameter_name(cluster_name, '*'))
+            }]
+        })
+    )
 
 
 def list_instances(ec2: object, cluster_name: str):
-    resp = ec2.describe_instances(Filters=[{
-            'Name': 'tag:Name',
-            'Values': [cluster_name]
-        }])
-    return sum([r['Instances'] for r in resp['Reservations']], [])
+    return list(iter_instances(ec2, cluster_name))
 
 
 def override_ephemeral_block_devices(mappings: dict) -> dict:
@@ -81,7 +174,11 @@ def override_ephemeral_block_devices(mappings: dict) -> dict:
     return block_devices
 
 
-def setup_sns_topics_for_alarm(regions: list, topic_name: str, email: str) -> list:
+def setup_sns_topics_for_alarm(regions: list, topic_name: str, email: str, undo: object = None) -> list:
+    '''
+    The topics are shared by clusters and are never undone, only the
+    subscriptions made here.
+    '''
     if not(topic_name):
         topic_name = 'planb-cassandra-system-event'
 
@@ -91,25 +188,52 @@ def setup_sns_topics_for_alarm(regions: list, topic_name: str, email: str) -> li
         resp = sns.create_topic(Name=topic_name)
         topic_arn = resp['TopicArn']
         if email:
-            sns.subscribe(TopicArn=topic_arn, Protocol='email', Endpoint=email)
+            subscriptions = sns.list_subscriptions_by_topic(TopicArn=topic_arn)['Subscriptions']
+            if not any(s['Endpoint'] == email for s in subscriptions):
+                resp = sns.subscribe(TopicArn=topic_arn, Protocol='email', Endpoint=email,
+                                     ReturnSubscriptionArn=True)
+                if undo:
+                    undo.push('subscription', region, 'subscription of {}'.format(email),
+                              unsubscribe, region, resp['SubscriptionArn'])
         result[region] = topic_arn
     return result
 
 
-def create_auto_recovery_alarm(region: str, cluster_name: str,
-                               instance_id: str, alarm_sns_topic_arn: str):
+def unsubscribe(region: str, subscription_arn: str):
+    sns = boto3.client('sns', region_name=region)
+    sns.unsubscribe(SubscriptionArn=subscription_arn)
+
+
+def make_auto_recovery_alarm_name(cluster_name: str, instance_id: str) -> str:
+    return '{}-{}-auto-recover'.format(cluster_name, instance_id)
+
+
+@functools.lru_cache()
+def autorecovery_client(region: str) -> object:
+    """
+    CloudWatch client of the planb_autorecovery profile, shared by all
+    alarms of a region.
+    """
     session = boto3.Session(profile_name='planb_autorecovery')
-    cw = session.client('cloudwatch', region_name=region)
+    return session.client('cloudwatch', region_name=region)
 
-    alarm_name = '{}-{}-auto-recover'.format(cluster_name, instance_id)
 
+def make_auto_recovery_alarm_actions(region: str, alarm_sns_topic_arn: str) -> list:
     alarm_actions = ['arn:aws:automate:{}:ec2:recover'.format(region)]
     if alarm_sns_topic_arn:
         alarm_actions.append(alarm_sns_topic_arn)
+    return alarm_actions
+
+
+def create_auto_recovery_alarm(region: str, cluster_name: str,
+                               instance_id: str, alarm_sns_topic_arn: str):
+    cw = autorecovery_client(region)
+
+    alarm_name = make_auto_recovery_alarm_name(cluster_name, instance_id)
 
     cw.put_metric_alarm(
         AlarmName=alarm_name,
-        AlarmActions=alarm_actions,
+        AlarmActions=make_auto_recovery_alarm_actions(region, alarm_sns_topic_arn),
         MetricName='StatusCheckFailed_System',
         Namespace='AWS/EC2',
         Statistic='Minimum',
@@ -199,8 +323,23 @@ def create_instance_profile(cluster_name: str):
     return profile['InstanceProfile']
 
 
-def ensure_instance_profile(cluster_name: str):
+def delete_instance_profile(cluster_name: str):
+    profile_name = make_instance_profile_name(cluster_name)
+    role_name = 'role-{}'.format(cluster_name)
+
+    iam = boto3.client('iam')
+    iam.remove_role_from_instance_profile(InstanceProfileName=profile_name, RoleName=role_name)
+    for policy_name in iam.list_role_policies(RoleName=role_name)['PolicyNames']:
+        iam.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
+    iam.delete_role(RoleName=role_name)
+    iam.delete_instance_profile(InstanceProfileName=profile_name)
+
+
+def ensure_instance_profile(cluster_name: str, undo: object = None):
     profile = get_instance_profile(cluster_name)
     if profile is None:
         profile = create_instance_profile(cluster_name)
+        if undo:
+            undo.push('instance_profile', 'global', 'instance profile {}'.format(profile['InstanceProfileName']),
+                      delete_instance_profile, cluster_name)
     return profile
@@ -0,0 +1,323 @@
+"""
+Closed-loop control of the compaction throughput of every node.
+
+Every interval the pending compactions, the client request latencies and
+the throttle are read from the Jolokia agent of every node, and the
+utilization of its data disk from /proc/diskstats.  A PID controller per
+node turns them into a new compaction throughput between the configured
+bounds, and the number of concurrent compactors follows the throughput.
+
+Every decision is appended to a JSON lines log together with its inputs,
+so that the policy can be replayed offline with other parameters.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import collections
+import subprocess
+import logging
+import shlex
+import json
+import time
+import os
+
+from clickclick import print_table
+
+from . import jolokia
+from .common import host_data_mount_point
+from .inventory import stream_instances
+
+
+logger = logging.getLogger(__name__)
+
+storage_service_mbean = 'org.apache.cassandra.db:type=StorageService'
+compaction_manager_mbean = 'org.apache.cassandra.db:type=CompactionManager'
+latency_mbean = 'org.apache.cassandra.metrics:type=ClientRequest,scope={},name=Latency'
+
+node_queries = [
+    {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=PendingTasks',
+     'attribute': 'Value'},
+    {'type': 'read', 'mbean': latency_mbean.format('Read'), 'attribute': '99thPercentile'},
+    {'type': 'read', 'mbean': latency_mbean.format('Write'), 'attribute': '99thPercentile'},
+    {'type': 'read', 'mbean': storage_service_mbean, 'attribute': 'CompactionThroughputMbPerSec'},
+    {'type': 'read', 'mbean': compaction_manager_mbean,
+     'attribute': ['CoreCompactorThreads', 'MaximumCompactorThreads']},
+]
+
+# prints the milliseconds spent doing I/O on the device of the data volume
+io_ticks_script = '''\
+dev=$(basename $(findmnt -n -o SOURCE {mount}))
+awk -v dev=$dev '$3 == dev {{print $13}}' /proc/diskstats'''.format(mount=host_data_mount_point)
+
+default_decision_log = os.path.expanduser('~/.planb/compaction-decisions.jsonl')
+
+# the normalized error terms are capped, so that one signal running away
+# cannot saturate the controller for long
+max_error_term = 3.0
+
+Sample = collections.namedtuple(
+    'Sample', ['time', 'pending', 'read_p99', 'write_p99', 'disk_util']
+)
+
+
+class PidController:
+    """
+    Positional PID controller around a bias.  The output is scaled to the
+    range between the bounds, and the integral is frozen while the output
+    is saturated (anti-windup).
+    """
+
+    def __init__(self, kp: float, ki: float, kd: float, bias: float,
+                 output_min: float, output_max: float):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.bias = bias
+        self.output_min = output_min
+        self.output_max = output_max
+        self.integral = 0.0
+        self.prev_error = None
+
+    def update(self, error: float, dt: float) -> tuple:
+        """
+        Returns the new output and the P, I and D terms.
+        """
+        derivative = (error - self.prev_error) / dt if self.prev_error is not None and dt > 0 else 0.0
+        self.prev_error = error
+        integral = self.integral + error * dt
+        span = self.output_max - self.output_min
+        terms = (self.kp * error, self.ki * integral, self.kd * derivative)
+        raw = self.bias + span * sum(terms)
+        output = min(max(raw, self.output_min), self.output_max)
+        if output == raw:
+            self.integral = integral
+        return output, terms
+
+
+def clip(value: float) -> float:
+    return min(max(value, -max_error_term), max_error_term)
+
+
+def control_error(sample: Sample, options: dict) -> dict:
+    """
+    Positive errors ask for more compaction: a growing backlog.  Negative
+    ones for less: a saturated disk or slow reads.  Unknown inputs do not
+    contribute.
+    """
+    terms = {'backlog': 0.0, 'disk': 0.0, 'latency': 0.0}
+    if sample.pending is not None:
+        terms['backlog'] = clip((sample.pending - options['target_pending']) / options['target_pending'])
+    if sample.disk_util is not None:
+        terms['disk'] = -clip(max(sample.disk_util - options['max_disk_util'], 0) /
+                              (1 - options['max_disk_util']))
+    if sample.read_p99 is not None:
+        terms['latency'] = -clip(max(sample.read_p99 - options['max_read_latency'], 0) /
+                                 options['max_read_latency'])
+    terms['error'] = sum(terms.values())
+    return terms
+
+
+def compactors_for(throughput: float, options: dict) -> int:
+    """
+    Concurrent compactors grow linearly with the throughput.
+    """
+    low, high = options['min_throughput'], options['max_throughput']
+    share = (throughput - low) / (high - low) if high > low else 1
+    return options['min_compactors'] + int(round(share * (options['max_compactors'] - options['min_compactors'])))
+
+
+def make_controller(throughput: float, options: dict) -> PidController:
+    bias = min(max(throughput, options['min_throughput']), options['max_throughput'])
+    return PidController(options['kp'], options['ki'], options['kd'], bias,
+                         options['min_throughput'], options['max_throughput'])
+
+
+def decide(controller: PidController, sample: Sample, prev_time: float, options: dict) -> dict:
+    terms = control_error(sample, options)
+    output, (p, i, d) = controller.update(terms['error'], sample.time - prev_time)
+    throughput = int(round(output))
+    return dict(terms, p=p, i=i, d=d, throughput=throughput,
+                compactors=compactors_for(throughput, options))
+
+
+def parse_io_ticks(output: bytes) -> int:
+    return int(output.decode().strip())
+
+
+def read_io_ticks(odd_host: str, ip: str) -> int:
+    cmd = ['ssh', odd_host, 'ssh', ip, shlex.quote(io_ticks_script)]
+    try:
+        return parse_io_ticks(subprocess.check_output(cmd, timeout=30))
+    except Exception as e:
+        logger.warning("Cannot read the disk stats of {}, disk utilization is not used: {}".format(ip, e))
+        return None
+
+
+def disk_utilization(prev: tuple, cur: tuple) -> float:
+    """
+    Share of the time the disk was busy between two (time, io_ticks).
+    """
+    if not prev or prev[1] is None or cur[1] is None or cur[0] <= prev[0]:
+        return None
+    return min(max((cur[1] - prev[1]) / 1000 / (cur[0] - prev[0]), 0), 1)
+
+
+def set_throughput(url: str, throughput: int, core: int, maximum: int, current_core: int) -> bool:
+    """
+    The core number of threads must never exceed the maximum, so the order
+    of the writes depends on the direction of the change.
+    """
+    threads = [
+        {'type': 'write', 'mbean': compaction_manager_mbean,
+         'attribute': 'MaximumCompactorThreads', 'value': maximum},
+        {'type': 'write', 'mbean': compaction_manager_mbean,
+         'attribute': 'CoreCompactorThreads', 'value': core},
+    ]
+    if current_core is not None and core < current_core:
+        threads.reverse()
+    queries = [{'type': 'write', 'mbean': storage_service_mbean,
+                'attribute': 'CompactionThroughputMbPerSec', 'value': throughput}] + threads
+    result = jolokia.query(url, queries)
+    return bool(result) and None not in result
+
+
+def log_decision(path: str, record: dict):
+    with open(path, 'a') as fd:
+        fd.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class NodeTuner:
+    """
+    Controller state of one node, and its throttle as found at the start.
+    """
+
+    def __init__(self, region: str, ip: str, url: str, odd_host: str):
+        self.region = region
+        self.ip = ip
+        self.url = url
+        self.odd_host = odd_host
+        self.controller = None
+        self.original = None
+        self.io_ticks = None
+        self.prev_time = None
+        self.core_threads = None
+
+    def sample(self, options: dict) -> tuple:
+        """
+        Returns the sample and the current threads settings, or None if the
+        node cannot be read.
+        """
+        values = jolokia.query(self.url, node_queries)
+        now = time.time()
+        io_ticks = (now, read_io_ticks(self.odd_host, self.ip))
+        disk_util = disk_utilization(self.io_ticks, io_ticks)
+        self.io_ticks = io_ticks
+        if not values or values[3] is None:
+            return None
+        pending, read_p99, write_p99, throughput, threads = values
+        if self.controller is None:
+            self.original = {'throughput': throughput, 'threads': threads}
+            self.controller = make_controller(throughput, options)
+        sample = Sample(
+            time=now, pending=pending,
+            read_p99=read_p99 / 1000 if read_p99 is not None else None,
+            write_p99=write_p99 / 1000 if write_p99 is not None else None,
+            disk_util=disk_util
+        )
+        return sample, {'throughput': throughput, 'threads': threads}
+
+    def step(self, options: dict) -> dict:
+        sampled = self.sample(options)
+        if not sampled:
+            logger.warning("Cannot read {}, leaving it alone".format(self.ip))
+            return None
+        sample, current = sampled
+        if current['threads']:
+            self.core_threads = current['threads']['CoreCompactorThreads']
+        if self.prev_time is None:
+            self.prev_time = sample.time
+            return None
+        decision = decide(self.controller, sample, self.prev_time, options)
+        self.prev_time = sample.time
+        compactors = decision['compactors']
+        applied = not options['dry_run'] and set_throughput(
+            self.url, decision['throughput'], compactors, compactors, self.core_threads
+        )
+        if applied:
+            self.core_threads = compactors
+        record = dict(decision, region=self.region, ip=self.ip,
+                      previous_throughput=current['throughput'], applied=applied)
+        record.update(sample._asdict())
+        return record
+
+    def restore(self):
+        if self.original and self.original['threads']:
+            threads = self.original['threads']
+            set_throughput(self.url, self.original['throughput'], threads['CoreCompactorThreads'],
+                           threads['MaximumCompactorThreads'], self.core_threads)
+
+
+def autotune_compaction(options: dict):
+    region_instances = collections.defaultdict(list)
+    for region, i in stream_instances(options['cluster_name'], list(options['odd_hosts']), ['running']):
+        region_instances[region].append(i)
+
+    decision_log = options['decision_log'] or default_decision_log
+    os.makedirs(os.path.dirname(decision_log) or '.', exist_ok=True)
+    with ExitStack() as stack:
+        tuners = []
+        for region, instances in region_instances.items():
+            odd_host = options['odd_hosts'][region]
+            urls = stack.enter_context(jolokia.tunnels(odd_host, instances))
+            tuners.extend(NodeTuner(region, ip, url, odd_host) for ip, url in sorted(urls.items()))
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(tuners), 1)) as executor:
+                while True:
+                    started = time.time()
+                    for record in executor.map(lambda t: t.step(options), tuners):
+                        if record:
+                            log_decision(decision_log, record)
+                            logger.info("{ip}: pending {pending}, read p99 {read_p99}, disk {disk_util} "
+                                        "-> {throughput} MB/s, {compactors} compactors".format(**record))
+                    time.sleep(max(options['interval'] - (time.time() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if options['restore'] and not options['dry_run']:
+                for t in tuners:
+                    t.restore()
+
+
+def replay_decisions(path: str, options: dict) -> list:
+    """
+    Runs the controller with the given options over the inputs of a
+    decision log.  Returns (logged, replayed) decision pairs.
+    """
+    controllers = {}
+    prev_times = {}
+    result = []
+    with open(path) as fd:
+        for line in fd:
+            logged = json.loads(line)
+            sample = Sample(**{f: logged[f] for f in Sample._fields})
+            ip = logged['ip']
+            if ip not in controllers:
+                controllers[ip] = make_controller(logged['previous_throughput'], options)
+                prev_times[ip] = sample.time - options['interval']
+            replayed = decide(controllers[ip], sample, prev_times[ip], options)
+            prev_times[ip] = sample.time
+            result.append((logged, replayed))
+    return result
+
+
+def run_replay(path: str, options: dict):
+    rows = [{
+        'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(logged['time'])),
+        'ip': logged['ip'],
+        'pending': logged['pending'],
+        'logged': logged['throughput'],
+        'replayed': replayed['throughput'],
+        'compactors': replayed['compactors'],
+    } for logged, replayed in replay_decisions(path, options)]
+    print_table(['time', 'ip', 'pending', 'logged', 'replayed', 'compactors'], rows,
+                titles={'logged': 'Logged MB/s', 'replayed': 'Replayed MB/s'})
@@ -21,11 +21,31 @@ from clickclick import Action, info
 
 from .common import override_ephemeral_block_devices, \
     dump_user_data_for_taupage, setup_sns_topics_for_alarm, \
-    create_auto_recovery_alarm, ensure_instance_profile
+    ensure_instance_profile, store_secret_parameters, \
+    delete_secret_parameters, ensure_secrets_policy
+from .alarms import sync_cluster_alarms, delete_cluster_alarms
+from .preflight import run_preflight
+from .undo import UndoStack
+
+
+def make_public_ip_ingress_rules(ips: list) -> list:
+    return [{
+        'IpProtocol': 'tcp',
+        'FromPort': 7001,  # port range: From-To
+        'ToPort':   7001,
+        'IpRanges': [{
+            'CidrIp': '{}/32'.format(ip['PublicIp'])
+        }]
+    } for ip in ips]
+
+
+def delete_security_group(region: str, group_id: str):
+    ec2 = boto3.client('ec2', region)
+    ec2.delete_security_group(GroupId=group_id)
 
 
 def setup_security_groups(use_dmz: bool, cluster_name: str, node_ips: dict,
-                          result: dict) -> dict:
+                          result: dict, undo: object = None) -> dict:
     '''
     Allow traffic between regions (or within a VPC, if `use_dmz' is False)
     '''
@@ -43,6 +63,9 @@ def setup_security_groups(use_dmz: bool, cluster_name: str, node_ips: dict,
                 Description=description
             )
             result[region] = sg
+            if undo:
+                undo.push('security_group', region, 'security group {}'.format(sg['GroupId']),
+                          delete_security_group, region, sg['GroupId'])
 
             ec2.create_tags(
                 Resources=[sg['GroupId']],
@@ -51,16 +74,9 @@ def setup_security_groups(use_dmz: bool, cluster_name: str, node_ips: dict,
             ip_permissions = []
             if use_dmz:
                 # NOTE: we need to allow ALL public IPs (from all regions)
-                for ip in itertools.chain(*node_ips.values()):
-                    ingress_rule = {
-                        'IpProtocol': 'tcp',
-                        'FromPort': 7001,  # port range: From-To
-                        'ToPort':   7001,
-                        'IpRanges': [{
-                            'CidrIp': '{}/32'.format(ip['PublicIp'])
-                        }]
-                    }
-                    ip_permissions.append(ingress_rule)
+                ip_permissions.extend(
+                    make_public_ip_ingress_rules(itertools.chain(*node_ips.values()))
+                )
             # if internal subnets are used we just allow access from
             # within the SG, which we also need in multi-region setup
             # (for the nodetool?)
@@ -235,9 +251,14 @@ def generate_private_ip_addresses(ec2: object, subnets: list, cluster_size: int)
             yield ip
 
 
+def release_address(region: str, allocation_id: str):
+    ec2 = boto3.client('ec2', region_name=region)
+    ec2.release_address(AllocationId=allocation_id)
+
+
 def allocate_ip_addresses(
         region_subnets: dict, cluster_size: int,
-        node_ips: dict, take_elastic_ips: bool):
+        node_ips: dict, take_elastic_ips: bool, undo: object = None):
     '''
     Allocate unused private IP addresses by checking the current
     reservations, and optionally allocate Elastic IPs.
@@ -254,6 +275,9 @@ def allocate_ip_addresses(
                     address['_defaultIp'] = resp['PublicIp']
                     address['PublicIp'] = resp['PublicIp']
                     address['AllocationId'] = resp['AllocationId']
+                    if undo:
+                        undo.push('address', region, 'IP address {}'.format(resp['PublicIp']),
+                                  release_address, region, resp['AllocationId'])
                 else:
                     address['_defaultIp'] = ip
 
@@ -305,7 +329,15 @@ def make_dns_records(region: str, ips: list) -> list:
     return [{'Value': '1 1 9042 {}'.format(host)} for host in hosts]
 
 
-def setup_dns_records(cluster_name: str, hosted_zone: str, node_ips: dict):
+def delete_dns_records(zone_id: str, record_set: dict):
+    r53 = boto3.client('route53')
+    r53.change_resource_record_sets(
+        HostedZoneId=zone_id,
+        ChangeBatch={'Changes': [{'Action': 'DELETE', 'ResourceRecordSet': record_set}]}
+    )
+
+
+def setup_dns_records(cluster_name: str, hosted_zone: str, node_ips: dict, undo: object = None):
     r53 = boto3.client('route53')
 
     zone = None
@@ -328,21 +360,71 @@ def setup_dns_records(cluster_name: str, hosted_zone: str, node_ips: dict):
             # lookup and won't recognize them as such.
             #
             records = make_dns_records(region, ips)
+            record_set = {
+                'Name': name,
+                'Type': 'SRV',
+                'TTL': 60,
+                'ResourceRecords': records
+            }
 
             r53.change_resource_record_sets(
                 HostedZoneId=zone['Id'],
                 ChangeBatch={
                     'Changes': [{
                         'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': name,
-                            'Type': 'SRV',
-                            'TTL': 60,
-                            'ResourceRecords': records
-                        }
+                        'ResourceRecordSet': record_set
                     }]
                 }
             )
+            if undo:
+                undo.push('dns', region, 'SRV records {}'.format(name),
+                          delete_dns_records, zone['Id'], record_set)
+
+
+def dc_name(region: str) -> str:
+    """
+    The EC2 snitches drop the '-1' suffix of the region name.
+    """
+    return re.sub('-1$', '', region)
+
+
+def make_replication_map(region_counts: dict) -> str:
+    dcs = ''.join(
+        ", '{}': {}".format(dc_name(region), count)
+        for region, count in sorted(region_counts.items())
+    )
+    return "{{'class': 'NetworkTopologyStrategy'{}}}".format(dcs)
+
+
+def describe_instance_type(region: str, instance_type: str) -> dict:
+    ec2 = boto3.client('ec2', region)
+    resp = ec2.describe_instance_types(InstanceTypes=[instance_type])
+    return resp['InstanceTypes'][0]
+
+
+def scylla_environment(instance_type: dict) -> dict:
+    """
+    Shard-per-core settings for Scylla.  On larger instances the first core
+    is left to the network interrupts, and some memory is left to the OS
+    and scylla-jmx.
+    """
+    vcpus = instance_type['VCpuInfo']['DefaultVCpus']
+    memory = instance_type['MemoryInfo']['SizeInMiB']
+    first_cpu = 1 if vcpus > 4 else 0
+    reserved = max(1536, int(memory * 0.07))
+    return {
+        'SCYLLA_PRODUCTION': 'true',
+        'SCYLLA_SMP': vcpus - first_cpu,
+        'SCYLLA_CPU_SET': '{}-{}'.format(first_cpu, vcpus - 1),
+        'SCYLLA_MEMORY': '{}M'.format(memory - reserved)
+    }
+
+
+def encode_keystores(options: dict) -> dict:
+    return {
+        'KEYSTORE': str(base64.b64encode(options['keystore']), 'UTF-8'),
+        'TRUSTSTORE': str(base64.b64encode(options['truststore']), 'UTF-8'),
+    }
 
 
 def generate_taupage_user_data(options: dict) -> str:
@@ -350,9 +432,6 @@ def generate_taupage_user_data(options: dict) -> str:
     Generate Taupage user data to start a Cassandra node
     http://docs.stups.io/en/latest/components/taupage.html
     '''
-    keystore_base64 = base64.b64encode(options['keystore'])
-    truststore_base64 = base64.b64encode(options['truststore'])
-
     # seed nodes across all regions
     all_seeds = [
         ip['_defaultIp']
@@ -374,10 +453,11 @@ def generate_taupage_user_data(options: dict) -> str:
             'CLUSTER_SIZE': options['cluster_size'],
             'NUM_TOKENS': options['num_tokens'],
             'REGIONS': ' '.join(options['regions']),
+            'SYSTEM_AUTH_REPLICATION': make_replication_map(
+                {region: options['cluster_size'] for region in options['regions']}
+            ),
             'SUBNET_TYPE': 'dmz' if options['use_dmz'] else 'internal',
             'SEEDS': ','.join(all_seeds),
-            'KEYSTORE': str(keystore_base64, 'UTF-8'),
-            'TRUSTSTORE': str(truststore_base64, 'UTF-8'),
             'ADMIN_PASSWORD': generate_password()
         },
         'volumes': {
@@ -394,6 +474,20 @@ def generate_taupage_user_data(options: dict) -> str:
         'scalyr_account_key': options['scalyr_key']
     }
 
+    if options.get('keystore_parameters'):
+        data['environment'].update(options['keystore_parameters'])
+    else:
+        data['environment'].update(encode_keystores(options))
+
+    if options['engine'] == 'scylla':
+        # Scylla is only supported in internal subnets, without encryption
+        data['ports'] = {'7000': '7000', '9042': '9042'}
+        # iotune requires XFS
+        data['mounts']['/var/lib/cassandra']['filesystem'] = 'xfs'
+        data['environment'].update(scylla_environment(
+            describe_instance_type(options['regions'][0], options['instance_type'])
+        ))
+
     if options['environment']:
         data['environment'].update(options['environment'])
 
@@ -407,8 +501,12 @@ def create_tagged_volume(ec2: object, options: dict, zone: str, name: str):
         "Size": options['volume_size'],
         "Encrypted": False,
     }
-    if options['volume_type'] == 'io1':
+    if options['volume_type'] in ('io1', 'io2'):
+        ebs_data['Iops'] = options['volume_iops']
+    elif options['volume_type'] == 'gp3' and options.get('volume_throughput'):
+        # the performance of the volume of another node, instead of the baseline
         ebs_data['Iops'] = options['volume_iops']
+        ebs_data['Throughput'] = options['volume_throughput']
     vol = ec2.create_volume(**ebs_data)
 
     tags = [
@@ -416,6 +514,24 @@ def create_tagged_volume(ec2: object, options: dict, zone: str, name: str):
         {'Key': 'Taupage:erase-on-boot', 'Value': 'True'}
     ]
     ec2.create_tags(Resources=[vol['VolumeId']], Tags=tags)
+    return vol['VolumeId']
+
+
+def delete_volume(region: str, volume_id: str):
+    '''
+    The volume is attached by the node at boot, and only becomes
+    available once the instance has been terminated.
+    '''
+    ec2 = boto3.client('ec2', region_name=region)
+    ec2.get_waiter('volume_available').wait(VolumeIds=[volume_id])
+    ec2.delete_volume(VolumeId=volume_id)
+
+
+def terminate_instance(region: str, instance_id: str):
+    ec2 = boto3.client('ec2', region_name=region)
+    ec2.modify_instance_attribute(InstanceId=instance_id, DisableApiTermination={'Value': False})
+    ec2.terminate_instances(InstanceIds=[instance_id])
+    ec2.get_waiter('instance_terminated').wait(InstanceIds=[instance_id])
 
 
 def launch_instance(region: str, ip: dict, ami: object, subnet: dict,
@@ -433,17 +549,21 @@ def launch_instance(region: str, ip: dict, ami: object, subnet: dict,
         mappings = ami.block_device_mappings
         block_devices = override_ephemeral_block_devices(mappings)
 
+        undo = options.get('undo')
+
         volume_name = '{}-{}'.format(options['cluster_name'], ip['PrivateIp'])
-        create_tagged_volume(
+        volume_id = create_tagged_volume(
             ec2,
             options,
             subnet['AvailabilityZone'],
             volume_name
         )
+        if undo:
+            undo.push('volume', region, 'volume {}'.format(volume_id), delete_volume, region, volume_id)
 
         user_data = options['user_data']
         user_data['volumes']['ebs']['/dev/xvdf'] = volume_name
-        taupage_user_data = dump_user_data_for_taupage(user_data)
+        taupage_user_data = dump_user_data_for_taupage(user_data, options['gzip_user_data'])
 
         resp = ec2.run_instances(
             ImageId=ami.id,
@@ -460,6 +580,9 @@ def launch_instance(region: str, ip: dict, ami: object, subnet: dict,
         )
         instance = resp['Instances'][0]
         instance_id = instance['InstanceId']
+        if undo:
+            undo.push('instance', region, 'instance {}'.format(instance_id),
+                      terminate_instance, region, instance_id)
 
         ec2.create_tags(
             Resources=[instance_id],
@@ -481,15 +604,6 @@ def launch_instance(region: str, ip: dict, ami: object, subnet: dict,
                 AllocationId=ip['AllocationId']
             )
 
-        alarm_sns_topic_arn = None
-        if options['alarm_topics']:
-            alarm_sns_topic_arn = options['alarm_topics'][region]
-
-        create_auto_recovery_alarm(
-            region, options['cluster_name'],
-            instance_id, alarm_sns_topic_arn
-        )
-
 
 def launch_seed_nodes(options: dict):
     total_seed_count = options['seed_count'] * len(options['regions'])
@@ -560,8 +674,7 @@ You were trying to deploy Plan B Cassandra, but the process has failed :-(
 One of the reasons might be that some of Private IP addresses we were
 going to use to launch the EC2 instances were taken by some other
 instances in the middle of the process.  If that is the case, simply
-retrying the operation might resolve the problem (you still might need
-to clean up after this attempt before retrying).
+retrying the operation might resolve the problem.
 
 Please review the error message to see if that is the case, then
 either correct the error or retry.
@@ -569,12 +682,18 @@ either correct the error or retry.
 ''')
 
 
+default_artifacts = {
+    'cassandra': 'planb-cassandra-3.0',
+    'scylla': 'planb-scylla-1.3'
+}
+
+
 def validate_artifact_version(options: dict) -> dict:
     conflict_options_msg = """Conflicting options: --artifact-name and
 --docker-image cannot be specified at the same time"""
     if not options['docker_image']:
         if not options['artifact_name']:
-            options['artifact_name'] = 'planb-cassandra-3.0'
+            options['artifact_name'] = default_artifacts[options['engine']]
         image_version = get_latest_docker_image_version(options['artifact_name'])
         docker_image = 'registry.opensource.zalan.do/stups/{}:{}' \
                        .format(options['artifact_name'], image_version)
@@ -603,6 +722,9 @@ def create_cluster(options: dict):
     options = validate_artifact_version(options)
     options = read_environment(options)
 
+    if not options['skip_preflight']:
+        run_preflight(options)
+
     keystore, truststore = generate_certificate(options['cluster_name'])
 
     # List of IP addresses by region
@@ -611,6 +733,9 @@ def create_cluster(options: dict):
     # Mapping of region name to the Security Group
     security_groups = {}
 
+    # Compensating actions of every resource created so far
+    undo = UndoStack()
+
     try:
         taupage_amis = find_taupage_amis(options['regions'])
 
@@ -620,14 +745,16 @@ def create_cluster(options: dict):
         )
         allocate_ip_addresses(
             subnets, options['cluster_size'], node_ips,
-            take_elastic_ips=options['use_dmz']
+            take_elastic_ips=options['use_dmz'],
+            undo=undo
         )
 
         if options['sns_topic'] or options['sns_email']:
             alarm_topics = setup_sns_topics_for_alarm(
                 options['regions'],
                 options['sns_topic'],
-                options['sns_email']
+                options['sns_email'],
+                undo=undo
             )
         else:
             alarm_topics = {}
@@ -636,13 +763,15 @@ def create_cluster(options: dict):
             setup_dns_records(
                 options['cluster_name'],
                 options['hosted_zone'],
-                node_ips
+                node_ips,
+                undo=undo
             )
         setup_security_groups(
             options['use_dmz'],
             options['cluster_name'],
             node_ips,
-            security_groups
+            security_groups,
+            undo=undo
         )
         # We should have up to 3 seeds nodes per DC
         seed_count = min(options['cluster_size'], 3)
@@ -655,9 +784,21 @@ def create_cluster(options: dict):
             seed_count=seed_count,
             seed_nodes=seed_nodes
         )
-        user_data = generate_taupage_user_data(options)
 
-        instance_profile = ensure_instance_profile(options['cluster_name'])
+        instance_profile = ensure_instance_profile(options['cluster_name'], undo=undo)
+
+        if not options['inline_keystores']:
+            # stored once for the cluster instead of in the user data of
+            # every node, which is limited to 16 KB
+            ensure_secrets_policy(options['cluster_name'])
+            keystore_parameters = store_secret_parameters(
+                options['regions'], options['cluster_name'], encode_keystores(options)
+            )
+            undo.push('parameter', 'global', 'keystore parameters', delete_secret_parameters,
+                      options['regions'], options['cluster_name'], ['KEYSTORE', 'TRUSTSTORE'])
+            options = dict(options, keystore_parameters=keystore_parameters)
+
+        user_data = generate_taupage_user_data(options)
 
         options = dict(
             options,
@@ -667,33 +808,28 @@ def create_cluster(options: dict):
             subnets=subnets,
             alarm_topics=alarm_topics,
             user_data=user_data,
-            instance_profile=instance_profile
+            instance_profile=instance_profile,
+            undo=undo
         )
         launch_seed_nodes(options)
 
         # TODO: make sure all seed nodes are up
         launch_normal_nodes(options)
 
+        for region in options['regions']:
+            undo.push('alarm', region, 'Auto-Recovery alarms', delete_cluster_alarms,
+                      region, options['cluster_name'])
+        sync_cluster_alarms(options['regions'], options['cluster_name'], alarm_topics)
+
         print_success_message(options)
 
     except:
         print_failure_message()
 
-        #
-        # TODO: in order to break dependencies, delete entities in the
-        # order opposite to the creation.  For that pushing things on
-        # Undo stack sounds like a natural choice.
-        #
-        for region, sg in security_groups.items():
-            ec2 = boto3.client('ec2', region)
-            info('Cleaning up security group: {}'.format(sg['GroupId']))
-            ec2.delete_security_group(GroupId=sg['GroupId'])
-
-        if options['use_dmz']:
-            for region, ips in node_ips.items():
-                ec2 = boto3.client('ec2', region)
-                for ip in ips:
-                    info('Releasing IP address: {}'.format(ip['PublicIp']))
-                    ec2.release_address(AllocationId=ip['AllocationId'])
+        leftovers = undo.unwind()
+        if leftovers:
+            sys.stderr.write('The following resources could not be deleted, please clean them up:\n')
+            for undo_action in leftovers:
+                sys.stderr.write('  {} in {}\n'.format(undo_action.description, undo_action.region))
 
         raise
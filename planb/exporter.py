@@ -0,0 +1,266 @@
+"""
+Prometheus exporter for a Plan B cluster.
+
+Nodes are discovered through the tag-based inventory and their Jolokia
+agents are read in bulk on a fixed schedule, through SSH tunnels kept open
+via the Odd hosts.  Scrapes are served from the last in-memory snapshot and
+never reach out to the cluster.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import logging
+import time
+import re
+
+from . import jolokia
+from .inventory import stream_instances
+
+
+logger = logging.getLogger(__name__)
+
+latency_mbean = 'org.apache.cassandra.metrics:type=ClientRequest,scope={},name=Latency'
+
+
+def client_request_metrics() -> list:
+    result = []
+    for scope in ['Read', 'Write']:
+        for quantile, attribute in [('0.5', '50thPercentile'), ('0.99', '99thPercentile')]:
+            result.append({
+                'name': 'cassandra_client_request_latency_seconds',
+                'type': 'gauge',
+                'help': 'Client request latency',
+                'mbean': latency_mbean.format(scope),
+                'attribute': attribute,
+                'labels': {'scope': scope.lower(), 'quantile': quantile},
+                'scale': 1e-6
+            })
+        result.append({
+            'name': 'cassandra_client_requests_total',
+            'type': 'counter',
+            'help': 'Client requests served',
+            'mbean': latency_mbean.format(scope),
+            'attribute': 'Count',
+            'labels': {'scope': scope.lower()}
+        })
+    return result
+
+
+metrics = [
+    {'name': 'cassandra_load_bytes', 'type': 'gauge',
+     'help': 'Size of the data on disk',
+     'mbean': 'org.apache.cassandra.db:type=StorageService', 'attribute': 'Load'},
+    {'name': 'cassandra_heap_used_bytes', 'type': 'gauge',
+     'help': 'Used JVM heap',
+     'mbean': 'java.lang:type=Memory', 'attribute': 'HeapMemoryUsage', 'path': 'used'},
+    {'name': 'cassandra_heap_max_bytes', 'type': 'gauge',
+     'help': 'Maximum JVM heap',
+     'mbean': 'java.lang:type=Memory', 'attribute': 'HeapMemoryUsage', 'path': 'max'},
+    {'name': 'cassandra_compaction_pending_tasks', 'type': 'gauge',
+     'help': 'Pending compaction tasks',
+     'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=PendingTasks',
+     'attribute': 'Value'},
+    {'name': 'cassandra_compaction_completed_tasks_total', 'type': 'counter',
+     'help': 'Completed compaction tasks',
+     'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=CompletedTasks',
+     'attribute': 'Value'},
+    {'name': 'cassandra_compaction_bytes_total', 'type': 'counter',
+     'help': 'Bytes compacted',
+     'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=BytesCompacted',
+     'attribute': 'Count'},
+    {'name': 'cassandra_dropped_messages_total', 'type': 'counter',
+     'help': 'Dropped messages by verb',
+     'mbean': 'org.apache.cassandra.metrics:type=DroppedMessage,scope=*,name=Dropped',
+     'attribute': 'Count', 'label': 'scope'},
+    {'name': 'cassandra_thread_pool_pending_tasks', 'type': 'gauge',
+     'help': 'Pending tasks by thread pool',
+     'mbean': 'org.apache.cassandra.metrics:type=ThreadPools,path=request,scope=*,name=PendingTasks',
+     'attribute': 'Value', 'label': 'scope'},
+    {'name': 'cassandra_hints_in_progress', 'type': 'gauge',
+     'help': 'Hints being written',
+     'mbean': 'org.apache.cassandra.metrics:type=Storage,name=TotalHintsInProgress',
+     'attribute': 'Count'},
+] + client_request_metrics()
+
+
+def make_queries(metrics: list) -> list:
+    queries = []
+    for m in metrics:
+        q = {'type': 'read', 'mbean': m['mbean'], 'attribute': m['attribute']}
+        if 'path' in m:
+            q['path'] = m['path']
+        queries.append(q)
+    return queries
+
+
+def mbean_key_property(mbean: str, key: str) -> str:
+    match = re.search('[:,]{}=([^,]+)'.format(key), mbean)
+    return match.group(1) if match else ''
+
+
+def metric_samples(metric: dict, value: object) -> list:
+    """
+    Returns a list of (labels, value) pairs for the value read by Jolokia.
+    """
+    if value is None:
+        return []
+    labels = metric.get('labels', {})
+    scale = metric.get('scale', 1)
+    if 'label' in metric:
+        return [
+            (dict(labels, **{metric['label']: mbean_key_property(mbean, metric['label'])}),
+             v[metric['attribute']] * scale)
+            for mbean, v in sorted(value.items())
+        ]
+    return [(labels, value * scale)]
+
+
+def format_labels(labels: dict) -> str:
+    return ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+
+
+def render_metrics(cluster_name: str, node_values: dict) -> str:
+    """
+    Renders Prometheus text format from the values read from every node,
+    given as a dict of lists by (region, ip), with None for unreachable nodes.
+    """
+    lines = ['# HELP cassandra_up Whether the Jolokia agent of the node could be read',
+             '# TYPE cassandra_up gauge']
+    for (region, ip), values in sorted(node_values.items()):
+        labels = {'cluster': cluster_name, 'region': region, 'instance': ip}
+        lines.append('cassandra_up{{{}}} {}'.format(format_labels(labels), int(values is not None)))
+
+    seen = set()
+    for idx, m in enumerate(metrics):
+        if m['name'] not in seen:
+            seen.add(m['name'])
+            lines.append('# HELP {} {}'.format(m['name'], m['help']))
+            lines.append('# TYPE {} {}'.format(m['name'], m['type']))
+        for (region, ip), values in sorted(node_values.items()):
+            if values is None:
+                continue
+            node_labels = {'cluster': cluster_name, 'region': region, 'instance': ip}
+            for labels, value in metric_samples(m, values[idx]):
+                lines.append('{}{{{}}} {}'.format(
+                    m['name'], format_labels(dict(node_labels, **labels)), value
+                ))
+    return '\n'.join(lines) + '\n'
+
+
+class Collector:
+    """
+    Keeps an SSH tunnel open to every node of the cluster and periodically
+    replaces the snapshot with freshly collected metrics.
+    """
+
+    def __init__(self, cluster_name: str, odd_hosts: dict, interval: int,
+                 discovery_interval: int):
+        self.cluster_name = cluster_name
+        self.odd_hosts = odd_hosts
+        self.interval = interval
+        self.discovery_interval = discovery_interval
+        self.queries = make_queries(metrics)
+        self.tunnels = {}
+        self.nodes = []
+        self.last_discovery = 0
+        self.snapshot = render_metrics(cluster_name, {})
+
+    def discover(self):
+        """
+        Opens tunnels to new nodes and closes the ones to nodes gone.
+        """
+        nodes = {
+            (region, i['PrivateIpAddress']): i
+            for region, i in stream_instances(self.cluster_name,
+                                              list(self.odd_hosts), ['running'])
+        }
+        for key in list(self.tunnels):
+            ssh, port = self.tunnels[key]
+            if key not in nodes or ssh.poll() is not None:
+                logger.info("Closing tunnel to {} in {}".format(key[1], key[0]))
+                ssh.terminate()
+                del self.tunnels[key]
+
+        for key, instance in nodes.items():
+            if key not in self.tunnels:
+                port = jolokia.find_free_local_port(
+                    exclude=[p for _, p in self.tunnels.values()]
+                )
+                ssh = jolokia.open_ssh_tunnel(self.odd_hosts[key[0]], instance, port)
+                if ssh:
+                    self.tunnels[key] = (ssh, port)
+        self.nodes = list(nodes)
+
+    def collect(self):
+        def read(key):
+            if key not in self.tunnels:
+                return None
+            _, port = self.tunnels[key]
+            return jolokia.query(jolokia.make_jolokia_url(port), self.queries)
+
+        with ThreadPoolExecutor(max_workers=max(len(self.nodes), 1)) as executor:
+            node_values = dict(zip(self.nodes, executor.map(read, self.nodes)))
+        self.snapshot = render_metrics(self.cluster_name, node_values)
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                if started - self.last_discovery >= self.discovery_interval:
+                    self.discover()
+                    self.last_discovery = started
+                self.collect()
+            except Exception as e:
+                logger.error("Failed to collect metrics: {}".format(e))
+            time.sleep(max(self.interval - (time.time() - started), 0))
+
+    def close(self):
+        for ssh, _ in self.tunnels.values():
+            ssh.terminate()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(collector: Collector):
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = collector.snapshot.encode('UTF-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return MetricsHandler
+
+
+def run_exporter(options: dict):
+    collector = Collector(
+        options['cluster_name'],
+        options['odd_hosts'],
+        options['interval'],
+        options['discovery_interval']
+    )
+    thread = threading.Thread(target=collector.run, daemon=True)
+    thread.start()
+
+    server = ThreadingHTTPServer(('', options['port']), make_handler(collector))
+    logger.info("Serving metrics on port {}".format(options['port']))
+    try:
+        server.serve_forever()
+    finally:
+        collector.close()
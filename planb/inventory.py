@@ -0,0 +1,160 @@
+"""
+Discovery of the AWS resources of a cluster: instances, data volumes and
+Elastic IPs, across all the regions the cluster is deployed to.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+import queue
+import re
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+live_instance_states = ['pending', 'running', 'stopping', 'stopped']
+
+
+def iter_instances(ec2: object, cluster_name: str, states: list = None):
+    filters = [{'Name': 'tag:Name', 'Values': [cluster_name]}]
+    if states:
+        filters.append({'Name': 'instance-state-name', 'Values': states})
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters):
+        for r in page['Reservations']:
+            yield from r['Instances']
+
+
+def iter_volumes(ec2: object, cluster_name: str):
+    """
+    Data volumes are named {cluster_name}-{private_ip}.
+    """
+    filters = [{'Name': 'tag:Name', 'Values': ['{}-*'.format(cluster_name)]}]
+    paginator = ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(Filters=filters):
+        yield from page['Volumes']
+
+
+def iter_addresses(ec2: object, instance_ids: list):
+    # DescribeAddresses is not paginated, but can be filtered by instance
+    for chunk in chunks(instance_ids, 200):
+        resp = ec2.describe_addresses(
+            Filters=[{'Name': 'instance-id', 'Values': chunk}]
+        )
+        yield from resp['Addresses']
+
+
+def chunks(items: list, size: int):
+    it = iter(items)
+    chunk = list(itertools.islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(it, size))
+
+
+def regions_from_srv_records(cluster_name: str, hosted_zone: str) -> list:
+    """
+    Regions can be derived from the SRV records set up by create:
+    _{cluster_name}-{region}._tcp.{hosted_zone}
+    """
+    r53 = boto3.client('route53')
+    zones = r53.list_hosted_zones_by_name(DNSName=hosted_zone)['HostedZones']
+    zone = next((z for z in zones if z['Name'] == hosted_zone), None)
+    if not zone:
+        raise Exception('Failed to find Hosted Zone {}'.format(hosted_zone))
+
+    # Route53 sorts the records by their labels in reverse order, so the
+    # records of the cluster do not follow each other, but they all follow
+    # _tcp.{hosted_zone}
+    prefix = '_{}-'.format(cluster_name)
+    suffix = '._tcp.{}'.format(hosted_zone)
+    regions = []
+    paginator = r53.get_paginator('list_resource_record_sets')
+    for page in paginator.paginate(HostedZoneId=zone['Id'],
+                                   StartRecordName=suffix[1:]):
+        for rs in page['ResourceRecordSets']:
+            name = rs['Name']
+            if rs['Type'] == 'SRV' and name.startswith(prefix) and name.endswith(suffix):
+                region = name[len(prefix):-len(suffix)]
+                # the records of clusters whose name starts with this one's
+                if re.match('^[a-z]{2}(-[a-z]+)+-[0-9]+$', region):
+                    regions.append(region)
+    return regions
+
+
+def regions_from_tags(cluster_name: str) -> list:
+    """
+    Looks for instances of the cluster in all known regions at once.
+    """
+    # unlike get_available_regions, only the regions enabled for the account
+    all_regions = [r['RegionName'] for r in boto3.client('ec2').describe_regions()['Regions']]
+
+    def has_instances(region: str) -> bool:
+        ec2 = boto3.client('ec2', region)
+        try:
+            return next(iter_instances(ec2, cluster_name, live_instance_states), None) is not None
+        except ClientError as e:
+            logger.warning("Cannot list the instances in {}: {}".format(region, e))
+            return False
+
+    with ThreadPoolExecutor(max_workers=len(all_regions)) as executor:
+        found = executor.map(has_instances, all_regions)
+    return [r for r, f in zip(all_regions, found) if f]
+
+
+def discover_regions(cluster_name: str, hosted_zone: str = None) -> list:
+    if hosted_zone:
+        return regions_from_srv_records(cluster_name, hosted_zone)
+    return regions_from_tags(cluster_name)
+
+
+def with_elastic_ips(ec2: object, instances):
+    """
+    Adds the ElasticIp of every instance, None if it has none, looking them
+    up for a chunk of instances at a time.
+    """
+    for chunk in chunks(instances, 200):
+        addresses = {a['InstanceId']: a['PublicIp']
+                     for a in iter_addresses(ec2, [i['InstanceId'] for i in chunk])}
+        for i in chunk:
+            yield dict(i, ElasticIp=addresses.get(i['InstanceId']))
+
+
+def stream_instances(cluster_name: str, regions: list,
+                     states: list = live_instance_states,
+                     elastic_ips: bool = False):
+    """
+    Lists instances in all regions concurrently, yielding (region, instance)
+    pairs as soon as they arrive.
+    """
+    results = queue.Queue()
+    done = object()
+
+    def list_region(region: str):
+        try:
+            ec2 = boto3.client('ec2', region)
+            instances = iter_instances(ec2, cluster_name, states)
+            if elastic_ips:
+                instances = with_elastic_ips(ec2, instances)
+            for i in instances:
+                results.put((region, i))
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    with ThreadPoolExecutor(max_workers=max(len(regions), 1)) as executor:
+        for region in regions:
+            executor.submit(list_region, region)
+
+        pending = len(regions)
+        while pending:
+            item = results.get()
+            if item is done:
+                pending -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
@@ -0,0 +1,132 @@
+"""
+Access to the Jolokia agents of the Cassandra nodes through SSH tunnels
+opened via the Odd host.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import subprocess
+import requests
+import logging
+import socket
+import click
+import time
+
+
+logger = logging.getLogger(__name__)
+
+local_jolokia_port = 8778
+remote_jolokia_port = 8778
+
+
+def make_jolokia_url(port: int) -> str:
+    return "http://localhost:{}/jolokia/".format(port)
+
+
+jolokia_url = make_jolokia_url(local_jolokia_port)
+
+
+def query(url: str, queries: list, timeout: int = 10) -> list:
+    """
+    Sends a bulk request to the Jolokia agent.  Returns the list of values,
+    with None in place of failed queries, or None if the agent cannot be
+    reached.
+    """
+    try:
+        response = requests.post(url, json=queries, timeout=timeout).json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.debug("Jolokia request to {} failed: {}".format(url, e))
+        return None
+    return [r.get('value') if r.get('status') == 200 else None
+            for r in response]
+
+
+def ssh_command_works(odd_host: str) -> bool:
+    ssh = subprocess.Popen(
+        ['ssh', odd_host, 'echo', 'test-ssh'],
+        stdout=subprocess.PIPE
+    )
+    try:
+        out, err = ssh.communicate(timeout=5)
+        return out == b'test-ssh\n'
+    except Exception as e:
+        logger.error(
+            "Failed to open SSH connection to the Odd host: {}".format(e)
+        )
+        ssh.kill()
+        ssh.communicate()
+
+
+def find_free_local_port(exclude: list = ()) -> int:
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        if port not in exclude:
+            return port
+
+
+def open_ssh_tunnel(odd_host: str, instance: dict,
+                    local_port: int = local_jolokia_port) -> object:
+
+    if is_local_jolokia_port_open(local_port):
+        click.echo(
+            "Port {} is already in use on localhost!".format(local_port),
+            err=True
+        )
+        return None
+
+    ip_address = instance['PrivateIpAddress']
+    port_forward = "{}:{}:{}".format(
+        local_port, ip_address, remote_jolokia_port
+    )
+    cmd = ["ssh", odd_host, "-L", port_forward, "-N"]
+    logger.info("Opening SSH tunnel: {}".format(" ".join(cmd)))
+    ssh = subprocess.Popen(cmd)
+    retry = 1
+    while not is_local_jolokia_port_open(local_port):
+        if retry > 5:
+            ssh.terminate()
+            return None
+        retry += 1
+        time.sleep(1)
+    return ssh
+
+
+def is_local_jolokia_port_open(port: int = local_jolokia_port) -> bool:
+    """
+    Returns True if the local port is accepting connections.
+    """
+    rcode = subprocess.call(['nc', 'localhost', str(port), '-z'])
+    return rcode == 0
+
+
+@contextmanager
+def tunnels(odd_host: str, instances: list):
+    """
+    Opens an SSH tunnel to the Jolokia agent of every instance, each on its
+    own local port.  Yields a dict of Jolokia URLs by private IP address,
+    leaving out the instances which cannot be reached.
+    """
+    ports = []
+    for i in instances:
+        # make sure every tunnel gets a distinct local port
+        ports.append(find_free_local_port(exclude=ports))
+
+    with ThreadPoolExecutor(max_workers=max(len(instances), 1)) as executor:
+        processes = list(executor.map(
+            lambda i, port: open_ssh_tunnel(odd_host, i, port), instances, ports
+        ))
+    urls = {}
+    try:
+        for i, port, ssh in zip(instances, ports, processes):
+            if ssh:
+                urls[i['PrivateIpAddress']] = make_jolokia_url(port)
+            else:
+                logger.warning(
+                    "Cannot open SSH tunnel to {}".format(i['PrivateIpAddress'])
+                )
+        yield urls
+    finally:
+        for ssh in processes:
+            if ssh:
+                ssh.terminate()
@@ -0,0 +1,289 @@
+"""
+Local journal of the operations in flight.
+
+The state of an operation is stored in the tags of the data volume, that is
+the source of truth.  The journal keeps what cannot be stored in the tags:
+the spec of the instance being replaced and the history of state
+transitions with their timings.  It can hold any number of concurrent
+operations across clusters and regions.
+"""
+from datetime import datetime
+import sqlite3
+import json
+import os
+
+from .common import json_serial
+
+
+default_journal_path = os.environ.get(
+    'PLANB_JOURNAL', os.path.expanduser('~/.planb/journal.sqlite')
+)
+
+schema = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY,
+    cluster_name TEXT NOT NULL,
+    region TEXT NOT NULL,
+    volume_id TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    saved_instance TEXT,
+    state TEXT,
+    started_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS operations_cluster
+    ON operations (cluster_name, region);
+CREATE INDEX IF NOT EXISTS operations_volume
+    ON operations (volume_id);
+CREATE INDEX IF NOT EXISTS operations_state
+    ON operations (state);
+CREATE UNIQUE INDEX IF NOT EXISTS operations_active_volume
+    ON operations (region, volume_id) WHERE finished_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS state_history (
+    operation_id INTEGER NOT NULL REFERENCES operations (id),
+    state TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS state_history_operation
+    ON state_history (operation_id);
+
+CREATE TABLE IF NOT EXISTS repair_ranges (
+    id INTEGER PRIMARY KEY,
+    cluster_name TEXT NOT NULL,
+    keyspace TEXT NOT NULL,
+    start_token TEXT NOT NULL,
+    end_token TEXT NOT NULL,
+    replicas TEXT NOT NULL,
+    state TEXT NOT NULL,
+    coordinator TEXT,
+    command INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at TEXT,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS repair_ranges_keyspace
+    ON repair_ranges (cluster_name, keyspace, state);
+"""
+
+
+def timestamp() -> str:
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def open_journal(path: str = default_journal_path) -> sqlite3.Connection:
+    if path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.executescript(schema)
+    return db
+
+
+def row_as_dict(row: sqlite3.Row) -> dict:
+    d = dict(row)
+    if d.get('saved_instance'):
+        d['saved_instance'] = json.loads(d['saved_instance'])
+    return d
+
+
+def find_operation(db: sqlite3.Connection, region: str, volume_id: str) -> dict:
+    row = db.execute(
+        "SELECT * FROM operations"
+        " WHERE region = ? AND volume_id = ? AND finished_at IS NULL",
+        (region, volume_id)
+    ).fetchone()
+    return row_as_dict(row) if row else None
+
+
+def find_last_operation(db: sqlite3.Connection, region: str,
+                        volume_id: str) -> dict:
+    """
+    Returns the most recent operation on the volume, even if finished.
+    """
+    row = db.execute(
+        "SELECT * FROM operations WHERE region = ? AND volume_id = ?"
+        " ORDER BY id DESC LIMIT 1",
+        (region, volume_id)
+    ).fetchone()
+    return row_as_dict(row) if row else None
+
+
+def start_operation(db: sqlite3.Connection, cluster_name: str, region: str,
+                    volume_id: str, operation: str) -> dict:
+    """
+    Returns the active operation on the volume, starting a new one if needed.
+    """
+    op = find_operation(db, region, volume_id)
+    if op:
+        return op
+    now = timestamp()
+    with db:
+        db.execute(
+            "INSERT INTO operations"
+            " (cluster_name, region, volume_id, operation, started_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (cluster_name, region, volume_id, operation, now, now)
+        )
+    return find_operation(db, region, volume_id)
+
+
+def save_instance(db: sqlite3.Connection, region: str, volume_id: str,
+                  instance: dict):
+    with db:
+        db.execute(
+            "UPDATE operations SET saved_instance = ?, updated_at = ?"
+            " WHERE region = ? AND volume_id = ? AND finished_at IS NULL",
+            (json.dumps(instance, default=json_serial), timestamp(),
+             region, volume_id)
+        )
+
+
+def load_instance(db: sqlite3.Connection, region: str, volume_id: str) -> dict:
+    op = find_operation(db, region, volume_id)
+    if op:
+        return op['saved_instance']
+
+
+def record_state(db: sqlite3.Connection, region: str, volume_id: str,
+                 state: str):
+    """
+    Records a state transition, if the state differs from the last one seen.
+    """
+    op = find_operation(db, region, volume_id)
+    if not op or op['state'] == state:
+        return
+    now = timestamp()
+    with db:
+        db.execute(
+            "UPDATE operations SET state = ?, updated_at = ? WHERE id = ?",
+            (state, now, op['id'])
+        )
+        db.execute(
+            "INSERT INTO state_history (operation_id, state, timestamp)"
+            " VALUES (?, ?, ?)",
+            (op['id'], state, now)
+        )
+
+
+def finish_operation(db: sqlite3.Connection, region: str, volume_id: str):
+    with db:
+        db.execute(
+            "UPDATE operations SET finished_at = ?"
+            " WHERE region = ? AND volume_id = ? AND finished_at IS NULL",
+            (timestamp(), region, volume_id)
+        )
+
+
+def list_active_operations(db: sqlite3.Connection, cluster_name: str,
+                           region: str) -> list:
+    rows = db.execute(
+        "SELECT * FROM operations"
+        " WHERE cluster_name = ? AND region = ? AND finished_at IS NULL"
+        " ORDER BY started_at",
+        (cluster_name, region)
+    )
+    return [row_as_dict(r) for r in rows]
+
+
+def find_instance_by_ip(db: sqlite3.Connection, cluster_name: str,
+                        region: str, private_ip: str) -> dict:
+    """
+    Returns the most recently saved instance with the private IP, if any.
+    """
+    rows = db.execute(
+        "SELECT * FROM operations"
+        " WHERE cluster_name = ? AND region = ? AND saved_instance IS NOT NULL"
+        " ORDER BY id DESC",
+        (cluster_name, region)
+    )
+    for row in rows:
+        instance = row_as_dict(row)['saved_instance']
+        if instance.get('PrivateIpAddress') == private_ip:
+            return instance
+
+
+def state_history(db: sqlite3.Connection, operation_id: int) -> list:
+    rows = db.execute(
+        "SELECT state, timestamp FROM state_history"
+        " WHERE operation_id = ? ORDER BY rowid",
+        (operation_id,)
+    )
+    return [dict(r) for r in rows]
+
+
+def reconcile(db: sqlite3.Connection, ec2: object, cluster_name: str,
+              region: str) -> list:
+    """
+    Brings the journal in line with the volume tags and returns the
+    operations which are still in flight.
+    """
+    result = []
+    for op in list_active_operations(db, cluster_name, region):
+        resp = ec2.describe_volumes(
+            Filters=[{'Name': 'volume-id', 'Values': [op['volume_id']]}]
+        )
+        volumes = resp['Volumes']
+        tags = {}
+        if volumes:
+            tags = {t['Key']: t['Value'] for t in volumes[0].get('Tags', [])}
+        state = tags.get('planb:operation:state')
+        if tags.get('planb:operation') != op['operation'] or not state:
+            finish_operation(db, region, op['volume_id'])
+            continue
+        record_state(db, region, op['volume_id'], state)
+        result.append(dict(op, state=state))
+    return result
+
+
+def save_repair_plan(db: sqlite3.Connection, cluster_name: str, keyspace: str,
+                     subranges: list):
+    """
+    Stores the subranges to repair, as a list of (start, end, replicas).
+    """
+    with db:
+        db.executemany(
+            "INSERT INTO repair_ranges"
+            " (cluster_name, keyspace, start_token, end_token, replicas, state)"
+            " VALUES (?, ?, ?, ?, ?, 'pending')",
+            [(cluster_name, keyspace, str(start), str(end), json.dumps(replicas))
+             for start, end, replicas in subranges]
+        )
+
+
+def list_repair_ranges(db: sqlite3.Connection, cluster_name: str,
+                       keyspace: str) -> list:
+    rows = db.execute(
+        "SELECT * FROM repair_ranges WHERE cluster_name = ? AND keyspace = ?"
+        " ORDER BY id",
+        (cluster_name, keyspace)
+    )
+    result = []
+    for r in rows:
+        d = dict(r)
+        d['start_token'] = int(d['start_token'])
+        d['end_token'] = int(d['end_token'])
+        d['replicas'] = json.loads(d['replicas'])
+        result.append(d)
+    return result
+
+
+def update_repair_range(db: sqlite3.Connection, range_id: int, **fields):
+    if fields.get('state') in ('done', 'failed'):
+        fields['finished_at'] = timestamp()
+    with db:
+        db.execute(
+            "UPDATE repair_ranges SET {} WHERE id = ?".format(
+                ", ".join("{} = ?".format(k) for k in fields)
+            ),
+            list(fields.values()) + [range_id]
+        )
+
+
+def delete_repair_plan(db: sqlite3.Connection, cluster_name: str, keyspace: str):
+    with db:
+        db.execute(
+            "DELETE FROM repair_ranges WHERE cluster_name = ? AND keyspace = ?",
+            (cluster_name, keyspace)
+        )
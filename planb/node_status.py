@@ -0,0 +1,129 @@
+"""
+Live health and load information of the cluster nodes, read in bulk from
+their Jolokia agents.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import os
+
+from . import jolokia
+
+
+cache_dir = os.path.expanduser('~/.planb/cache')
+
+storage_service_mbean = 'org.apache.cassandra.db:type=StorageService'
+latency_mbean = 'org.apache.cassandra.metrics:type=ClientRequest,scope={},name=Latency'
+dropped_mbean = 'org.apache.cassandra.metrics:type=DroppedMessage,scope=*,name=Dropped'
+
+status_queries = [
+    {'type': 'read', 'mbean': storage_service_mbean,
+     'attribute': ['Load', 'OperationMode', 'Ownership']},
+    {'type': 'read', 'mbean': 'java.lang:type=Memory',
+     'attribute': 'HeapMemoryUsage'},
+    {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=PendingTasks',
+     'attribute': 'Value'},
+    {'type': 'read', 'mbean': dropped_mbean, 'attribute': 'Count'},
+    {'type': 'read', 'mbean': latency_mbean.format('Read'),
+     'attribute': '99thPercentile'},
+    {'type': 'read', 'mbean': latency_mbean.format('Write'),
+     'attribute': '99thPercentile'}
+]
+
+status_columns = ['region', 'ip', 'mode', 'load', 'owns', 'heap',
+                  'pending', 'dropped', 'read_p99', 'write_p99']
+
+
+def format_bytes(n: float) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if n < 1024:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+    return '{:.1f} TiB'.format(n)
+
+
+def parse_status(ip: str, values: list) -> dict:
+    storage, heap, pending, dropped, read, write = values
+    status = {'ip': ip}
+    if storage:
+        status['mode'] = storage['OperationMode']
+        status['load'] = format_bytes(storage['Load'])
+        ownership = {k.split('/')[-1]: v for k, v in storage['Ownership'].items()}
+        if ip in ownership:
+            status['owns'] = '{:.1f}%'.format(ownership[ip] * 100)
+    if heap:
+        status['heap'] = '{:.0f}%'.format(heap['used'] * 100 / heap['max'])
+    if pending is not None:
+        status['pending'] = pending
+    if dropped:
+        status['dropped'] = sum(v['Count'] for v in dropped.values())
+    if read is not None:
+        status['read_p99'] = '{:.1f} ms'.format(read / 1000)
+    if write is not None:
+        status['write_p99'] = '{:.1f} ms'.format(write / 1000)
+    return status
+
+
+def fetch_node_status(ip: str, url: str) -> dict:
+    values = jolokia.query(url, status_queries)
+    if values is None:
+        return {'ip': ip, 'mode': 'UNREACHABLE'}
+    return parse_status(ip, values)
+
+
+def fetch_region_status(region: str, odd_host: str, instances: list) -> list:
+    with jolokia.tunnels(odd_host, instances) as urls:
+        with ThreadPoolExecutor(max_workers=max(len(instances), 1)) as executor:
+            ips = [i['PrivateIpAddress'] for i in instances]
+            rows = executor.map(
+                lambda ip: fetch_node_status(ip, urls[ip]) if ip in urls
+                else {'ip': ip, 'mode': 'NO TUNNEL'},
+                ips
+            )
+            return [dict(row, region=region) for row in rows]
+
+
+def fetch_cluster_status(odd_hosts: dict, region_instances: dict) -> list:
+    """
+    Fetches the status of all nodes in all regions concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(region_instances), 1)) as executor:
+        futures = [
+            executor.submit(fetch_region_status, region, odd_hosts[region], instances)
+            for region, instances in region_instances.items()
+        ]
+        rows = [row for f in futures for row in f.result()]
+    return sort_rows(rows)
+
+
+def sort_rows(rows: list) -> list:
+    def ip_key(ip: str):
+        return tuple(int(x) for x in ip.split('.'))
+    return sorted(rows, key=lambda r: (r['region'], ip_key(r['ip'])))
+
+
+def cache_filename(cluster_name: str) -> str:
+    return os.path.join(cache_dir, 'status-{}.json'.format(cluster_name))
+
+
+def load_cached_status(cluster_name: str, regions: list, ttl: int) -> list:
+    filename = cache_filename(cluster_name)
+    try:
+        if time.time() - os.path.getmtime(filename) > ttl:
+            return None
+        with open(filename, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if sorted(cached['regions']) != sorted(regions):
+        return None
+    return cached['rows']
+
+
+def save_cached_status(cluster_name: str, regions: list, rows: list):
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = cache_filename(cluster_name)
+    tmp = '{}.tmp'.format(filename)
+    with open(tmp, 'w') as f:
+        json.dump({'regions': regions, 'rows': rows}, f)
+    os.replace(tmp, filename)
@@ -0,0 +1,204 @@
+"""
+Pre-flight checks of create: everything the cluster is going to need is
+checked in all regions at once, before any resource is created, so that a
+missing quota fails the command in seconds instead of halfway through.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import re
+
+import boto3
+from botocore.exceptions import ClientError
+from clickclick import Action, print_table
+
+
+OK = 'OK'
+FAILED = 'FAILED'
+UNKNOWN = 'UNKNOWN'
+
+Check = collections.namedtuple('Check', ['region', 'name', 'status', 'detail'])
+
+# generate_private_ip_addresses skips the first addresses of every subnet
+skipped_addresses = 10
+
+# quota codes of the running On-Demand instances by instance family, all
+# other families count against the standard one
+vcpu_quota_codes = collections.OrderedDict([
+    ('inf', 'L-1945791B'),
+    ('vt', 'L-DB2E81BA'),
+    ('f', 'L-74FC7D96'),
+    ('g', 'L-DB2E81BA'),
+    ('p', 'L-417A185B'),
+    ('x', 'L-7295265B'),
+])
+standard_vcpu_quota_code = 'L-1216C47A'
+
+rules_per_security_group_quota_code = 'L-0EA8095F'
+default_rules_per_security_group = 60
+
+
+def vcpu_quota_code(instance_type: str) -> str:
+    family = re.match('[a-z]+', instance_type).group(0)
+    for prefix, code in vcpu_quota_codes.items():
+        if family.startswith(prefix):
+            return code
+    return standard_vcpu_quota_code
+
+
+def nodes_per_subnet(cluster_size: int, subnet_count: int) -> list:
+    """
+    Nodes are spread over the subnets round robin.
+    """
+    return [len(range(i, cluster_size, subnet_count)) for i in range(subnet_count)]
+
+
+def find_subnets(ec2: object, prefix_filter: str) -> list:
+    resp = ec2.describe_subnets(Filters=[{'Name': 'tag:Name', 'Values': [prefix_filter + '*']}])
+    return sorted(resp['Subnets'], key=lambda subnet: subnet['AvailabilityZone'])
+
+
+def check_account(ec2: object) -> tuple:
+    resp = ec2.describe_account_attributes(AttributeNames=['supported-platforms'])
+    platforms = [v['AttributeValue'] for a in resp['AccountAttributes'] for v in a['AttributeValues']]
+    if 'VPC' not in platforms:
+        return FAILED, 'VPC is not supported, only {}'.format(', '.join(platforms))
+    if not ec2.describe_vpcs()['Vpcs']:
+        return FAILED, 'no VPC'
+    return OK, ''
+
+
+def check_subnets(subnets: list, cluster_size: int) -> tuple:
+    if not subnets:
+        return FAILED, 'no subnets found'
+    short = [
+        '{} has {} free IPs, {} needed'.format(s['SubnetId'], s['AvailableIpAddressCount'], nodes)
+        for s, nodes in zip(subnets, nodes_per_subnet(cluster_size, len(subnets)))
+        if s['AvailableIpAddressCount'] - skipped_addresses < nodes
+    ]
+    if short:
+        return FAILED, '; '.join(short)
+    return OK, '{} free IPs in {} subnets'.format(sum(s['AvailableIpAddressCount'] for s in subnets), len(subnets))
+
+
+def check_instance_type(ec2: object, instance_type: str, subnets: list) -> tuple:
+    try:
+        ec2.describe_instance_types(InstanceTypes=[instance_type])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidInstanceType':
+            return FAILED, 'unknown instance type {}'.format(instance_type)
+        raise
+    resp = ec2.describe_instance_type_offerings(
+        LocationType='availability-zone',
+        Filters=[{'Name': 'instance-type', 'Values': [instance_type]}]
+    )
+    offered = {o['Location'] for o in resp['InstanceTypeOfferings']}
+    missing = sorted({s['AvailabilityZone'] for s in subnets} - offered)
+    if missing:
+        return FAILED, '{} is not offered in {}'.format(instance_type, ', '.join(missing))
+    return OK, ''
+
+
+def running_vcpus(ec2: object, quota_code: str) -> int:
+    paginator = ec2.get_paginator('describe_instances')
+    filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running']}]
+    return sum(
+        i['CpuOptions']['CoreCount'] * i['CpuOptions']['ThreadsPerCore']
+        for page in paginator.paginate(Filters=filters)
+        for r in page['Reservations']
+        for i in r['Instances']
+        if vcpu_quota_code(i['InstanceType']) == quota_code
+    )
+
+
+def check_vcpus(ec2: object, quotas: object, instance_type: str, cluster_size: int) -> tuple:
+    code = vcpu_quota_code(instance_type)
+    resp = ec2.describe_instance_types(InstanceTypes=[instance_type])
+    needed = resp['InstanceTypes'][0]['VCpuInfo']['DefaultVCpus'] * cluster_size
+    limit = int(quotas.get_service_quota(ServiceCode='ec2', QuotaCode=code)['Quota']['Value'])
+    used = running_vcpus(ec2, code)
+    detail = '{} of {} vCPUs used, {} needed'.format(used, limit, needed)
+    return (OK if used + needed <= limit else FAILED), detail
+
+
+def check_elastic_ips(ec2: object, cluster_size: int) -> tuple:
+    resp = ec2.describe_account_attributes(AttributeNames=['vpc-max-elastic-ips'])
+    limit = int(resp['AccountAttributes'][0]['AttributeValues'][0]['AttributeValue'])
+    used = len(ec2.describe_addresses()['Addresses'])
+    detail = '{} of {} Elastic IPs used, {} needed'.format(used, limit, cluster_size)
+    return (OK if used + cluster_size <= limit else FAILED), detail
+
+
+def check_security_group(ec2: object, quotas: object, cluster_name: str, rules: int) -> tuple:
+    resp = ec2.describe_security_groups(Filters=[{'Name': 'group-name', 'Values': [cluster_name]}])
+    if resp['SecurityGroups']:
+        return FAILED, 'security group {} already exists'.format(resp['SecurityGroups'][0]['GroupId'])
+    try:
+        resp = quotas.get_service_quota(ServiceCode='vpc', QuotaCode=rules_per_security_group_quota_code)
+        limit = int(resp['Quota']['Value'])
+    except ClientError:
+        limit = default_rules_per_security_group
+    detail = '{} ingress rules needed, {} allowed'.format(rules, limit)
+    return (OK if rules <= limit else FAILED), detail
+
+
+def check_hosted_zone(hosted_zone: str) -> tuple:
+    r53 = boto3.client('route53')
+    zones = r53.list_hosted_zones_by_name(DNSName=hosted_zone)['HostedZones']
+    if not any(z['Name'] == hosted_zone for z in zones):
+        return FAILED, 'hosted zone {} not found'.format(hosted_zone)
+    return OK, ''
+
+
+def run_check(region: str, name: str, check, *args) -> Check:
+    """
+    A check that cannot be run, for lack of permissions for example, is
+    reported but does not fail the pre-flight.
+    """
+    try:
+        status, detail = check(*args)
+    except ClientError as e:
+        status, detail = UNKNOWN, e.response['Error'].get('Message', str(e))
+    return Check(region, name, status, detail)
+
+
+def check_region(region: str, options: dict) -> list:
+    ec2 = boto3.client('ec2', region)
+    quotas = boto3.client('service-quotas', region)
+    subnets = find_subnets(ec2, 'dmz-' if options['use_dmz'] else 'internal-')
+    size = options['cluster_size']
+    # the nodes of all regions, the Odd host and the cluster itself
+    rules = (size * len(options['regions']) if options['use_dmz'] else 0) + 2
+
+    checks = [
+        run_check(region, 'account', check_account, ec2),
+        run_check(region, 'subnet IPs', check_subnets, subnets, size),
+        run_check(region, 'instance type', check_instance_type, ec2, options['instance_type'], subnets),
+        run_check(region, 'vCPU quota', check_vcpus, ec2, quotas, options['instance_type'], size),
+        run_check(region, 'security group', check_security_group, ec2, quotas, options['cluster_name'], rules),
+    ]
+    if options['use_dmz']:
+        checks.append(run_check(region, 'Elastic IPs', check_elastic_ips, ec2, size))
+    return checks
+
+
+def preflight_checks(options: dict) -> list:
+    regions = options['regions']
+    with ThreadPoolExecutor(max_workers=len(regions) + 1) as executor:
+        hosted_zone = None
+        if options['hosted_zone']:
+            hosted_zone = executor.submit(run_check, 'global', 'hosted zone', check_hosted_zone,
+                                          options['hosted_zone'])
+        checks = [c for r in executor.map(lambda r: check_region(r, options), regions) for c in r]
+        if hosted_zone:
+            checks.append(hosted_zone.result())
+    return checks
+
+
+def run_preflight(options: dict):
+    with Action('Running pre-flight checks..'):
+        checks = preflight_checks(options)
+    print_table(['region', 'name', 'status', 'detail'], [c._asdict() for c in checks],
+                styles={FAILED: {'fg': 'red'}, UNKNOWN: {'fg': 'yellow'}})
+    failed = ['{} {}: {}'.format(c.region, c.name, c.detail) for c in checks if c.status == FAILED]
+    if failed:
+        raise Exception('Pre-flight checks failed, nothing was created:\n{}'.format('\n'.join(failed)))
@@ -0,0 +1,479 @@
+"""
+Subrange repair orchestrator.
+
+The token ring of every keyspace is read over Jolokia and split into
+subranges of roughly the same estimated number of partitions.  The
+subranges are repaired with repairAsync, limiting the number of repairs
+running at a time on every node and in every data center, and backing off
+while the nodes are busy compacting or dropping mutations.  Progress is
+kept in the local journal, so that an interrupted repair can be resumed.
+"""
+from contextlib import ExitStack
+import collections
+import logging
+import math
+import time
+import re
+
+from . import jolokia, journal
+from .inventory import stream_instances
+
+
+logger = logging.getLogger(__name__)
+
+MIN_TOKEN = -2 ** 63
+RING_SIZE = 2 ** 64
+
+storage_service_mbean = 'org.apache.cassandra.db:type=StorageService'
+system_keyspaces = ['system', 'system_schema', 'system_traces',
+                    'system_distributed', 'system_auth']
+
+# ordinals of ProgressEventType in the userData of progress notifications
+progress_error = 2
+progress_abort = 3
+progress_complete = 5
+
+
+def normalize_token(token: int) -> int:
+    return (token - MIN_TOKEN) % RING_SIZE + MIN_TOKEN
+
+
+def range_width(start: int, end: int) -> int:
+    """
+    Width of the range (start, end], which may wrap around the ring.
+    """
+    return (end - start) % RING_SIZE or RING_SIZE
+
+
+def split_range(start: int, end: int, parts: int) -> list:
+    width = range_width(start, end)
+    bounds = [normalize_token(start + width * i // parts) for i in range(parts)]
+    return list(zip(bounds, bounds[1:] + [end]))
+
+
+def parse_range_key(key: str) -> tuple:
+    """
+    Jolokia renders the List<String> keys of the range map as "[start, end]".
+    """
+    start, end = re.findall('-?\\d+', key)
+    return int(start), int(end)
+
+
+def read_range_map(url: str, keyspace: str) -> dict:
+    values = jolokia.query(url, [{
+        'type': 'exec',
+        'mbean': storage_service_mbean,
+        'operation': 'getRangeToEndpointMap',
+        'arguments': [keyspace]
+    }])
+    if not values or values[0] is None:
+        raise Exception("Cannot read the token ring of {}".format(keyspace))
+    return {parse_range_key(k): v for k, v in values[0].items()}
+
+
+def read_datacenters(url: str, endpoints: list) -> dict:
+    values = jolokia.query(url, [{
+        'type': 'exec',
+        'mbean': 'org.apache.cassandra.db:type=EndpointSnitchInfo',
+        'operation': 'getDatacenter(java.lang.String)',
+        'arguments': [e]
+    } for e in endpoints])
+    if not values or None in values:
+        raise Exception("Cannot read the data centers of the nodes")
+    return dict(zip(endpoints, values))
+
+
+def estimate_partitions(url: str, keyspace: str) -> int:
+    mbean = 'org.apache.cassandra.metrics:type=Table,keyspace={},scope=*,name=EstimatedPartitionCount' \
+            .format(keyspace)
+    values = jolokia.query(url, [{'type': 'read', 'mbean': mbean, 'attribute': 'Value'}])
+    if not values or not values[0]:
+        return 0
+    return sum(v['Value'] for v in values[0].values())
+
+
+def plan_subranges(range_map: dict, partitions: dict, target: int) -> list:
+    """
+    Splits every range into subranges of about the target number of
+    partitions.  The partitions density of a range is estimated from the
+    partitions count and the replicated ring width of its replicas.
+    """
+    replicated_width = collections.Counter()
+    for (start, end), replicas in range_map.items():
+        for e in replicas:
+            replicated_width[e] += range_width(start, end)
+
+    subranges = []
+    for (start, end), replicas in sorted(range_map.items()):
+        densities = [partitions[e] / replicated_width[e]
+                     for e in replicas if partitions.get(e) is not None]
+        density = sum(densities) / len(densities) if densities else 0
+        estimated = range_width(start, end) * density
+        parts = max(int(math.ceil(estimated / target)), 1)
+        subranges.extend(
+            (s, e, replicas) for s, e in split_range(start, end, parts)
+        )
+    return subranges
+
+
+def start_repair(url: str, keyspace: str, start: int, end: int,
+                 parallelism: str) -> int:
+    values = jolokia.query(url, [{
+        'type': 'exec',
+        'mbean': storage_service_mbean,
+        'operation': 'repairAsync(java.lang.String,java.util.Map)',
+        'arguments': [keyspace, {
+            'ranges': '{}:{}'.format(start, end),
+            'parallelism': parallelism,
+            'primaryRange': 'false',
+            'incremental': 'false'
+        }]
+    }])
+    if not values or values[0] is None:
+        return None
+    return values[0]
+
+
+def repair_status(url: str, command: int) -> str:
+    """
+    Returns 'running', 'done', 'failed' or None if the status is unknown.
+
+    Newer versions report the status of a repair command.  Older ones only
+    expose a Repair#<command> thread pool while the command is running: a
+    missing pool does not tell a completed repair from a failed one, or one
+    whose pool did not show up yet, so their completion is only known from
+    the progress notifications of the coordinator.
+    """
+    values = jolokia.query(url, [
+        {'type': 'exec', 'mbean': storage_service_mbean,
+         'operation': 'getParentRepairStatus', 'arguments': [command]},
+        {'type': 'search',
+         'mbean': 'org.apache.cassandra.internal:type=Repair#{}'.format(command)}
+    ])
+    if values is None:
+        return None
+    status, pools = values
+    if status:
+        return {'COMPLETED': 'done', 'FAILED': 'failed'}.get(status[0], 'running')
+    if pools:
+        return 'running'
+    return None
+
+
+def subscribe_notifications(url: str) -> dict:
+    """
+    Registers a Jolokia client pulling the notifications of StorageService,
+    returns None if the agent does not support notifications.
+    """
+    values = jolokia.query(url, [{'type': 'notification', 'command': 'register'}])
+    if not values or not values[0]:
+        return None
+    client = values[0]['id']
+    values = jolokia.query(url, [{
+        'type': 'notification', 'command': 'add', 'client': client,
+        'mode': 'pull', 'mbean': storage_service_mbean
+    }])
+    if not values or values[0] is None:
+        unsubscribe_notifications(url, {'client': client})
+        return None
+    return {'client': client, 'handle': values[0]}
+
+
+def unsubscribe_notifications(url: str, subscription: dict):
+    jolokia.query(url, [{'type': 'notification', 'command': 'unregister',
+                         'client': subscription['client']}])
+
+
+def pull_notifications(url: str, subscription: dict) -> list:
+    values = jolokia.query(url, [{
+        'type': 'notification', 'command': 'pull',
+        'client': subscription['client'], 'handle': subscription['handle']
+    }])
+    if not values or values[0] is None:
+        return None
+    return values[0].get('notifications', [])
+
+
+def repair_progress(notifications: list) -> tuple:
+    """
+    Returns the repair commands which reported an error and those which
+    completed, from the progress notifications of StorageService.  A failed
+    repair reports an error or abort before completing.
+    """
+    failed, completed = set(), set()
+    for n in notifications:
+        match = re.match('repair:(\\d+)$', str(n.get('source')))
+        if n.get('type') != 'progress' or not match or not isinstance(n.get('userData'), dict):
+            continue
+        command = int(match.group(1))
+        event = n['userData'].get('type')
+        if event in (progress_error, progress_abort):
+            failed.add(command)
+        elif event == progress_complete:
+            completed.add(command)
+    return failed, completed
+
+
+def read_node_load(url: str) -> tuple:
+    """
+    Returns (pending compactions, dropped mutations) of a node.
+    """
+    values = jolokia.query(url, [
+        {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=PendingTasks',
+         'attribute': 'Value'},
+        {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=DroppedMessage,scope=MUTATION,name=Dropped',
+         'attribute': 'Count'}
+    ])
+    if not values or None in values:
+        return None
+    return tuple(values)
+
+
+class RepairScheduler:
+    """
+    Schedules the subrange repairs of a keyspace within the parallelism
+    limits, tracking them in the journal.
+    """
+
+    def __init__(self, db: object, options: dict, urls: dict, datacenters: dict):
+        self.db = db
+        self.options = options
+        self.urls = urls
+        self.datacenters = datacenters
+        self.dropped = {}
+        self.backoff = options['poll_interval']
+        self.subscriptions = {}
+        self.failed_commands = set()
+        self.results = {}
+
+    def is_overloaded(self, endpoints: list) -> bool:
+        overloaded = False
+        for e in endpoints:
+            load = read_node_load(self.urls[e])
+            if load is None:
+                logger.warning("Cannot read load of {}".format(e))
+                overloaded = True
+                continue
+            pending, dropped = load
+            if pending > self.options['max_pending_compactions']:
+                logger.info("{} has {} pending compactions".format(e, pending))
+                overloaded = True
+            if dropped > self.dropped.get(e, dropped):
+                logger.info("{} dropped {} mutations".format(e, dropped - self.dropped[e]))
+                overloaded = True
+            self.dropped[e] = dropped
+        return overloaded
+
+    def can_start(self, replicas: list, node_load: dict, dc_load: dict) -> bool:
+        if any(node_load[e] >= self.options['node_parallelism'] for e in replicas):
+            return False
+        dcs = {self.datacenters[e] for e in replicas}
+        return all(dc_load[dc] < self.options['dc_parallelism'] for dc in dcs)
+
+    def subscribe(self, endpoint: str):
+        """
+        Subscribes to the notifications of a coordinator before starting a
+        repair on it, so that its completion is not missed.
+        """
+        if endpoint in self.subscriptions:
+            return
+        subscription = subscribe_notifications(self.urls[endpoint])
+        if subscription is None:
+            logger.warning("Cannot subscribe to the notifications of {}, "
+                           "the repairs on it can only be confirmed on Cassandra 4.0 or newer".format(endpoint))
+        self.subscriptions[endpoint] = subscription
+
+    def unsubscribe(self):
+        for endpoint, subscription in self.subscriptions.items():
+            if subscription:
+                unsubscribe_notifications(self.urls[endpoint], subscription)
+        self.subscriptions = {}
+
+    def pull_results(self, endpoint: str):
+        subscription = self.subscriptions.get(endpoint)
+        if not subscription:
+            return
+        notifications = pull_notifications(self.urls[endpoint], subscription)
+        if notifications is None:
+            logger.warning("Cannot pull the notifications of {}".format(endpoint))
+            return
+        failed, completed = repair_progress(notifications)
+        self.failed_commands.update((endpoint, c) for c in failed)
+        for c in completed:
+            self.results[(endpoint, c)] = 'failed' if (endpoint, c) in self.failed_commands else 'done'
+
+    def check_running(self, ranges: list):
+        """
+        A repair whose status stays unknown until the timeout is retried,
+        it is only done once the coordinator confirms it.
+        """
+        for e in sorted({r['coordinator'] for r in ranges if r['state'] == 'running'}):
+            self.pull_results(e)
+        for r in ranges:
+            if r['state'] != 'running':
+                continue
+            status = self.results.get((r['coordinator'], r['command'])) or \
+                repair_status(self.urls[r['coordinator']], r['command'])
+            timed_out = time.time() - r['started'] > self.options['range_timeout']
+            if status == 'running' and not timed_out:
+                continue
+            if status is None and not timed_out:
+                continue
+            if status == 'done':
+                journal.update_repair_range(self.db, r['id'], state='done')
+            elif r['attempts'] < self.options['max_attempts']:
+                logger.warning("Repair of ({}, {}] failed, will retry".format(r['start_token'], r['end_token']))
+                journal.update_repair_range(self.db, r['id'], state='pending')
+            else:
+                logger.error("Repair of ({}, {}] failed".format(r['start_token'], r['end_token']))
+                journal.update_repair_range(self.db, r['id'], state='failed')
+
+    def start_ranges(self, keyspace: str, ranges: list):
+        node_load = collections.Counter()
+        dc_load = collections.Counter()
+        for r in ranges:
+            if r['state'] == 'running':
+                node_load.update(r['replicas'])
+                dc_load.update({self.datacenters[e] for e in r['replicas']})
+
+        for r in ranges:
+            if r['state'] != 'pending':
+                continue
+            reachable = [e for e in r['replicas'] if e in self.urls]
+            if not reachable:
+                logger.error("No replica of ({}, {}] can be reached".format(r['start_token'], r['end_token']))
+                journal.update_repair_range(self.db, r['id'], state='failed')
+                continue
+            if not self.can_start(r['replicas'], node_load, dc_load):
+                continue
+            coordinator = min(reachable, key=lambda e: node_load[e])
+            self.subscribe(coordinator)
+            command = start_repair(self.urls[coordinator], keyspace,
+                                   r['start_token'], r['end_token'],
+                                   self.options['parallelism'])
+            if not command:
+                logger.warning("Cannot start repair on {}".format(coordinator))
+                continue
+            logger.info("Repairing ({}, {}] of {} on {}".format(
+                r['start_token'], r['end_token'], keyspace, coordinator))
+            journal.update_repair_range(
+                self.db, r['id'], state='running', coordinator=coordinator,
+                command=command, attempts=r['attempts'] + 1, started_at=journal.timestamp()
+            )
+            self.started[r['id']] = time.time()
+            node_load.update(r['replicas'])
+            dc_load.update({self.datacenters[e] for e in r['replicas']})
+
+    def run(self, keyspace: str) -> dict:
+        """
+        Repairs all pending subranges, returns the count of subranges by state.
+        """
+        try:
+            return self.repair(keyspace)
+        finally:
+            self.unsubscribe()
+
+    def repair(self, keyspace: str) -> dict:
+        cluster_name = self.options['cluster_name']
+        self.started = {}
+        # repairs running when interrupted cannot be tracked, start them over
+        for r in journal.list_repair_ranges(self.db, cluster_name, keyspace):
+            if r['state'] == 'running':
+                journal.update_repair_range(self.db, r['id'], state='pending')
+
+        while True:
+            ranges = [
+                dict(r, started=self.started.get(r['id'], 0))
+                for r in journal.list_repair_ranges(self.db, cluster_name, keyspace)
+            ]
+            self.check_running(ranges)
+            ranges = journal.list_repair_ranges(self.db, cluster_name, keyspace)
+            states = collections.Counter(r['state'] for r in ranges)
+            logger.info("{}: {}".format(keyspace, dict(states)))
+            if not states['pending'] and not states['running']:
+                return states
+
+            if self.is_overloaded(list(self.urls)):
+                self.backoff = min(self.backoff * 2, self.options['max_backoff'])
+                logger.info("Backing off for {} seconds".format(self.backoff))
+                time.sleep(self.backoff)
+                continue
+            self.backoff = self.options['poll_interval']
+
+            self.start_ranges(keyspace, ranges)
+            time.sleep(self.options['poll_interval'])
+
+
+def list_keyspaces(url: str) -> list:
+    values = jolokia.query(url, [{
+        'type': 'read', 'mbean': storage_service_mbean, 'attribute': 'NonSystemKeyspaces'
+    }])
+    if not values or values[0] is None:
+        raise Exception("Cannot list keyspaces")
+    return [k for k in values[0] if k not in system_keyspaces]
+
+
+def endpoint_urls(region_urls: dict, region_instances: dict) -> dict:
+    """
+    Maps the endpoint addresses, which are the Public IPs in a multi-region
+    setup, to the Jolokia URLs of the nodes.
+    """
+    urls = {}
+    for region, instances in region_instances.items():
+        for i in instances:
+            url = region_urls[region].get(i['PrivateIpAddress'])
+            if url:
+                for k in ['PrivateIpAddress', 'PublicIpAddress']:
+                    if k in i:
+                        urls[i[k]] = url
+    return urls
+
+
+def prepare_plan(db: object, options: dict, keyspace: str, urls: dict) -> list:
+    cluster_name = options['cluster_name']
+    ranges = journal.list_repair_ranges(db, cluster_name, keyspace)
+    if ranges and not options['restart']:
+        return ranges
+    journal.delete_repair_plan(db, cluster_name, keyspace)
+
+    any_url = next(iter(urls.values()))
+    range_map = read_range_map(any_url, keyspace)
+    endpoints = {e for replicas in range_map.values() for e in replicas}
+    partitions = {e: estimate_partitions(urls[e], keyspace) for e in endpoints if e in urls}
+    subranges = plan_subranges(range_map, partitions, options['partitions_per_range'])
+    logger.info("Split {} ranges of {} into {} subranges".format(
+        len(range_map), keyspace, len(subranges)))
+    journal.save_repair_plan(db, cluster_name, keyspace, subranges)
+    return journal.list_repair_ranges(db, cluster_name, keyspace)
+
+
+def run_repair(options: dict) -> bool:
+    region_instances = collections.defaultdict(list)
+    for region, i in stream_instances(options['cluster_name'], list(options['odd_hosts']), ['running']):
+        region_instances[region].append(i)
+
+    db = journal.open_journal()
+    with ExitStack() as stack:
+        region_urls = {
+            region: stack.enter_context(jolokia.tunnels(options['odd_hosts'][region], instances))
+            for region, instances in region_instances.items()
+        }
+        urls = endpoint_urls(region_urls, region_instances)
+        if not urls:
+            raise Exception("Cannot reach any node of {}".format(options['cluster_name']))
+        any_url = next(iter(urls.values()))
+        keyspaces = options['keyspace'] or list_keyspaces(any_url)
+
+        success = True
+        for keyspace in keyspaces:
+            ranges = prepare_plan(db, options, keyspace, urls)
+            endpoints = sorted({e for r in ranges for e in r['replicas']})
+            datacenters = read_datacenters(any_url, endpoints)
+            states = RepairScheduler(db, options, urls, datacenters).run(keyspace)
+            if states['failed']:
+                logger.error("{} subranges of {} failed to repair".format(states['failed'], keyspace))
+                success = False
+            else:
+                journal.delete_repair_plan(db, options['cluster_name'], keyspace)
+    db.close()
+    return success
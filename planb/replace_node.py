@@ -0,0 +1,304 @@
+"""
+Replacement of a dead node which lost its data volume.
+
+A fresh node is launched on the same private IP address with
+replace_address_first_boot set, so that it takes over the tokens of the
+dead node and streams their data from the remaining replicas.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+import netaddr
+from clickclick import Action, info
+
+from . import jolokia, journal
+from .common import ec2_client, dump_user_data_for_taupage, \
+    setup_sns_topics_for_alarm, template_user_data
+from .alarms import sync_alarms
+from .create_cluster import create_tagged_volume
+from .inventory import iter_instances, live_instance_states
+from .scale_out import read_ring_state, has_joined
+from .update_cluster import fetch_user_data, find_data_volume_id, \
+    is_api_termination_disabled, build_run_instances_params, \
+    drain_cassandra, wait_drained
+
+
+logger = logging.getLogger(__name__)
+
+storage_service_mbean = 'org.apache.cassandra.db:type=StorageService'
+streaming_mbean = 'org.apache.cassandra.metrics:type=Streaming,scope={},name=OutgoingBytes'
+
+
+def broadcast_address(instance: dict) -> str:
+    return instance.get('PublicIpAddress') or instance['PrivateIpAddress']
+
+
+def find_subnet_for_ip(ec2: object, vpc_id: str, ip: str) -> dict:
+    resp = ec2.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+    for subnet in resp['Subnets']:
+        if netaddr.IPAddress(ip) in netaddr.IPNetwork(subnet['CidrBlock']):
+            return subnet
+    raise Exception("No subnet of {} contains {}".format(vpc_id, ip))
+
+
+def instance_spec(ec2: object, instance: dict) -> dict:
+    user_data, gzipped = fetch_user_data(ec2, instance['InstanceId'])
+    return dict(
+        instance,
+        UserData=template_user_data(user_data),
+        UserDataGzipped=gzipped,
+        DisableApiTermination=is_api_termination_disabled(ec2, instance['InstanceId'])
+    )
+
+
+def derive_instance_spec(ec2: object, peer: dict, ip: str, public_ip: str) -> dict:
+    """
+    Models the replacement on a running peer, moving it to the subnet of
+    the dead node.
+    """
+    spec = instance_spec(ec2, peer)
+    spec.pop('PublicIpAddress', None)
+    if 'PublicIpAddress' in peer:
+        if not public_ip:
+            raise Exception("The cluster uses public IPs, please specify the "
+                            "Elastic IP of the dead node with --public-ip")
+        spec['PublicIpAddress'] = public_ip
+    spec['PrivateIpAddress'] = ip
+    spec['SubnetId'] = find_subnet_for_ip(ec2, peer['VpcId'], ip)['SubnetId']
+    return spec
+
+
+def find_instance_spec(ec2: object, db: object, options: dict, peers: list) -> dict:
+    """
+    Derives the spec from a running peer, so that the node gets the image,
+    AMI and instance type the cluster runs now.  The instance saved in the
+    journal dates from before the last update of the cluster, it is only
+    used for its Elastic IP, or if no node is left to model on.
+    """
+    saved = journal.find_instance_by_ip(db, options['cluster_name'],
+                                        options['region'], options['ip'])
+    public_ip = options['public_ip'] or (saved or {}).get('PublicIpAddress')
+    if peers:
+        return derive_instance_spec(ec2, peers[0], options['ip'], public_ip)
+    if not saved:
+        raise Exception("No running node to model {} on".format(options['ip']))
+    logger.warning("No running node to model {} on, using the instance saved in the journal "
+                   "at the last update, which may run an outdated image".format(options['ip']))
+    saved = dict(saved, UserData=template_user_data(saved['UserData']))
+    return dict(saved, PublicIpAddress=public_ip) if public_ip else saved
+
+
+def replacement_user_data(spec: dict, dead_address: str) -> dict:
+    """
+    The user data of the first start of the replacement only, see
+    restart_replacement.  Cassandra does not bootstrap a seed, so a dead
+    seed is taken out of the seeds of its replacement, or it would not
+    stream its data.
+    """
+    user_data = dict(spec['UserData'])
+    environment = dict(user_data.get('environment', {}), REPLACE_ADDRESS=dead_address)
+    seeds = [s for s in environment.get('SEEDS', '').split(',') if s]
+    if dead_address in seeds:
+        seeds.remove(dead_address)
+        if not seeds:
+            raise Exception("Node {} is the only seed of the cluster, it cannot be replaced".format(dead_address))
+        logger.info("Node {} is a seed, it is left out of the seeds until it has joined".format(dead_address))
+        environment['SEEDS'] = ','.join(seeds)
+    user_data['environment'] = environment
+    return user_data
+
+
+def read_unreachable_nodes(url: str) -> list:
+    values = jolokia.query(url, [{
+        'type': 'read', 'mbean': storage_service_mbean, 'attribute': 'UnreachableNodes'
+    }])
+    if not values or values[0] is None:
+        raise Exception("Failed to read the ring state from {}".format(url))
+    return values[0]
+
+
+def read_stream_throughput(urls: dict) -> dict:
+    query = [{'type': 'read', 'mbean': storage_service_mbean,
+              'attribute': 'StreamThroughputMbPerSec'}]
+    result = {}
+    for ip, url in urls.items():
+        values = jolokia.query(url, query)
+        if values and values[0] is not None:
+            result[ip] = values[0]
+    return result
+
+
+def set_stream_throughput(urls: dict, throughput: dict):
+    """
+    Sets the outbound streaming throughput, in megabits per second, by IP.
+    """
+    for ip, value in throughput.items():
+        logger.info("Setting stream throughput of {} to {} Mb/s".format(ip, value))
+        jolokia.query(urls[ip], [{
+            'type': 'write', 'mbean': storage_service_mbean,
+            'attribute': 'StreamThroughputMbPerSec', 'value': value
+        }])
+
+
+def streamed_bytes(urls: dict, address: str) -> int:
+    """
+    Total bytes streamed to the address by all peers.
+    """
+    query = [{'type': 'read', 'mbean': streaming_mbean.format(address), 'attribute': 'Count'}]
+
+    def read(url):
+        values = jolokia.query(url, query)
+        return values[0] if values and values[0] is not None else 0
+
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        return sum(executor.map(read, urls.values()))
+
+
+def launch_node(ec2: object, spec: dict, options: dict) -> str:
+    """
+    Launches an instance from the spec, which expects its data volume to
+    be named after the private IP already.
+    """
+    params = build_run_instances_params(ec2, None, spec, dict(
+        cluster_name=options['cluster_name'],
+        taupage_ami_id=None, instance_type=None, docker_image=None
+    ))
+    params['UserData'] = dump_user_data_for_taupage(params['UserData'], spec.get('UserDataGzipped', False))
+
+    with Action('Launching node {}..'.format(spec['PrivateIpAddress'])) as act:
+        resp = ec2.run_instances(**params)
+        instance_id = resp['Instances'][0]['InstanceId']
+        ec2.create_tags(Resources=[instance_id],
+                        Tags=[t for t in spec['Tags'] if not t['Key'].startswith('aws:')])
+        while True:
+            instance = ec2.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+            if instance['State']['Name'] != 'pending':
+                break
+            time.sleep(5)
+            act.progress()
+
+        if 'PublicIpAddress' in spec:
+            ec2.associate_address(InstanceId=instance_id, PublicIp=spec['PublicIpAddress'])
+
+    # also deletes the alarm of the dead node
+    alarm_topics = options['alarm_topics']
+    sync_alarms(options['region'], options['cluster_name'],
+                alarm_topics[options['region']] if alarm_topics else None)
+    return instance_id
+
+
+def launch_replacement(ec2: object, spec: dict, user_data: dict, volume: dict,
+                       options: dict) -> str:
+    subnet = ec2.describe_subnets(SubnetIds=[spec['SubnetId']])['Subnets'][0]
+    volume_name = '{}-{}'.format(options['cluster_name'], spec['PrivateIpAddress'])
+    create_tagged_volume(ec2, dict(
+        volume_type=volume['VolumeType'],
+        volume_size=volume['Size'],
+        volume_iops=volume.get('Iops'),
+        volume_throughput=volume.get('Throughput')
+    ), subnet['AvailabilityZone'], volume_name)
+
+    return launch_node(ec2, dict(spec, UserData=user_data), options)
+
+
+def restart_replacement(ec2: object, instance_id: str, spec: dict, urls: dict, options: dict):
+    """
+    Restarts the replacement once it has joined with the user data of the
+    spec, so that it does not keep the address it took over: the user data
+    of running nodes is the template of new ones.
+    """
+    address = broadcast_address(spec)
+    with jolokia.tunnels(options['odd_host'], [spec]) as node_urls:
+        url = node_urls.get(spec['PrivateIpAddress'])
+        if url:
+            drain_cassandra(url)
+            if not wait_drained(url):
+                logger.warning("Node {} did not finish draining in time".format(address))
+
+    with Action('Restarting node {} with its final user data..'.format(address)):
+        ec2.stop_instances(InstanceIds=[instance_id])
+        ec2.get_waiter('instance_stopped').wait(InstanceIds=[instance_id])
+        data = dump_user_data_for_taupage(spec['UserData'], spec.get('UserDataGzipped', False))
+        ec2.modify_instance_attribute(
+            InstanceId=instance_id,
+            UserData={'Value': data if isinstance(data, bytes) else data.encode('UTF-8')}
+        )
+        ec2.start_instances(InstanceIds=[instance_id])
+        ec2.get_waiter('instance_running').wait(InstanceIds=[instance_id])
+    wait_until_normal(urls, address, options['join_timeout'])
+
+
+def find_blocking_instance(ec2: object, cluster_name: str, ip: str) -> dict:
+    """
+    A new instance can only take the private IP once the old one is gone.
+    """
+    return next((i for i in iter_instances(ec2, cluster_name, live_instance_states)
+                 if i['PrivateIpAddress'] == ip), None)
+
+
+def wait_until_normal(urls: dict, address: str, timeout: int):
+    """
+    The replacing node only shows up as live once it has finished streaming.
+    """
+    url = next(iter(urls.values()))
+    deadline = time.time() + timeout
+    while True:
+        ring_state = read_ring_state(url)
+        if ring_state and has_joined(ring_state, {address}):
+            return
+        if time.time() > deadline:
+            raise Exception("Node {} did not become NORMAL in time".format(address))
+        info("Streamed {:.1f} MiB to {} so far..".format(
+            streamed_bytes(urls, address) / 1024 ** 2, address
+        ))
+        time.sleep(30)
+
+
+def replace_node(options: dict):
+    region = options['region']
+    ec2 = ec2_client(region)
+
+    peers = [i for i in iter_instances(ec2, options['cluster_name'], ['running'])
+             if i['PrivateIpAddress'] != options['ip']]
+    if not peers:
+        raise Exception("No running nodes of {} found in {}".format(options['cluster_name'], region))
+
+    blocking = find_blocking_instance(ec2, options['cluster_name'], options['ip'])
+    if blocking:
+        raise Exception("Instance {} still holds {}, please terminate it first".format(
+            blocking['InstanceId'], options['ip']
+        ))
+
+    db = journal.open_journal()
+    try:
+        spec = find_instance_spec(ec2, db, options, peers)
+    finally:
+        db.close()
+
+    dead_address = broadcast_address(spec)
+    user_data = replacement_user_data(spec, dead_address)
+    volume = ec2.describe_volumes(VolumeIds=[find_data_volume_id(ec2, peers[0])])['Volumes'][0]
+
+    if options['sns_topic'] or options['sns_email']:
+        alarm_topics = setup_sns_topics_for_alarm([region], options['sns_topic'], options['sns_email'])
+    else:
+        alarm_topics = {}
+
+    with jolokia.tunnels(options['odd_host'], peers) as urls:
+        if not urls:
+            raise Exception("Cannot reach any node of {} in {}".format(options['cluster_name'], region))
+        if dead_address not in read_unreachable_nodes(next(iter(urls.values()))):
+            raise Exception("Node {} is not DOWN, refusing to replace it".format(dead_address))
+
+        original_throughput = read_stream_throughput(urls)
+        set_stream_throughput(urls, {ip: options['stream_throughput'] for ip in original_throughput})
+        try:
+            instance_id = launch_replacement(ec2, spec, user_data, volume,
+                                             dict(options, alarm_topics=alarm_topics))
+            wait_until_normal(urls, dead_address, options['join_timeout'])
+        finally:
+            set_stream_throughput(urls, original_throughput)
+        restart_replacement(ec2, instance_id, spec, urls, options)
+
+    info('Node {} was replaced successfully!'.format(dead_address))
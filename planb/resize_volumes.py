@@ -0,0 +1,151 @@
+"""
+Online modification of the data volumes of a cluster: size, type, IOPS and
+throughput are changed with ModifyVolume while the nodes keep running, and
+the filesystem is grown in place once the new size is available.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import subprocess
+import logging
+import shlex
+import time
+
+from clickclick import info
+
+from .common import ec2_client, host_data_mount_point
+from .inventory import iter_instances
+from .update_cluster import find_data_volume_id
+
+
+logger = logging.getLogger(__name__)
+
+# AWS allows one modification of a volume every 6 hours
+modification_cooldown = timedelta(hours=6)
+
+grow_filesystem_script = '''\
+fstype=$(findmnt -n -o FSTYPE {mount})
+if [ "$fstype" = xfs ]; then
+    sudo xfs_growfs {mount}
+else
+    sudo resize2fs $(findmnt -n -o SOURCE {mount})
+fi'''.format(mount=host_data_mount_point)
+
+
+def volume_changes(volume: dict, options: dict) -> dict:
+    """
+    Returns the ModifyVolume parameters which differ from the volume.
+    """
+    changes = {}
+    if options['size']:
+        if options['size'] < volume['Size']:
+            raise Exception("Cannot shrink {} from {} GiB to {} GiB".format(
+                volume['VolumeId'], volume['Size'], options['size']
+            ))
+        if options['size'] > volume['Size']:
+            changes['Size'] = options['size']
+    if options['volume_type'] and options['volume_type'] != volume['VolumeType']:
+        changes['VolumeType'] = options['volume_type']
+    if options['iops'] and options['iops'] != volume.get('Iops'):
+        changes['Iops'] = options['iops']
+    if options['throughput'] and options['throughput'] != volume.get('Throughput'):
+        changes['Throughput'] = options['throughput']
+    return changes
+
+
+def last_modification(ec2: object, volume_id: str) -> dict:
+    try:
+        resp = ec2.describe_volumes_modifications(VolumeIds=[volume_id])
+    except Exception as e:
+        # volumes never modified are reported as not found
+        logger.debug("No modifications of {}: {}".format(volume_id, e))
+        return None
+    modifications = sorted(resp['VolumesModifications'], key=lambda m: m['StartTime'])
+    return modifications[-1] if modifications else None
+
+
+def modification_blocked_until(modification: dict) -> datetime:
+    """
+    Returns the time before which the volume cannot be modified again, or
+    None if it can be modified right away.
+    """
+    if not modification:
+        return None
+    not_before = modification['StartTime'] + modification_cooldown
+    if modification['ModificationState'] == 'modifying' or \
+            datetime.now(timezone.utc) < not_before:
+        return not_before
+    return None
+
+
+def wait_for_optimizing(ec2: object, volume_id: str, poll_interval: int = 15):
+    """
+    The new size can be used as soon as the volume is optimizing.
+    """
+    while True:
+        modification = last_modification(ec2, volume_id)
+        state = modification['ModificationState'] if modification else None
+        if state in ('optimizing', 'completed'):
+            return
+        if state == 'failed':
+            raise Exception("Modification of {} failed: {}".format(
+                volume_id, modification.get('StatusMessage')
+            ))
+        logger.info("Waiting for {} to be optimizing, now {}".format(volume_id, state))
+        time.sleep(poll_interval)
+
+
+def grow_filesystem(odd_host: str, ip: str) -> bool:
+    cmd = ['ssh', odd_host, 'ssh', ip, shlex.quote(grow_filesystem_script)]
+    logger.info("Growing the filesystem on {}".format(ip))
+    return subprocess.call(cmd) == 0
+
+
+def resize_node(region: str, instance: dict, options: dict) -> str:
+    """
+    Returns a short description of what was done to the node.
+    """
+    ec2 = ec2_client(region)
+    ip = instance['PrivateIpAddress']
+    volume_id = find_data_volume_id(ec2, instance)
+    volume = ec2.describe_volumes(VolumeIds=[volume_id])['Volumes'][0]
+
+    changes = volume_changes(volume, options)
+    if not changes:
+        return 'unchanged'
+
+    not_before = modification_blocked_until(last_modification(ec2, volume_id))
+    if not_before:
+        return 'skipped, can be modified again at {:%Y-%m-%d %H:%M} UTC'.format(not_before)
+
+    logger.info("Modifying {} of {}: {}".format(volume_id, ip, changes))
+    ec2.modify_volume(VolumeId=volume_id, **changes)
+    wait_for_optimizing(ec2, volume_id)
+
+    if 'Size' in changes and not grow_filesystem(options['odd_hosts'][region], ip):
+        return 'modified, but growing the filesystem failed'
+    return 'modified'
+
+
+def resize_volumes(options: dict) -> bool:
+    nodes = [
+        (region, i)
+        for region in options['odd_hosts']
+        for i in iter_instances(ec2_client(region), options['cluster_name'], ['running'])
+    ]
+
+    def resize(node):
+        region, instance = node
+        try:
+            return resize_node(region, instance, options)
+        except Exception as e:
+            logger.error("Failed to resize the volume of {}: {}".format(
+                instance['PrivateIpAddress'], e
+            ))
+            return 'failed'
+
+    with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+        results = list(executor.map(resize, nodes))
+
+    for (region, instance), result in zip(nodes, results):
+        info('{} in {}: {}'.format(instance['PrivateIpAddress'], region, result))
+    return not any(r == 'failed' or r.startswith('modified,') for r in results)
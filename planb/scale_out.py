@@ -0,0 +1,283 @@
+"""
+Scale out a running cluster by adding nodes, reusing the steps of create.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import collections
+import logging
+import shlex
+import subprocess
+import time
+
+import boto3
+from clickclick import Action, info
+
+from . import jolokia
+from .common import ec2_client, setup_sns_topics_for_alarm, \
+    ensure_instance_profile, template_user_data
+from .create_cluster import allocate_ip_addresses, get_subnets, \
+    launch_instance, make_public_ip_ingress_rules, setup_dns_records, \
+    make_replication_map
+from .alarms import sync_cluster_alarms
+from .inventory import iter_instances
+from .repair import list_keyspaces
+from .update_cluster import fetch_user_data, find_data_volume_id, \
+    is_api_termination_disabled
+
+
+logger = logging.getLogger(__name__)
+
+storage_service_mbean = 'org.apache.cassandra.db:type=StorageService'
+
+
+def system_auth_replication(region_counts: dict) -> str:
+    return "ALTER KEYSPACE system_auth WITH replication = {};".format(
+        make_replication_map(region_counts)
+    )
+
+
+def least_populated_subnets(subnets: list, instances: list, count: int) -> list:
+    """
+    Picks a subnet for each new node, always taking the Availability Zone
+    with the fewest nodes.
+    """
+    zone_counts = collections.Counter(
+        i['Placement']['AvailabilityZone'] for i in instances
+    )
+    result = []
+    for _ in range(count):
+        subnet = min(subnets, key=lambda s: zone_counts[s['AvailabilityZone']])
+        zone_counts[subnet['AvailabilityZone']] += 1
+        result.append(subnet)
+    return result
+
+
+def run_cql(odd_host: str, ip: str, cql: str) -> bool:
+    inner = 'cqlsh -u admin -p "$ADMIN_PASSWORD" -e {}'.format(shlex.quote(cql))
+    node_cmd = 'docker exec taupageapp sh -c {}'.format(shlex.quote(inner))
+    cmd = ['ssh', odd_host, 'ssh', ip, shlex.quote(node_cmd)]
+    logger.info("Running on {}: {}".format(ip, cql))
+    return subprocess.call(cmd) == 0
+
+
+def read_ring_state(url: str) -> dict:
+    values = jolokia.query(url, [{
+        'type': 'read', 'mbean': storage_service_mbean,
+        'attribute': ['LiveNodes', 'JoiningNodes']
+    }])
+    if not values or values[0] is None:
+        return None
+    return values[0]
+
+
+def has_joined(ring_state: dict, ips: set) -> bool:
+    return ips <= set(ring_state['LiveNodes']) and \
+        not ips & set(ring_state['JoiningNodes'])
+
+
+def wait_for_join(url: str, ips: set, timeout: int):
+    deadline = time.time() + timeout
+    with Action('Waiting for {} to join the ring..'.format(', '.join(sorted(ips)))) as act:
+        while True:
+            ring_state = read_ring_state(url)
+            if ring_state and has_joined(ring_state, ips):
+                return
+            if time.time() > deadline:
+                raise Exception("Nodes {} did not join in time".format(', '.join(sorted(ips))))
+            time.sleep(10)
+            act.progress()
+
+
+def read_pending_compactions(url: str) -> int:
+    values = jolokia.query(url, [{
+        'type': 'read',
+        'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=PendingTasks',
+        'attribute': 'Value'
+    }])
+    return values[0] if values else None
+
+
+def cleanup_node(ip: str, url: str, keyspaces: list, max_pending: int):
+    for keyspace in keyspaces:
+        while True:
+            pending = read_pending_compactions(url)
+            if pending is not None and pending <= max_pending:
+                break
+            logger.info("Waiting for {} pending compactions on {}".format(pending, ip))
+            time.sleep(30)
+        logger.info("Cleaning up {} on {}".format(keyspace, ip))
+        jolokia.query(url, [{
+            'type': 'exec', 'mbean': storage_service_mbean,
+            'operation': 'forceKeyspaceCleanup(int,java.lang.String,[Ljava.lang.String;)',
+            'arguments': [0, keyspace, []]
+        }], timeout=None)
+
+
+def find_cluster_security_group(ec2: object, cluster_name: str) -> dict:
+    resp = ec2.describe_security_groups(
+        Filters=[{'Name': 'group-name', 'Values': [cluster_name]}]
+    )
+    return resp['SecurityGroups'][0]
+
+
+def prepare_region(ec2: object, region: str, instances: list, options: dict) -> dict:
+    """
+    Derives the launch options for new nodes in the region from an
+    existing node.
+    """
+    template = instances[0]
+    user_data, gzipped = fetch_user_data(ec2, template['InstanceId'])
+    user_data = template_user_data(user_data)
+    environment = user_data['environment']
+    use_dmz = environment.get('SUBNET_TYPE') == 'dmz'
+
+    volume = ec2.describe_volumes(
+        VolumeIds=[find_data_volume_id(ec2, template)]
+    )['Volumes'][0]
+
+    subnets = get_subnets('dmz-' if use_dmz else 'internal-', [region])[region]
+    return {
+        'template': template,
+        'user_data': user_data,
+        'gzip_user_data': gzipped,
+        'use_dmz': use_dmz,
+        'regions': environment['REGIONS'].split(),
+        'subnets': least_populated_subnets(subnets, instances, options['add']),
+        'ami': boto3.resource('ec2', region).Image(template['ImageId']),
+        'security_group_id': find_cluster_security_group(ec2, options['cluster_name'])['GroupId'],
+        'instance_type': template['InstanceType'],
+        'volume_type': volume['VolumeType'],
+        'volume_size': volume['Size'],
+        'volume_iops': volume.get('Iops'),
+        'volume_throughput': volume.get('Throughput'),
+        'no_termination_protection': not is_api_termination_disabled(ec2, template['InstanceId'])
+    }
+
+
+def group_by_subnet(subnets: list) -> list:
+    groups = collections.OrderedDict()
+    for s in subnets:
+        groups.setdefault(s['SubnetId'], []).append(s)
+    return list(groups.values())
+
+
+def allocate_region_ips(region: str, subnets: list, use_dmz: bool) -> list:
+    """
+    Returns a list of (ip, subnet) for the new nodes.  Addresses are
+    allocated per subnet, as generate_private_ip_addresses would otherwise
+    hand out the same address twice for a subnet listed twice.
+    """
+    result = []
+    for group in group_by_subnet(subnets):
+        node_ips = collections.defaultdict(list)
+        allocate_ip_addresses({region: group[:1]}, len(group), node_ips, use_dmz)
+        result.extend((ip, group[0]) for ip in node_ips[region])
+    return result
+
+
+def authorize_public_ips(cluster_name: str, regions: list, ips: list):
+    rules = make_public_ip_ingress_rules(ips)
+    for region in regions:
+        with Action('Authorizing new Elastic IPs in {}..'.format(region)):
+            ec2 = ec2_client(region)
+            sg = find_cluster_security_group(ec2, cluster_name)
+            ec2.authorize_security_group_ingress(GroupId=sg['GroupId'], IpPermissions=rules)
+
+
+def scale_out(options: dict):
+    cluster_name = options['cluster_name']
+    odd_hosts = options['odd_hosts']
+
+    region_instances = {}
+    region_options = {}
+    for region in odd_hosts:
+        ec2 = ec2_client(region)
+        instances = list(iter_instances(ec2, cluster_name, ['running']))
+        if not instances:
+            raise Exception("No running nodes of {} found in {}".format(cluster_name, region))
+        region_instances[region] = instances
+        region_options[region] = prepare_region(ec2, region, instances, options)
+
+    all_regions = next(iter(region_options.values()))['regions']
+    region_counts = {
+        region: len(list(iter_instances(ec2_client(region), cluster_name, ['running'])))
+        for region in all_regions
+    }
+    for region in odd_hosts:
+        region_counts[region] += options['add']
+
+    # system_auth should be replicated to every node
+    first_region = next(iter(odd_hosts))
+    if not run_cql(odd_hosts[first_region], region_instances[first_region][0]['PrivateIpAddress'],
+                   system_auth_replication(region_counts)):
+        raise Exception("Failed to raise the replication factor of system_auth")
+
+    new_ips = {}
+    for region, ro in region_options.items():
+        new_ips[region] = allocate_region_ips(region, ro['subnets'], ro['use_dmz'])
+
+    if any(ro['use_dmz'] for ro in region_options.values()):
+        authorize_public_ips(cluster_name, all_regions,
+                             [ip for ips in new_ips.values() for ip, _ in ips])
+
+    if options['sns_topic'] or options['sns_email']:
+        alarm_topics = setup_sns_topics_for_alarm(
+            list(odd_hosts), options['sns_topic'], options['sns_email']
+        )
+    else:
+        alarm_topics = {}
+    instance_profile = ensure_instance_profile(cluster_name)
+
+    with ExitStack() as stack:
+        region_urls = {
+            region: stack.enter_context(jolokia.tunnels(odd_hosts[region], instances))
+            for region, instances in region_instances.items()
+        }
+
+        for region, ips in new_ips.items():
+            ro = region_options[region]
+            user_data = dict(ro['user_data'])
+            user_data['environment'] = dict(
+                user_data['environment'],
+                CLUSTER_SIZE=region_counts[region],
+                SYSTEM_AUTH_REPLICATION=make_replication_map(region_counts)
+            )
+            launch_options = dict(
+                ro, cluster_name=cluster_name, user_data=user_data,
+                alarm_topics=alarm_topics, instance_profile=instance_profile
+            )
+            url = region_urls[region][ro['template']['PrivateIpAddress']]
+
+            for start in range(0, len(ips), options['join_concurrency']):
+                batch = ips[start:start + options['join_concurrency']]
+                for ip, subnet in batch:
+                    launch_instance(region, ip, ami=ro['ami'], subnet=subnet,
+                                    security_group_id=ro['security_group_id'],
+                                    is_seed=False, options=launch_options)
+                wait_for_join(url, {ip['_defaultIp'] for ip, _ in batch},
+                              options['join_timeout'])
+
+        sync_cluster_alarms(list(new_ips), cluster_name, alarm_topics)
+
+        if options['hosted_zone']:
+            node_ips = {
+                region: [{'PrivateIp': i['PrivateIpAddress']}
+                         for i in iter_instances(ec2_client(region), cluster_name, ['running'])]
+                for region in all_regions
+            }
+            setup_dns_records(cluster_name, options['hosted_zone'], node_ips)
+
+        nodes = [(i['PrivateIpAddress'], region_urls[region][i['PrivateIpAddress']])
+                 for region, instances in region_instances.items()
+                 for i in instances
+                 if i['PrivateIpAddress'] in region_urls[region]]
+        keyspaces = list_keyspaces(nodes[0][1])
+        info('Running cleanup on {} nodes..'.format(len(nodes)))
+        with ThreadPoolExecutor(max_workers=options['cleanup_concurrency']) as executor:
+            futures = [executor.submit(cleanup_node, ip, url, keyspaces,
+                                       options['max_pending_compactions'])
+                       for ip, url in nodes]
+            for f in futures:
+                f.result()
+
+    info('Cluster {} scaled out successfully!'.format(cluster_name))
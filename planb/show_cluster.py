@@ -1,4 +1,19 @@
-def show_instances(instances):
-    for i in instances:
-        f = "{InstanceId} {PrivateIpAddress}".format(**i)
+import sys
+
+from clickclick import print_table
+
+from .node_status import status_columns
+
+
+def show_region_instances(region_instances):
+    """
+    Prints (region, instance) pairs as they arrive.
+    """
+    for region, i in region_instances:
+        f = "{} {InstanceId} {PrivateIpAddress} {}".format(region, i.get('ElasticIp') or '-', **i)
         print(f)
+        sys.stdout.flush()
+
+
+def show_node_status(rows):
+    print_table(status_columns, rows)
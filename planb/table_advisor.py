@@ -0,0 +1,308 @@
+"""
+Per-table compaction and compression advisor.
+
+Table metrics are read in bulk from the Jolokia agents of all nodes, summed
+up or maxed out over the cluster, and turned into recommendations with the
+ALTER TABLE statements to apply them.  Counters are totals since the nodes
+were started, so the advice reflects the long term workload rather than
+the last few minutes.
+
+The recommendations are ranked by the estimated benefit weighted with the
+share of the cluster operations going to the table: a busy table with a
+moderate problem comes before an idle one with a big problem.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import collections
+import math
+import re
+
+from clickclick import print_table
+
+from . import jolokia
+from .inventory import stream_instances
+from .repair import system_keyspaces
+
+
+table_mbean = 'org.apache.cassandra.metrics:type=Table,keyspace=*,scope=*,name={}'
+settings_mbean = 'org.apache.cassandra.db:type=ColumnFamilies,keyspace=*,columnfamily=*'
+
+table_queries = [
+    {'type': 'read', 'mbean': table_mbean.format('ReadLatency'), 'attribute': 'Count'},
+    {'type': 'read', 'mbean': table_mbean.format('WriteLatency'), 'attribute': 'Count'},
+    {'type': 'read', 'mbean': table_mbean.format('SSTablesPerReadHistogram'),
+     'attribute': ['Mean', '99thPercentile']},
+    {'type': 'read', 'mbean': table_mbean.format('TombstoneScannedHistogram'),
+     'attribute': ['Mean', '99thPercentile']},
+    {'type': 'read', 'mbean': table_mbean.format('MeanPartitionSize'), 'attribute': 'Value'},
+    {'type': 'read', 'mbean': table_mbean.format('MaxPartitionSize'), 'attribute': 'Value'},
+    {'type': 'read', 'mbean': table_mbean.format('CompressionRatio'), 'attribute': 'Value'},
+    {'type': 'read', 'mbean': settings_mbean,
+     'attribute': ['CompactionParameters', 'CompressionParameters']},
+    {'type': 'read', 'mbean': 'org.apache.cassandra.db:type=StorageService', 'attribute': 'ReleaseVersion'},
+]
+
+# the Table metrics and the CompactionParameters attribute
+min_version = (3, 0)
+
+# tables serving less than this share of the reads are not worth leveled
+# compaction, nor smaller compression chunks
+min_read_share = 0.5
+
+# below this share of reads, the write amplification of leveled compaction
+# is not paid back
+max_read_share_leveled = 0.1
+
+# p99 SSTables touched by a read above which size-tiered compaction hurts
+max_sstables_per_read = 4
+
+# same as the tombstone_warn_threshold of cassandra.yaml
+max_tombstones_per_read = 1000
+
+# compressed size over uncompressed size above which compression is not
+# worth the CPU
+min_compression_gain = 0.9
+
+default_chunk_length = 64
+default_gc_grace_days = 10
+
+# short class names of the compaction strategies
+stcs = 'SizeTieredCompactionStrategy'
+lcs = 'LeveledCompactionStrategy'
+twcs = 'TimeWindowCompactionStrategy'
+
+
+def parse_version(version: str) -> tuple:
+    return tuple(int(n) for n in re.findall('\\d+', version)[:3])
+
+
+def has_twcs(version: tuple) -> bool:
+    """
+    TimeWindowCompactionStrategy came with 3.0.8 and 3.8.
+    """
+    return version >= (3, 8) or (3, 0, 8) <= version < (3, 1)
+
+
+def table_name(mbean: str) -> tuple:
+    keyspace = re.search('keyspace=([^,]+)', mbean).group(1)
+    table = re.search('(?:scope|columnfamily|table)=([^,]+)', mbean).group(1)
+    return keyspace, table
+
+
+def new_table_stats() -> dict:
+    return {
+        'reads': 0, 'writes': 0,
+        'sstables_p99': 0, 'tombstones_p99': 0,
+        'partition_sizes': [], 'max_partition': 0,
+        'compression_ratios': [],
+        'compaction': None, 'compression': None,
+    }
+
+
+def merge_node(tables: dict, values: list):
+    """
+    Adds the values read from one node to the cluster-wide stats by table.
+    """
+    reads, writes, sstables, tombstones, mean_size, max_size, ratio, settings = values[:8]
+
+    def each(result):
+        for mbean, v in (result or {}).items():
+            name = table_name(mbean)
+            if name[0] not in system_keyspaces:
+                yield tables.setdefault(name, new_table_stats()), v
+
+    for stats, v in each(reads):
+        stats['reads'] += v['Count']
+    for stats, v in each(writes):
+        stats['writes'] += v['Count']
+    for stats, v in each(sstables):
+        stats['sstables_p99'] = max(stats['sstables_p99'], v['99thPercentile'])
+    for stats, v in each(tombstones):
+        stats['tombstones_p99'] = max(stats['tombstones_p99'], v['99thPercentile'])
+    for stats, v in each(mean_size):
+        if v['Value'] > 0:
+            stats['partition_sizes'].append(v['Value'])
+    for stats, v in each(max_size):
+        stats['max_partition'] = max(stats['max_partition'], v['Value'])
+    for stats, v in each(ratio):
+        # -1 or 0 until the first compressed SSTable is written
+        if v['Value'] > 0:
+            stats['compression_ratios'].append(v['Value'])
+    for stats, v in each(settings):
+        stats['compaction'] = stats['compaction'] or v['CompactionParameters']
+        if stats['compression'] is None:
+            stats['compression'] = v['CompressionParameters']
+
+
+def mean(values: list) -> float:
+    return sum(values) / len(values) if values else 0
+
+
+def compaction_class(stats: dict) -> str:
+    return (stats['compaction'] or {}).get('class', '').split('.')[-1]
+
+
+def chunk_length(compression: dict) -> int:
+    """
+    Returns the compression chunk length in KiB, or None if compression is
+    disabled.  Cassandra 2.x calls it chunk_length_kb; unknown settings
+    are taken to be the defaults.
+    """
+    if compression is None:
+        return default_chunk_length
+    if compression.get('enabled') == 'false' or \
+            not compression.get('class', compression.get('sstable_compression')):
+        return None
+    value = compression.get('chunk_length_in_kb', compression.get('chunk_length_kb'))
+    return int(value) if value else default_chunk_length
+
+
+def compression_options(compression: dict, chunk: int) -> str:
+    """
+    Returns the CQL map of the current compression parameters with a new
+    chunk length, keeping the compressor and its other options.
+    """
+    key = 'chunk_length_kb' if 'sstable_compression' in compression else 'chunk_length_in_kb'
+    options = {k: v for k, v in compression.items() if k not in ('chunk_length_kb', 'chunk_length_in_kb')}
+    options[key] = chunk
+    return '{{{}}}'.format(', '.join(
+        "'{}': '{}'".format(k, str(v).replace("'", "''")) for k, v in options.items()
+    ))
+
+
+def suggested_chunk_length(partition_size: float) -> int:
+    """
+    Smallest power of two KiB holding a whole partition, from 4 to 64 KiB.
+    """
+    kib = max(partition_size / 1024, 1)
+    return int(min(max(2 ** math.ceil(math.log2(kib)), 4), default_chunk_length))
+
+
+def advise_table(name: tuple, stats: dict, repair_interval: int, repair_duration: int,
+                 version: tuple) -> list:
+    """
+    Returns the recommendations for one table as dicts with the setting,
+    current and recommended values, the reason, the benefit and the CQL.
+    """
+    operations = stats['reads'] + stats['writes']
+    if not operations:
+        return []
+    read_share = stats['reads'] / operations
+    table = '{}.{}'.format(*name)
+    strategy = compaction_class(stats)
+    result = []
+
+    def recommend(setting, current, recommended, reason, benefit, options):
+        result.append({
+            'table': table, 'setting': setting, 'current': current,
+            'recommended': recommended, 'reason': reason, 'benefit': benefit,
+            'cql': 'ALTER TABLE {} WITH {};'.format(table, options)
+        })
+
+    tombstone_heavy = stats['tombstones_p99'] > max_tombstones_per_read
+    if strategy == stcs and read_share >= min_read_share and \
+            stats['sstables_p99'] > max_sstables_per_read:
+        recommend('compaction', strategy, lcs,
+                  '{:.0%} reads touching up to {:.0f} SSTables'.format(read_share, stats['sstables_p99']),
+                  (stats['sstables_p99'] - 1) * read_share,
+                  "compaction = {{'class': '{}'}}".format(lcs))
+    elif strategy in (stcs, lcs) and read_share < min_read_share and tombstone_heavy and has_twcs(version):
+        recommend('compaction', strategy, twcs,
+                  'write-mostly with {:.0f} tombstones per read, '
+                  'if rows are written in time order with a TTL'.format(stats['tombstones_p99']),
+                  math.log10(stats['tombstones_p99']) * (1 - read_share),
+                  "compaction = {{'class': '{}', 'compaction_window_unit': 'DAYS', "
+                  "'compaction_window_size': 1}}".format(twcs))
+    elif strategy == lcs and read_share < max_read_share_leveled:
+        recommend('compaction', strategy, stcs,
+                  'only {:.0%} reads do not pay back the leveled write amplification'.format(read_share),
+                  3 * (1 - read_share),
+                  "compaction = {{'class': '{}'}}".format(stcs))
+
+    current_chunk = chunk_length(stats['compression'])
+    partition_size = mean(stats['partition_sizes'])
+    ratio = mean(stats['compression_ratios'])
+    if current_chunk and ratio > min_compression_gain:
+        recommend('compression', '{:.2f} ratio'.format(ratio), 'disabled',
+                  'compression saves only {:.0%} of the disk space'.format(1 - ratio),
+                  ratio - min_compression_gain + 0.5,
+                  "compression = {'enabled': 'false'}")
+    elif current_chunk and stats['compression'] and partition_size and read_share >= min_read_share:
+        chunk = suggested_chunk_length(partition_size)
+        if chunk < current_chunk:
+            recommend('chunk_length_in_kb', current_chunk, chunk,
+                      'mean partition of {:.1f} KiB decompresses {} KiB per read'.format(
+                          partition_size / 1024, current_chunk),
+                      math.log2(current_chunk / chunk) * read_share,
+                      'compression = {}'.format(compression_options(stats['compression'], chunk)))
+
+    # gc_grace_seconds is not exposed over JMX, the default is assumed.  It
+    # must cover the repair interval plus the time a repair of the whole
+    # cluster takes, or deleted data can come back.
+    gc_grace_days = repair_interval + repair_duration + 1
+    if tombstone_heavy and gc_grace_days < default_gc_grace_days:
+        recommend('gc_grace_seconds', '{}d (assumed)'.format(default_gc_grace_days), '{}d'.format(gc_grace_days),
+                  '{:.0f} tombstones per read, repairs every {} days taking {} days, '
+                  'if gc_grace_seconds is the default'.format(
+                      stats['tombstones_p99'], repair_interval, repair_duration),
+                  math.log10(stats['tombstones_p99'] / max_tombstones_per_read) + 1,
+                  'gc_grace_seconds = {}'.format(gc_grace_days * 86400))
+    return result
+
+
+def advise(tables: dict, repair_interval: int, repair_duration: int, version: tuple) -> list:
+    """
+    Returns the recommendations for all tables, most valuable first.
+    """
+    total = sum(s['reads'] + s['writes'] for s in tables.values())
+    result = []
+    for name, stats in tables.items():
+        share = (stats['reads'] + stats['writes']) / total if total else 0
+        for r in advise_table(name, stats, repair_interval, repair_duration, version):
+            result.append(dict(r, score=r['benefit'] * share))
+    return sorted(result, key=lambda r: r['score'], reverse=True)
+
+
+def collect_table_stats(options: dict) -> tuple:
+    """
+    Returns the stats by table and the oldest Cassandra version of the nodes.
+    """
+    region_instances = collections.defaultdict(list)
+    for region, i in stream_instances(options['cluster_name'], list(options['odd_hosts']), ['running']):
+        region_instances[region].append(i)
+
+    with ExitStack() as stack:
+        urls = []
+        for region, instances in region_instances.items():
+            urls.extend(stack.enter_context(
+                jolokia.tunnels(options['odd_hosts'][region], instances)
+            ).values())
+        with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+            results = list(executor.map(lambda url: jolokia.query(url, table_queries, timeout=30), urls))
+
+    versions = [parse_version(values[-1]) for values in results if values and values[-1]]
+    if not versions:
+        raise Exception('Cannot read the Cassandra version of any node of {}'.format(options['cluster_name']))
+    version = min(versions)
+    if version < min_version:
+        raise Exception('advise-tables needs Cassandra {}.{} or newer, {} runs {}'.format(
+            *min_version, options['cluster_name'], '.'.join(map(str, version))))
+
+    tables = {}
+    for values in results:
+        if values:
+            merge_node(tables, values)
+    return tables, version
+
+
+def run_advise_tables(options: dict):
+    tables, version = collect_table_stats(options)
+    recommendations = advise(tables, options['repair_interval'], options['repair_duration'], version)[:options['top']]
+    if not recommendations:
+        print('No recommendations for the {} tables of {}'.format(len(tables), options['cluster_name']))
+        return
+    rows = [dict(r, rank=rank) for rank, r in enumerate(recommendations, 1)]
+    print_table(['rank', 'table', 'setting', 'current', 'recommended', 'reason'], rows)
+    print()
+    for rank, r in enumerate(recommendations, 1):
+        print('{}: {}'.format(rank, r['cql']))
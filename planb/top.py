@@ -0,0 +1,259 @@
+"""
+Live, rate-based dashboard of a cluster.
+
+Counters are read from the Jolokia agents of all nodes every few seconds and
+rates are computed as deltas between consecutive samples.  Only a fixed
+number of samples is kept per node, so memory stays flat however long the
+dashboard is running.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import collections
+import time
+import sys
+import re
+
+from clickclick import print_table
+
+from . import jolokia
+from .inventory import stream_instances
+
+
+latency_mbean = 'org.apache.cassandra.metrics:type=ClientRequest,scope={},name=Latency'
+table_mbean = 'org.apache.cassandra.metrics:type=Table,keyspace=*,scope=*,name={}'
+
+node_queries = [
+    {'type': 'read', 'mbean': latency_mbean.format('Read'),
+     'attribute': ['Count', '99thPercentile']},
+    {'type': 'read', 'mbean': latency_mbean.format('Write'),
+     'attribute': ['Count', '99thPercentile']},
+    {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=Compaction,name=BytesCompacted',
+     'attribute': 'Count'},
+    {'type': 'read', 'mbean': 'java.lang:type=GarbageCollector,name=*',
+     'attribute': 'CollectionTime'},
+    {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=Streaming,name=TotalIncomingBytes',
+     'attribute': 'Count'},
+    {'type': 'read', 'mbean': 'org.apache.cassandra.metrics:type=Streaming,name=TotalOutgoingBytes',
+     'attribute': 'Count'},
+    {'type': 'read', 'mbean': table_mbean.format('ReadLatency'), 'attribute': 'Count'},
+    {'type': 'read', 'mbean': table_mbean.format('WriteLatency'), 'attribute': 'Count'},
+    {'type': 'read', 'mbean': 'org.apache.cassandra.net:type=FailureDetector',
+     'attribute': 'DownEndpointCount'}
+]
+
+# compact per-node sample as kept in the ring buffers
+NodeSample = collections.namedtuple(
+    'NodeSample',
+    ['time', 'reads', 'read_p99', 'writes', 'write_p99',
+     'compacted', 'gc_ms', 'stream_in', 'stream_out']
+)
+
+# counters which are turned into rates, everything else is a gauge
+rate_fields = ['reads', 'writes', 'compacted', 'gc_ms', 'stream_in', 'stream_out']
+
+
+def table_name(mbean: str) -> tuple:
+    keyspace = re.search('keyspace=([^,]+)', mbean).group(1)
+    table = re.search('scope=([^,]+)', mbean).group(1)
+    return keyspace, table
+
+
+def parse_sample(timestamp: float, values: list) -> tuple:
+    """
+    Returns a NodeSample and a dict of (reads, writes) counters by table.
+    """
+    read, write, compacted, gc, stream_in, stream_out, table_reads, table_writes = values[:8]
+    sample = NodeSample(
+        time=timestamp,
+        reads=read['Count'],
+        read_p99=read['99thPercentile'],
+        writes=write['Count'],
+        write_p99=write['99thPercentile'],
+        compacted=compacted,
+        gc_ms=sum(v['CollectionTime'] for v in gc.values()),
+        stream_in=stream_in,
+        stream_out=stream_out
+    )
+    tables = collections.defaultdict(lambda: [0, 0])
+    for mbean, v in (table_reads or {}).items():
+        tables[table_name(mbean)][0] = v['Count']
+    for mbean, v in (table_writes or {}).items():
+        tables[table_name(mbean)][1] = v['Count']
+    return sample, {k: tuple(v) for k, v in tables.items()}
+
+
+def rates(prev: NodeSample, cur: NodeSample) -> dict:
+    """
+    Per second rates of the counters between two samples.  Counters going
+    down mean the node was restarted, those rates are unknown.
+    """
+    dt = cur.time - prev.time
+    if dt <= 0:
+        return {}
+    result = {}
+    for f in rate_fields:
+        delta = getattr(cur, f) - getattr(prev, f)
+        result[f] = delta / dt if delta >= 0 else None
+    return result
+
+
+def table_rates(prev: tuple, cur: tuple) -> dict:
+    """
+    Per second read/write rates by table between two (time, tables) samples.
+    """
+    dt = cur[0] - prev[0]
+    result = {}
+    if dt <= 0:
+        return result
+    for name, (reads, writes) in cur[1].items():
+        if name in prev[1]:
+            prev_reads, prev_writes = prev[1][name]
+            result[name] = (max(reads - prev_reads, 0) / dt,
+                            max(writes - prev_writes, 0) / dt)
+    return result
+
+
+class NodeHistory:
+    """
+    Ring buffer of the last samples of a node.  Tables counters are only
+    kept for the last two samples, as they are only needed for the rates.
+    """
+
+    def __init__(self, size: int):
+        self.samples = collections.deque(maxlen=size)
+        self.tables = collections.deque(maxlen=2)
+
+    def append(self, sample: NodeSample, tables: dict):
+        self.samples.append(sample)
+        self.tables.append((sample.time, tables))
+
+    def current_rates(self) -> dict:
+        if len(self.samples) < 2:
+            return {}
+        return rates(self.samples[-2], self.samples[-1])
+
+    def average_rates(self) -> dict:
+        if len(self.samples) < 2:
+            return {}
+        return rates(self.samples[0], self.samples[-1])
+
+    def current_table_rates(self) -> dict:
+        if len(self.tables) < 2:
+            return {}
+        return table_rates(self.tables[0], self.tables[1])
+
+
+def format_rate(value: float, scale: float = 1, fmt: str = '{:.0f}') -> str:
+    if value is None:
+        return None
+    return fmt.format(value / scale)
+
+
+def node_rows(histories: dict) -> list:
+    rows = []
+    for (region, ip), history in sorted(histories.items()):
+        row = {'region': region, 'ip': ip}
+        if not history.samples:
+            rows.append(dict(row, reads='?'))
+            continue
+        last = history.samples[-1]
+        cur = history.current_rates()
+        avg = history.average_rates()
+        rows.append(dict(
+            row,
+            reads=format_rate(cur.get('reads')),
+            writes=format_rate(cur.get('writes')),
+            avg_reads=format_rate(avg.get('reads')),
+            avg_writes=format_rate(avg.get('writes')),
+            read_p99='{:.1f}'.format(last.read_p99 / 1000),
+            write_p99='{:.1f}'.format(last.write_p99 / 1000),
+            compaction=format_rate(cur.get('compacted'), 1024 ** 2, '{:.1f}'),
+            gc=format_rate(cur.get('gc_ms'), 10, '{:.1f}%'),
+            stream_in=format_rate(cur.get('stream_in'), 1024 ** 2, '{:.1f}'),
+            stream_out=format_rate(cur.get('stream_out'), 1024 ** 2, '{:.1f}')
+        ))
+    return rows
+
+
+def top_table_rows(histories: dict, limit: int) -> list:
+    totals = collections.defaultdict(lambda: [0, 0])
+    for history in histories.values():
+        for name, (reads, writes) in history.current_table_rates().items():
+            totals[name][0] += reads
+            totals[name][1] += writes
+    ranked = sorted(totals.items(), key=lambda t: t[1][0] + t[1][1], reverse=True)
+    return [
+        {'table': '{}.{}'.format(*name), 'reads': '{:.0f}'.format(r), 'writes': '{:.0f}'.format(w)}
+        for name, (r, w) in ranked[:limit]
+    ]
+
+
+node_columns = ['region', 'ip', 'reads', 'writes', 'avg_reads', 'avg_writes',
+                'read_p99', 'write_p99', 'compaction', 'gc', 'stream_in', 'stream_out']
+node_titles = {
+    'reads': 'Reads/s', 'writes': 'Writes/s',
+    'avg_reads': 'Avg Reads/s', 'avg_writes': 'Avg Writes/s',
+    'read_p99': 'Read p99 ms', 'write_p99': 'Write p99 ms',
+    'compaction': 'Compaction MiB/s', 'gc': 'GC',
+    'stream_in': 'Stream in MiB/s', 'stream_out': 'Stream out MiB/s'
+}
+
+
+def render(cluster_name: str, histories: dict, down_count: int, tables: int):
+    sys.stdout.write('\x1b[H\x1b[2J')
+    print('{} - {} - DownEndpointCount: {}'.format(
+        cluster_name, time.strftime('%Y-%m-%d %H:%M:%S'),
+        '?' if down_count is None else down_count
+    ))
+    print()
+    print_table(node_columns, node_rows(histories), titles=node_titles)
+    print()
+    print_table(['table', 'reads', 'writes'], top_table_rows(histories, tables),
+                titles={'reads': 'Reads/s', 'writes': 'Writes/s'})
+    sys.stdout.flush()
+
+
+def sample_nodes(urls: dict, histories: dict) -> int:
+    """
+    Appends a new sample to the history of every node that can be read,
+    returns the highest DownEndpointCount seen by any node.
+    """
+    def read(key):
+        return jolokia.query(urls[key], node_queries)
+
+    keys = list(urls)
+    with ThreadPoolExecutor(max_workers=max(len(keys), 1)) as executor:
+        results = list(executor.map(read, keys))
+    now = time.time()
+    down_counts = []
+    for key, values in zip(keys, results):
+        if values and None not in values[:6]:
+            sample, tables = parse_sample(now, values)
+            histories[key].append(sample, tables)
+        if values and values[8] is not None:
+            down_counts.append(values[8])
+    return max(down_counts) if down_counts else None
+
+
+def run_top(options: dict):
+    region_instances = collections.defaultdict(list)
+    for region, i in stream_instances(options['cluster_name'], list(options['odd_hosts']), ['running']):
+        region_instances[region].append(i)
+
+    with ExitStack() as stack:
+        urls = {}
+        for region, instances in region_instances.items():
+            region_urls = stack.enter_context(
+                jolokia.tunnels(options['odd_hosts'][region], instances)
+            )
+            urls.update({(region, ip): url for ip, url in region_urls.items()})
+
+        histories = {key: NodeHistory(options['history']) for key in urls}
+        try:
+            while True:
+                started = time.time()
+                down_count = sample_nodes(urls, histories)
+                render(options['cluster_name'], histories, down_count, options['tables'])
+                time.sleep(max(options['interval'] - (time.time() - started), 0))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,61 @@
+"""
+Undo journal of the resources created by a command.
+
+Every step that creates something pushes the action deleting it again.  On
+failure the journal is unwound level by level: a resource is only deleted
+once everything depending on it is gone, e.g. security groups and volumes
+after the instances using them.  The actions of one level run in parallel,
+across all regions.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import logging
+
+from clickclick import info
+
+
+logger = logging.getLogger(__name__)
+
+# kinds of resources in the order they are undone
+levels = [
+    ['instance', 'alarm', 'dns', 'subscription'],
+    ['volume', 'address', 'security_group', 'parameter', 'instance_profile'],
+]
+
+kind_levels = {kind: i for i, kinds in enumerate(levels) for kind in kinds}
+
+UndoAction = collections.namedtuple('UndoAction', ['kind', 'region', 'description', 'action', 'args'])
+
+
+class UndoStack:
+
+    def __init__(self):
+        self.actions = []
+
+    def push(self, kind: str, region: str, description: str, action, *args):
+        if kind not in kind_levels:
+            raise Exception('Unknown kind of resource: {}'.format(kind))
+        self.actions.append(UndoAction(kind, region, description, action, args))
+
+    def run(self, undo: UndoAction) -> UndoAction:
+        info('Deleting {} in {}..'.format(undo.description, undo.region))
+        try:
+            undo.action(*undo.args)
+        except Exception as e:
+            logger.warning('Failed to delete {} in {}: {}'.format(undo.description, undo.region, e))
+            return undo
+        return None
+
+    def unwind(self) -> list:
+        """
+        Undoes all actions, and returns those which failed.
+        """
+        failed = []
+        for level in range(len(levels)):
+            batch = [a for a in reversed(self.actions) if kind_levels[a.kind] == level]
+            if not batch:
+                continue
+            with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+                failed.extend(f for f in executor.map(self.run, batch) if f)
+        self.actions = []
+        return failed
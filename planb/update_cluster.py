@@ -1,24 +1,27 @@
 # update_cluster
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import subprocess
+import threading
 import requests
 import logging
-import base64
 import click
-import yaml
 import time
 import sys
 import re
-import io
 import os
 
 # TODO: can we avoid the explicit list here?
-from .common import ec2_client, \
-    dump_dict_as_file, load_dict_from_file, \
-    dump_user_data_for_taupage, list_instances, \
+from .common import ec2_client, load_dict_from_file, \
+    dump_user_data_for_taupage, decode_user_data, list_instances, \
+    store_secret_parameters, ensure_secrets_policy, \
     override_ephemeral_block_devices, \
-    setup_sns_topics_for_alarm, create_auto_recovery_alarm, \
-    ensure_instance_profile
+    setup_sns_topics_for_alarm, ensure_instance_profile
+from .alarms import sync_alarms, sync_cluster_alarms
+from .create_cluster import describe_instance_type, scylla_environment
+from .jolokia import jolokia_url, make_jolokia_url, find_free_local_port, \
+    ssh_command_works, open_ssh_tunnel
+from . import jolokia, journal, canary
 
 
 """
@@ -29,16 +32,52 @@ in every state transition to make sure we have the most recent data.
 
 logger = logging.getLogger(__name__)
 
-# TODO: may be this port is occupied?
-local_jolokia_port = 8778
-remote_jolokia_port = 8778
-jolokia_url = "http://localhost:{}/jolokia/".format(local_jolokia_port)
+tuned_environment_tag = 'planb:tuned-environment'
+
+keystore_variables = ['KEYSTORE', 'TRUSTSTORE']
 
 
 class ClusterUnhealthyException(Exception):
     pass
 
 
+class ClusterHealthGate:
+    """
+    Cluster-wide health gate shared by all nodes being updated at the same
+    time, in any region.  The cluster is considered healthy as long as the
+    only DOWN endpoints are the nodes currently being updated.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = set()
+
+    def unexpected_down(self, status: dict, exclude: set = frozenset()) -> set:
+        down = down_endpoints(status)
+        if down is None:
+            return None
+        return down - (self.in_flight - exclude)
+
+    def try_enter(self, ips: set, status: dict) -> bool:
+        with self.lock:
+            if self.unexpected_down(status) != set():
+                return False
+            self.in_flight |= ips
+            return True
+
+    def enter(self, ips: set):
+        with self.lock:
+            self.in_flight |= ips
+
+    def leave(self, ips: set):
+        with self.lock:
+            self.in_flight -= ips
+
+    def is_idle(self) -> bool:
+        with self.lock:
+            return not self.in_flight
+
+
 def text_timestamp():
     return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
@@ -67,6 +106,20 @@ def update_tags(ec2: object, resource_id: str, tags: dict):
     )
 
 
+def tuned_environment(instance: dict) -> dict:
+    """
+    Settings tuned on the running node are kept in a tag of the instance,
+    as space separated NAME=value pairs, until an update writes them into
+    the user data of the new instance.
+    """
+    value = tags_as_dict(instance.get('Tags', [])).get(tuned_environment_tag, '')
+    return dict(pair.split('=', 1) for pair in value.split())
+
+
+def format_tuned_environment(environment: dict) -> str:
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(environment.items()))
+
+
 def set_state(ec2: object, volume: dict, state: str):
     update_tags(ec2, volume['VolumeId'], {'planb:operation:state': state})
 
@@ -129,15 +182,19 @@ def find_instance_from_volume(
     return get_instance(ec2, instance_id)
 
 
-def get_user_data(ec2: object, instance_id: str) -> dict:
+def fetch_user_data(ec2: object, instance_id: str) -> tuple:
+    """
+    Returns the user data of the instance and whether it is gzipped.
+    """
     resp = ec2.describe_instance_attribute(
         InstanceId=instance_id,
         Attribute='userData'
     )
-    raw_bytes = base64.b64decode(resp['UserData']['Value'])
-    data = str(raw_bytes, 'UTF-8')
-    stream = io.StringIO(data)
-    return yaml.safe_load(stream)
+    return decode_user_data(resp['UserData']['Value'])
+
+
+def get_user_data(ec2: object, instance_id: str) -> dict:
+    return fetch_user_data(ec2, instance_id)[0]
 
 
 def is_api_termination_disabled(ec2: object, instance_id: str) -> dict:
@@ -148,23 +205,45 @@ def is_api_termination_disabled(ec2: object, instance_id: str) -> dict:
     return resp['DisableApiTermination']['Value']
 
 
-def instance_filename(volume: dict):
-    return "{}.json".format(volume['VolumeId'])
-
-
 def list_instance_dump_files() -> list:
+    """
+    Lists instance data dump files left in the current directory by older
+    versions, which kept the saved instance spec there instead of the journal.
+    """
     return [x
             for x in os.listdir()
             if re.match('^vol-\w+\.json$', x)]
 
 
-def get_cluster_status() -> dict:
+def import_instance_dump_files(ec2: object, db: object, cluster_name: str, region: str):
+    """
+    Imports the dump files of the volumes found in the region.  The files do
+    not tell the region of their volume, those of other regions are left for
+    the region they belong to.
+    """
+    volume_ids = {filename[:-len('.json')]: filename for filename in list_instance_dump_files()}
+    if not volume_ids:
+        return
+    # a filter, unlike VolumeIds, does not fail on the volumes of other regions
+    resp = ec2.describe_volumes(Filters=[{'Name': 'volume-id', 'Values': sorted(volume_ids)}])
+    for volume in resp['Volumes']:
+        volume_id = volume['VolumeId']
+        filename = volume_ids[volume_id]
+        journal.start_operation(db, cluster_name, region, volume_id, 'update')
+        if not journal.load_instance(db, region, volume_id):
+            journal.save_instance(db, region, volume_id,
+                                  load_dict_from_file(filename))
+        logger.info("Imported {} into the journal".format(filename))
+        os.unlink(filename)
+
+
+def get_cluster_status(url: str = jolokia_url) -> dict:
     try:
         queries = [{
             'mbean': 'org.apache.cassandra.net:type=FailureDetector',
             'type': 'read'
         }]
-        response = requests.post(jolokia_url, json=queries).json()
+        response = requests.post(url, json=queries).json()
         if len(response) == 1:
             return response[0].get('value', {})
         return {}
@@ -172,10 +251,26 @@ def get_cluster_status() -> dict:
         return {}
 
 
-def prepare_update(ec2: object, volume: dict, options: dict):
-    if get_cluster_status().get('DownEndpointCount') != 0:
-        raise ClusterUnhealthyException()
+def down_endpoints(status: dict) -> set:
+    """
+    Returns the addresses of DOWN endpoints, or None if status is unknown.
+    """
+    if 'SimpleStates' not in status:
+        return None
+    return {
+        endpoint.split('/')[-1]
+        for endpoint, state in status['SimpleStates'].items()
+        if state != 'UP'
+    }
+
 
+def instance_ips(instance: dict) -> set:
+    return {instance[k]
+            for k in ['PrivateIpAddress', 'PublicIpAddress']
+            if k in instance}
+
+
+def prepare_update(ec2: object, volume: dict, options: dict):
     instance = find_instance_from_volume(ec2, volume)
     if not instance:
         set_error_state(
@@ -184,19 +279,34 @@ def prepare_update(ec2: object, volume: dict, options: dict):
         )
         return
 
+    gate = options['health_gate']
+    status = get_cluster_status(options['jolokia_url'])
+    if not gate.try_enter(instance_ips(instance), status):
+        if gate.is_idle():
+            raise ClusterUnhealthyException()
+        logger.info(
+            "Some nodes are DOWN, waiting to update {}"
+            .format(instance['PrivateIpAddress'])
+        )
+        return
+
     instance_id = instance['InstanceId']
     disable_api_termination = is_api_termination_disabled(ec2, instance_id)
+    in_place = is_in_place_update(options)
 
-    instance_dump_file = instance_filename(volume)
-    if not os.path.exists(instance_dump_file):
-        instance_to_dump = dict(
+    db = options['journal']
+    if not journal.load_instance(db, options['region'], volume['VolumeId']):
+        user_data, gzipped = fetch_user_data(ec2, instance_id)
+        instance_to_save = dict(
             instance,
-            UserData=get_user_data(ec2, instance_id),
+            UserData=user_data,
+            UserDataGzipped=gzipped,
             DisableApiTermination=disable_api_termination
         )
-        dump_dict_as_file(instance_to_dump, instance_dump_file)
+        journal.save_instance(db, options['region'], volume['VolumeId'],
+                              instance_to_save)
 
-    if disable_api_termination:
+    if disable_api_termination and not in_place:
         if options['force_termination']:
             ec2.modify_instance_attribute(
                 InstanceId=instance_id,
@@ -207,13 +317,76 @@ def prepare_update(ec2: object, volume: dict, options: dict):
             set_error_state(ec2, volume, "API termination is disabled")
             return
 
-    set_state(ec2, volume, 'prepared')
+    update_tags(ec2, volume['VolumeId'], {
+        'planb:operation:state': 'prepared',
+        'planb:operation:mode': 'in-place' if in_place else 'replace'
+    })
+
+
+def is_in_place_update(options: dict) -> bool:
+    """
+    Only a change of the Docker image can be applied by restarting the
+    instance with updated user data: a new AMI or instance type requires
+    launching a new instance.
+    """
+    return bool(options.get('docker_image')) and \
+        not options.get('taupage_ami_id') and \
+        not options.get('instance_type')
+
 
+def list_keyspaces(url: str = jolokia_url) -> list:
+    response = requests.post(
+        url,
+        json=[{
+            'mbean': 'org.apache.cassandra.db:type=StorageService',
+            'type': 'read',
+            'attribute': 'Keyspaces'
+        }]
+    ).json()
+    return response[0].get('value', [])
+
+
+def flush_cassandra(url: str = jolokia_url):
+    """
+    Flush memtables of all keyspaces while the node is still serving
+    requests, so that the following drain has little left to do.
+    """
+    queries = [{
+        'mbean': 'org.apache.cassandra.db:type=StorageService',
+        'type': 'exec',
+        'operation': 'forceKeyspaceFlush(java.lang.String,[Ljava.lang.String;)',
+        'arguments': [keyspace, []]
+    } for keyspace in list_keyspaces(url)]
+    if queries:
+        requests.post(url, json=queries)
+
+
+def pull_docker_image(odd_host: str, ip_address: str, docker_image: str) -> bool:
+    cmd = ['ssh', odd_host, 'ssh', ip_address, 'docker', 'pull', docker_image]
+    logger.info("Pulling Docker image: {}".format(" ".join(cmd)))
+    return subprocess.call(cmd) == 0
+
+
+def pre_drain_node(ec2: object, volume: dict, saved_instance: dict,
+                   options: dict):
+    tags = tags_as_dict(volume.get('Tags', []))
+    if tags.get('planb:operation:mode') == 'in-place':
+        ip_address = saved_instance['PrivateIpAddress']
+        if not pull_docker_image(options['odd_host'], ip_address,
+                                 options['docker_image']):
+            logger.warning(
+                "Failed to pre-pull Docker image on {}".format(ip_address)
+            )
 
-def drain_cassandra():
+    logger.info("Flushing node {}".format(saved_instance['PrivateIpAddress']))
+    flush_cassandra(options['jolokia_url'])
+    set_state(ec2, volume, 'flushed')
+
+
+def drain_cassandra(url: str = jolokia_url):
     # TODO: what about timeout?
     requests.post(
-        jolokia_url,
+        url,
         json=[{
             'mbean': 'org.apache.cassandra.db:type=StorageService',
             'type': 'exec',
@@ -222,10 +395,39 @@ def drain_cassandra():
     )
 
 
-def drain_node(ec2: object, volume: dict, saved_instance: dict):
+def get_operation_mode(url: str = jolokia_url) -> str:
+    values = jolokia.query(url, [{
+        'mbean': 'org.apache.cassandra.db:type=StorageService',
+        'type': 'read',
+        'attribute': 'OperationMode'
+    }])
+    return values[0] if values else None
+
+
+def wait_drained(url: str = jolokia_url, timeout: int = 300) -> bool:
+    """
+    Scylla drains asynchronously behind its JMX proxy, so the drain call
+    may return before the node is done.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if get_operation_mode(url) == 'DRAINED':
+            return True
+        time.sleep(5)
+    return False
+
+
+def drain_node(ec2: object, volume: dict, saved_instance: dict,
+               options: dict):
     logger.info("Draining node {}".format(saved_instance['PrivateIpAddress']))
-    drain_cassandra()
-    set_state(ec2, volume, 'drained')
+    drain_cassandra(options['jolokia_url'])
+    if not wait_drained(options['jolokia_url']):
+        logger.warning("Node {} did not report DRAINED, proceeding anyway"
+                       .format(saved_instance['PrivateIpAddress']))
+    update_tags(ec2, volume['VolumeId'], {
+        'planb:operation:state': 'drained',
+        'planb:operation:drain-time': text_timestamp()
+    })
 
 
 def terminate_instance(ec2: object, volume: dict, saved_instance: dict):
@@ -246,6 +448,78 @@ def terminate_instance(ec2: object, volume: dict, saved_instance: dict):
         raise Exception("Unexpected state of {}: {}".format(instance_id, state))
 
 
+def stop_instance(ec2: object, volume: dict, saved_instance: dict):
+    instance_id = saved_instance['InstanceId']
+    instance = get_instance(ec2, instance_id)
+    if not instance:
+        set_error_state(ec2, volume, "Instance {} not found".format(instance_id))
+        return
+    state = instance['State']['Name']
+    if state == 'running':
+        logger.info("Stopping instance {}".format(instance_id))
+        ec2.stop_instances(InstanceIds=[instance_id])
+    elif state == 'stopping':
+        logger.info("Instance {} is still stopping".format(instance_id))
+    elif state == 'stopped':
+        set_state(ec2, volume, 'stopped')
+    else:
+        raise Exception("Unexpected state of {}: {}".format(instance_id, state))
+
+
+def start_instance(ec2: object, volume: dict, saved_instance: dict,
+                   options: dict):
+    instance_id = saved_instance['InstanceId']
+    user_data = build_user_data(saved_instance, options)
+
+    logger.info("Updating user data and starting instance {}".format(instance_id))
+    data = dump_user_data_for_taupage(user_data, saved_instance.get('UserDataGzipped', False))
+    ec2.modify_instance_attribute(
+        InstanceId=instance_id,
+        UserData={'Value': data if isinstance(data, bytes) else data.encode('UTF-8')}
+    )
+    ec2.start_instances(InstanceIds=[instance_id])
+    set_state(ec2, volume, 'started')
+
+
+def wait_instance_running(ec2: object, volume: dict, saved_instance: dict):
+    instance_id = saved_instance['InstanceId']
+    instance = get_instance(ec2, instance_id)
+    state = instance['State']['Name']
+    if state == 'running':
+        set_state(ec2, volume, 'configured')
+    elif state == 'pending':
+        logger.info("Instance {} is still pending".format(instance_id))
+    else:
+        raise Exception("Unexpected state of {}: {}".format(instance_id, state))
+
+
+def build_user_data(saved_instance: dict, options: dict) -> dict:
+    user_data_changes = {
+        'volumes': {
+            'ebs': {
+                '/dev/xvdf': "{}-{}".format(options['cluster_name'],
+                                            saved_instance['PrivateIpAddress'])
+            }
+        }
+    }
+    docker_image = options.get('docker_image')
+    if docker_image:
+        user_data_changes['source'] = docker_image
+    environment = dict(saved_instance['UserData'].get('environment', {}),
+                       **tuned_environment(saved_instance))
+    if options.get('keystore_parameters') and 'KEYSTORE' in environment:
+        # nodes fetch the keystores from SSM instead
+        environment = {k: v for k, v in environment.items() if k not in keystore_variables}
+        environment.update(options['keystore_parameters'])
+    if 'SCYLLA_SMP' in environment and options.get('instance_type'):
+        # shards must match the cores of the new instance type
+        instance_type = describe_instance_type(options['region'], options['instance_type'])
+        environment.update(scylla_environment(instance_type))
+    if environment:
+        user_data_changes['environment'] = environment
+    return dict(saved_instance['UserData'], **user_data_changes)
+
+
 def build_run_instances_params(
         ec2: object, volume: dict, saved_instance: dict, options: dict) -> dict:
 
@@ -286,25 +560,15 @@ def build_run_instances_params(
     mappings = override_ephemeral_block_devices(image['BlockDeviceMappings'])
     params['BlockDeviceMappings'] = mappings
 
-    user_data_changes = {
-        'volumes': {
-            'ebs': {
-                '/dev/xvdf': "{}-{}".format(options['cluster_name'],
-                                            saved_instance['PrivateIpAddress'])
-            }
-        }
-    }
-    docker_image = options.get('docker_image')
-    if docker_image:
-        user_data_changes['source'] = docker_image
-    params['UserData'].update(user_data_changes)
+    params['UserData'] = build_user_data(saved_instance, options)
     return params
 
 
 def create_instance(ec2: object, volume: dict, saved_instance: dict,
                     options: dict):
     params = build_run_instances_params(ec2, volume, saved_instance, options)
-    params['UserData'] = dump_user_data_for_taupage(params['UserData'])
+    params['UserData'] = dump_user_data_for_taupage(params['UserData'],
+                                                    saved_instance.get('UserDataGzipped', False))
 
     logger.info(
         "Creating new instance with IP {}".format(params['PrivateIpAddress'])
@@ -352,23 +616,35 @@ def configure_instance(ec2: object, volume: dict, saved_instance: dict,
     if options['alarm_topics']:
         alarm_sns_topic_arn = options['alarm_topics'][region]
 
-    create_auto_recovery_alarm(
-        region,
-        options['cluster_name'],
-        instance_id,
-        alarm_sns_topic_arn
-    )
+    # puts the alarm of the new instance, and deletes that of the old one
+    sync_alarms(region, options['cluster_name'], alarm_sns_topic_arn)
 
     # TODO: we should have another transition to wait for Cassandra to
     # jump to Normal, before declaring it complete
     set_state(ec2, volume, 'configured')
 
 
-def check_node_status(ec2: object, volume: dict):
-    down_count = get_cluster_status().get('DownEndpointCount')
-    logger.info("DownEndpointCount: {}".format(down_count))
-    if down_count == 0:
-        set_state(ec2, volume, 'completed')
+def parse_timestamp(text: str) -> datetime:
+    return datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def check_node_status(ec2: object, volume: dict, saved_instance: dict,
+                      options: dict):
+    status = get_cluster_status(options['jolokia_url'])
+    logger.info("DownEndpointCount: {}".format(status.get('DownEndpointCount')))
+    unexpected_down = options['health_gate'].unexpected_down(
+        status, exclude=instance_ips(saved_instance)
+    )
+    if unexpected_down == set():
+        new_tags = {'planb:operation:state': 'completed'}
+
+        drain_time = tags_as_dict(volume.get('Tags', [])).get('planb:operation:drain-time')
+        if drain_time:
+            downtime = datetime.utcnow() - parse_timestamp(drain_time)
+            new_tags['planb:operation:downtime'] = str(int(downtime.total_seconds()))
+            logger.info("Node was down for {} seconds".format(new_tags['planb:operation:downtime']))
+
+        update_tags(ec2, volume['VolumeId'], new_tags)
 
 
 def cleanup_state(ec2: object, volume: dict):
@@ -388,18 +664,36 @@ def step_forward(ec2: object, volume_id: str, options: dict):
             "Volume {} not prepared for operation 'update'".format(volume_id)
         )
 
-    saved_instance = load_dict_from_file(instance_filename(volume))
+    db = options['journal']
+    saved_instance = journal.load_instance(db, options['region'], volume_id)
 
     state = tags.get('planb:operation:state')
     logger.debug("{} planb:operation:state is {}".format(volume_id, state))
+    journal.record_state(db, options['region'], volume_id, state)
+    if state not in ('init', 'failed') and not saved_instance:
+        raise Exception(
+            "No saved instance data for {} found in the journal".format(volume_id)
+        )
     if state == 'init':
         prepare_update(ec2, volume, options)
 
     elif state == 'prepared':
-        drain_node(ec2, volume, saved_instance)
+        pre_drain_node(ec2, volume, saved_instance, options)
+
+    elif state == 'flushed':
+        drain_node(ec2, volume, saved_instance, options)
 
     elif state == 'drained':
-        terminate_instance(ec2, volume, saved_instance)
+        if tags.get('planb:operation:mode') == 'in-place':
+            stop_instance(ec2, volume, saved_instance)
+        else:
+            terminate_instance(ec2, volume, saved_instance)
+
+    elif state == 'stopped':
+        start_instance(ec2, volume, saved_instance, options)
+
+    elif state == 'started':
+        wait_instance_running(ec2, volume, saved_instance)
 
     elif state == 'terminated':
         create_instance(ec2, volume, saved_instance, options)
@@ -411,7 +705,7 @@ def step_forward(ec2: object, volume_id: str, options: dict):
         configure_instance(ec2, volume, saved_instance, options)
 
     elif state == 'configured':
-        check_node_status(ec2, volume)
+        check_node_status(ec2, volume, saved_instance, options)
 
     elif state == 'completed':
         cleanup_state(ec2, volume)
@@ -432,145 +726,231 @@ def step_forward(ec2: object, volume_id: str, options: dict):
     return True
 
 
-def ssh_command_works(odd_host: str) -> bool:
-    ssh = subprocess.Popen(
-        ['ssh', odd_host, 'echo', 'test-ssh'],
-        stdout=subprocess.PIPE
-    )
-    try:
-        out, err = ssh.communicate(timeout=5)
-        return out == b'test-ssh\n'
-    except Exception as e:
-        logger.error(
-            "Failed to open SSH connection to the Odd host: {}".format(e)
-        )
-        ssh.kill()
-        ssh.communicate()
+def list_instances_to_update(ec2: object, db: object, cluster_name: str,
+                             region: str) -> list:
+    import_instance_dump_files(ec2, db, cluster_name, region)
+    operations = [
+        op
+        for op in journal.reconcile(db, ec2, cluster_name, region)
+        if op['saved_instance']
+    ]
+    if operations:
+        saved_instances = [op['saved_instance'] for op in operations]
+        msg = "Resume interrupted operation on node(s) {}" \
+              .format(", ".join(i['PrivateIpAddress'] for i in saved_instances))
+        if click.confirm(msg):
+            return saved_instances
+    else:
+        print("Listing cluster nodes for {}".format(cluster_name))
+        alive_instances = [
+            i
+            for i in list_instances(ec2, cluster_name)
+            if 'PrivateIpAddress' in i
+        ]
+        return sorted(alive_instances, key=lambda i: i['PrivateIpAddress'])
 
 
-def open_ssh_tunnel(odd_host: str, instance: dict) -> object:
+def update_node(ec2: object, instance: dict, options: dict):
+    if options['aborted'].is_set():
+        return
 
-    if is_local_jolokia_port_open():
+    local_port = find_free_local_port()
+    ssh = open_ssh_tunnel(options['odd_host'], instance, local_port)
+    if not ssh:
         click.echo(
-            "Port {} is already in use on localhost!".format(local_jolokia_port),
+            "Cannot forward local port {} via ssh!".format(local_port),
             err=True
         )
-        return None
+        options['aborted'].set()
+        return
 
-    ip_address = instance['PrivateIpAddress']
-    port_forward = "{}:{}:{}".format(
-        local_jolokia_port, ip_address, remote_jolokia_port
+    db = journal.open_journal(options['journal_path'])
+    options = dict(options, journal=db, jolokia_url=make_jolokia_url(local_port))
+    gate = options['health_gate']
+    ips = instance_ips(instance)
+    try:
+        volume_id = find_data_volume_id(ec2, instance)
+        volume = get_volume(ec2, volume_id)
+        tags = tags_as_dict(volume.get('Tags', []))
+        if 'planb:operation:state' not in tags:
+            tag_instance_volume(ec2, volume, tags, instance, options['cluster_name'])
+        elif tags['planb:operation:state'] != 'init':
+            # resuming an interrupted operation: this node is already in flight
+            gate.enter(ips)
+        journal.start_operation(db, options['cluster_name'],
+                                options['region'], volume_id, 'update')
+
+        while step_forward(ec2, volume_id, options):
+            time.sleep(5)
+
+        journal.finish_operation(db, options['region'], volume_id)
+
+    except ClusterUnhealthyException:
+        if not options['aborted'].is_set():
+            options['aborted'].set()
+            sys.stderr.write("""
+Some nodes are DOWN.  Not updating anything!
+
+Please make sure all nodes are UP before proceeding with update.
+            """)
+
+    finally:
+        gate.leave(ips)
+        ssh.terminate()
+        db.close()
+
+
+def update_region(region: str, instances: list, options: dict):
+    ec2 = ec2_client(region)
+    options = dict(options, region=region, odd_host=options['odd_hosts'][region])
+    with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+        futures = [executor.submit(update_node, ec2, i, options)
+                   for i in instances]
+        for f in futures:
+            f.result()
+
+
+def rollback_node(ec2: object, instance: dict, options: dict):
+    volume_id = find_data_volume_id(ec2, instance)
+    db = journal.open_journal(options['journal_path'])
+    op = journal.find_last_operation(db, options['region'], volume_id)
+    db.close()
+    saved_instance = op['saved_instance']
+
+    rollback_options = dict(
+        options,
+        docker_image=saved_instance['UserData']['source'],
+        taupage_ami_id=saved_instance['ImageId'] if options['taupage_ami_id'] else None,
+        instance_type=saved_instance['InstanceType'] if options['instance_type'] else None
     )
-    cmd = ["ssh", odd_host, "-L", port_forward, "-N"]
-    logger.info("Opening SSH tunnel: {}".format(" ".join(cmd)))
-    ssh = subprocess.Popen(cmd)
-    retry = 1
-    while not is_local_jolokia_port_open():
-        if retry > 5:
-            ssh.terminate()
-            return None
-        retry += 1
-        time.sleep(1)
-    return ssh
+    # the node might have been replaced by a new instance
+    current_instance = find_instance_from_volume(ec2, get_volume(ec2, volume_id))
+    logger.info("Rolling back node {}".format(instance['PrivateIpAddress']))
+    update_node(ec2, current_instance, rollback_options)
 
 
-def is_local_jolokia_port_open() -> bool:
+def run_canary(region: str, instance: dict, peers: list, options: dict) -> bool:
     """
-    Returns True if local_jolokia_port is accepting connections.
+    Updates the canary node, then compares its latency to that of its peers
+    and counts the messages it dropped.  Returns True if no regression was
+    found.
     """
-    rcode = subprocess.call(['nc', 'localhost', str(local_jolokia_port), '-z'])
-    return rcode == 0
+    ec2 = ec2_client(region)
+    options = dict(options, region=region, odd_host=options['odd_hosts'][region])
+    sampled = [instance] + peers[:options['canary_peers']]
+
+    with jolokia.tunnels(options['odd_host'], sampled) as urls:
+        canary_ip = instance['PrivateIpAddress']
+        # only used if the peers cannot be sampled while soaking
+        baseline = canary.collect_baseline({ip: url for ip, url in urls.items() if ip == canary_ip}, options)
+        if not baseline:
+            click.echo("Cannot collect baseline metrics for canary!", err=True)
+            return False
+
+        logger.info("Updating canary node {}".format(canary_ip))
+        update_node(ec2, instance, options)
+        if options['aborted'].is_set():
+            return False
+
+        regressions = canary.soak(urls, canary_ip, baseline, options)
+
+    if not regressions:
+        logger.info("No regressions found on canary, proceeding with update")
+        return True
+
+    click.echo(
+        "Canary update of {} regressed:\n{}"
+        .format(instance['PrivateIpAddress'], "\n".join(regressions)),
+        err=True
+    )
+    if options['rollback']:
+        rollback_node(ec2, instance, options)
+    return False
 
 
-def list_instances_to_update(ec2: object, cluster_name: str) -> list:
-    dumps = list_instance_dump_files()
-    if dumps:
-        if len(dumps) > 1:
-            click.echo(
-                "Found more than one instance data dump file: {}".format(dumps),
-                err=True
-            )
-            return None
-        saved_instance = load_dict_from_file(dumps[0])
-        msg = "Resume interrupted operation on node {}" \
-              .format(saved_instance['PrivateIpAddress'])
-        if click.confirm(msg):
-            return [saved_instance]
-    else:
-        print("Listing cluster nodes for {}".format(cluster_name))
-        alive_instances = [
-            i
-            for i in list_instances(ec2, cluster_name)
-            if 'PrivateIpAddress' in i
-        ]
-        return sorted(alive_instances, key=lambda i: i['PrivateIpAddress'])
+def move_keystores(cluster_name: str, region_instances: dict) -> dict:
+    """
+    Stores the keystores embedded in the user data of the nodes in SSM
+    Parameter Store, once for the cluster.  Returns the environment
+    referencing them, or None if the nodes reference them already.
+    """
+    region, instances = next(iter(region_instances.items()))
+    environment = get_user_data(ec2_client(region), instances[0]['InstanceId'])['environment']
+    if 'KEYSTORE' not in environment:
+        return None
+    regions = environment.get('REGIONS', region).split()
+    ensure_secrets_policy(cluster_name)
+    return store_secret_parameters(regions, cluster_name, {k: environment[k] for k in keystore_variables})
 
 
 def update_cluster(options: dict):
-    ec2 = ec2_client(options['region'])
-    instances = list_instances_to_update(ec2, options['cluster_name'])
-    if not instances:
+    regions = list(options['odd_hosts'].keys())
+    journal_path = journal.default_journal_path
+    db = journal.open_journal(journal_path)
+
+    region_instances = {}
+    for region in regions:
+        ec2 = ec2_client(region)
+        instances = list_instances_to_update(
+            ec2, db, options['cluster_name'], region
+        )
+        if not instances:
+            continue
+
+        # TODO: List all nodes with IPs and some status information
+        # don't ask again if resuming after crash
+        if len(instances) > 1:
+            instances = [
+                i
+                for i in instances
+                if click.confirm("Update node {} in {}?".format(i['PrivateIpAddress'], region))
+            ]
+        if instances:
+            region_instances[region] = instances
+    db.close()
+    if not region_instances:
         return
 
+    for region in region_instances:
+        odd_host = options['odd_hosts'][region]
+        if not ssh_command_works(odd_host):
+            click.echo("Cannot ssh to the Odd host {}!".format(odd_host), err=True)
+            return
+
+    if options['move_keystores']:
+        options = dict(options, keystore_parameters=move_keystores(options['cluster_name'], region_instances))
+
     if options['sns_topic'] or options['sns_email']:
-        # a list of the only region we act on now
-        regions = [options['region']]
         alarm_topics = setup_sns_topics_for_alarm(
-            regions,
+            list(region_instances.keys()),
             options['sns_topic'],
             options['sns_email']
         )
     else:
         alarm_topics = {}
-    options = dict(options, alarm_topics=alarm_topics)
-
-    # TODO: List all nodes with IPs and some status information
-    for i in instances:
-        # TODO: user should hit Ctrl-c to cancel everything
-        # don't ask again if resuming after crash
-        if len(instances) > 1:
-            question = "Update node {}?".format(i['PrivateIpAddress'])
-            if not click.confirm(question):
-                continue
-
-        if not ssh_command_works(options['odd_host']):
-            click.echo(
-                "Cannot ssh to the Odd host!".format(local_jolokia_port),
-                err=True
-            )
-            return
-
-        ssh = open_ssh_tunnel(options['odd_host'], i)
-        if not ssh:
-            click.echo(
-                "Cannot forward local port {} via ssh!"
-                .format(local_jolokia_port),
-                err=True
-            )
-            return
-
-        try:
-            volume_id = find_data_volume_id(ec2, i)
-            volume = get_volume(ec2, volume_id)
-            tags = tags_as_dict(volume.get('Tags', []))
-            if 'planb:operation:state' not in tags:
-                tag_instance_volume(ec2, volume, tags, i, options['cluster_name'])
-
-            while step_forward(ec2, volume_id, options):
-                time.sleep(5)
-
-            # clean up any stale instance data dump file
-            instance_dump_file = instance_filename(volume)
-            if os.path.exists(instance_dump_file):
-                os.unlink(instance_dump_file)
-
-        except ClusterUnhealthyException:
-            sys.stderr.write("""
-Some nodes are DOWN.  Not updating anything!
+    options = dict(
+        options,
+        alarm_topics=alarm_topics,
+        journal_path=journal_path,
+        health_gate=ClusterHealthGate(),
+        aborted=threading.Event()
+    )
 
-Please make sure all nodes are UP before proceeding with update.
-            """)
+    if options['canary']:
+        region, instances = next(iter(region_instances.items()))
+        if not run_canary(region, instances[0], instances[1:], options):
             return
+        region_instances[region] = instances[1:]
+
+    if options['parallel_regions']:
+        with ThreadPoolExecutor(max_workers=len(region_instances)) as executor:
+            futures = [executor.submit(update_region, region, instances, options)
+                       for region, instances in region_instances.items()]
+            for f in futures:
+                f.result()
+    else:
+        for region, instances in region_instances.items():
+            update_region(region, instances, options)
 
-        finally:
-            ssh.terminate()
+    # nodes updated in place keep their alarms, which may lack a new topic
+    sync_cluster_alarms(list(region_instances), options['cluster_name'], alarm_topics)
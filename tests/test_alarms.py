@@ -0,0 +1,52 @@
+from unittest.mock import MagicMock, patch
+
+from planb.alarms import list_alarms, plan_sync, sync_alarms
+
+
+def alarm(cluster_name: str, instance_id: str, actions: list = None) -> dict:
+    return {'AlarmName': '{}-{}-auto-recover'.format(cluster_name, instance_id),
+            'AlarmActions': actions or ['arn:aws:automate:eu-west-1:ec2:recover']}
+
+
+def test_list_alarms_ignores_other_clusters():
+    cw = MagicMock()
+    cw.get_paginator.return_value.paginate.return_value = [
+        {'MetricAlarms': [alarm('my-cluster', 'i-1a')]},
+        {'MetricAlarms': [alarm('my-cluster', 'i-2b'), {'AlarmName': 'my-cluster-i-3c-high-cpu'}]},
+    ]
+    assert list(list_alarms(cw, 'my-cluster')) == ['i-1a', 'i-2b']
+    cw.get_paginator.return_value.paginate.assert_called_once_with(AlarmNamePrefix='my-cluster-i-')
+
+
+def test_plan_sync():
+    alarms = {'i-1': alarm('c', 'i-1'), 'i-2': alarm('c', 'i-2')}
+    assert plan_sync('eu-west-1', alarms, {'i-2', 'i-3'}, None) == (['i-3'], ['c-i-1-auto-recover'])
+
+    topic = 'arn:aws:sns:eu-west-1:123:planb'
+    create, delete = plan_sync('eu-west-1', alarms, {'i-1', 'i-2'}, topic)
+    assert (create, delete) == (['i-1', 'i-2'], [])
+
+    alarms['i-1']['AlarmActions'].append(topic)
+    assert plan_sync('eu-west-1', alarms, {'i-1'}, None) == ([], ['c-i-2-auto-recover'])
+
+
+def test_sync_alarms_batches_deletes():
+    cw = MagicMock()
+    stale = {'i-{:x}'.format(n): alarm('c', 'i-{:x}'.format(n)) for n in range(250)}
+    with patch('planb.alarms.ec2_client'), \
+            patch('planb.alarms.iter_instances', return_value=[{'InstanceId': 'i-live'}]), \
+            patch('planb.alarms.autorecovery_client', return_value=cw), \
+            patch('planb.alarms.list_alarms', return_value=stale), \
+            patch('planb.alarms.create_auto_recovery_alarm') as create:
+        create_ids, delete_names = sync_alarms('eu-west-1', 'c')
+    create.assert_called_once_with('eu-west-1', 'c', 'i-live', None)
+    assert len(delete_names) == 250
+    assert sorted(len(c[1]['AlarmNames']) for c in cw.delete_alarms.call_args_list) == [50, 100, 100]
+
+    cw.reset_mock()
+    with patch('planb.alarms.ec2_client'), \
+            patch('planb.alarms.iter_instances', return_value=[]), \
+            patch('planb.alarms.autorecovery_client', return_value=cw), \
+            patch('planb.alarms.list_alarms', return_value=stale):
+        sync_alarms('eu-west-1', 'c', dry_run=True)
+    cw.delete_alarms.assert_not_called()
@@ -0,0 +1,107 @@
+from unittest.mock import MagicMock, patch
+
+from planb.backup import make_backup_id, find_data_volumes, snapshot_tags, \
+    list_backups, expired_backups, restore_volume, tags_as_dict, restore_nodes
+
+
+def test_make_backup_id():
+    assert make_backup_id('my-cluster', 0) == 'my-cluster-19700101T000000Z'
+
+
+def test_find_data_volumes():
+    instances = [
+        {'InstanceId': 'i-1', 'PrivateIpAddress': '172.31.1.1',
+         'BlockDeviceMappings': [{'DeviceName': '/dev/xvdf', 'Ebs': {'VolumeId': 'vol-1'}}]},
+        {'InstanceId': 'i-2', 'PrivateIpAddress': '172.31.1.2',
+         'BlockDeviceMappings': [{'DeviceName': '/dev/xvdf', 'Ebs': {'VolumeId': 'vol-2'}}]},
+    ]
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value = [{'Volumes': [
+        {'VolumeId': 'vol-1', 'Tags': [{'Key': 'Name', 'Value': 'my-cluster-172.31.1.1'}]},
+        # stale volume of a node which was replaced
+        {'VolumeId': 'vol-old', 'Tags': [{'Key': 'Name', 'Value': 'my-cluster-172.31.1.2'}]},
+        {'VolumeId': 'vol-2', 'Tags': [{'Key': 'Name', 'Value': 'my-cluster-172.31.1.2'}]},
+    ]}]
+    volumes = find_data_volumes(ec2, 'my-cluster', instances)
+    assert {k: v['VolumeId'] for k, v in volumes.items()} == {'i-1': 'vol-1', 'i-2': 'vol-2'}
+
+
+def test_snapshot_tags():
+    instance = {'PrivateIpAddress': '172.31.1.1', 'PublicIpAddress': '52.1.1.1'}
+    volume = {'VolumeType': 'gp2', 'Iops': 300,
+              'Tags': [{'Key': 'Name', 'Value': 'my-cluster-172.31.1.1'},
+                       {'Key': 'Taupage:erase-on-boot', 'Value': 'True'}]}
+    tags = tags_as_dict(snapshot_tags('my-cluster', 'b-1', instance, volume))
+    assert tags == {
+        'Name': 'my-cluster-172.31.1.1',
+        'planb:cluster-name': 'my-cluster',
+        'planb:backup-id': 'b-1',
+        'planb:private-ip': '172.31.1.1',
+        'planb:public-ip': '52.1.1.1',
+        'planb:volume-type': 'gp2',
+    }
+
+    volume = dict(volume, VolumeType='gp3', Iops=6000, Throughput=250)
+    tags = tags_as_dict(snapshot_tags('my-cluster', 'b-1', instance, volume))
+    assert (tags['planb:volume-iops'], tags['planb:volume-throughput']) == ('6000', '250')
+
+
+def test_list_and_expire_backups():
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value = [{'Snapshots': [
+        {'SnapshotId': 'snap-{}'.format(n),
+         'Tags': [{'Key': 'planb:backup-id', 'Value': 'c-2017010{}T000000Z'.format(n % 3)}]}
+        for n in range(6)
+    ]}]
+    backups = list_backups(ec2, 'c')
+    assert len(backups['c-20170100T000000Z']) == 2
+    assert expired_backups(list(backups), 2) == ['c-20170100T000000Z']
+    assert expired_backups(list(backups), 0) == sorted(backups, reverse=True)
+
+
+def test_restore_volume():
+    ec2 = MagicMock()
+    ec2.describe_fast_snapshot_restores.return_value = {
+        'FastSnapshotRestores': [{'State': 'enabled'}]
+    }
+    ec2.create_volume.return_value = {'VolumeId': 'vol-new'}
+    snapshot = {'SnapshotId': 'snap-1', 'Tags': [
+        {'Key': 'Name', 'Value': 'my-cluster-172.31.1.1'},
+        {'Key': 'planb:volume-type', 'Value': 'io1'},
+        {'Key': 'planb:volume-iops', 'Value': '1000'},
+    ]}
+    assert restore_volume(ec2, snapshot, 'eu-central-1a', True) == 'vol-new'
+    ec2.enable_fast_snapshot_restores.assert_called_once_with(
+        AvailabilityZones=['eu-central-1a'], SourceSnapshotIds=['snap-1']
+    )
+    params = ec2.create_volume.call_args[1]
+    assert params['Iops'] == 1000
+    assert 'Throughput' not in params
+    assert params['TagSpecifications'][0]['Tags'] == [
+        {'Key': 'Name', 'Value': 'my-cluster-172.31.1.1'}
+    ]
+
+
+def test_restore_models_nodes_on_running_peers():
+    snapshot = {'SnapshotId': 'snap-1', 'Tags': [{'Key': 'planb:private-ip', 'Value': '172.31.1.23'},
+                                                 {'Key': 'planb:public-ip', 'Value': '52.1.1.1'}]}
+    peer = {'InstanceId': 'i-peer', 'PrivateIpAddress': '172.31.1.5'}
+    options = {'cluster_name': 'my-cluster', 'region': 'eu-central-1', 'odd_host': 'odd',
+               'backup_id': 'my-cluster-1', 'ip': [], 'fast_restore': False,
+               'sns_topic': None, 'sns_email': None}
+    ec2 = MagicMock()
+    ec2.describe_subnets.return_value = {'Subnets': [{'AvailabilityZone': 'eu-central-1a'}]}
+    with patch('planb.backup.ec2_client', return_value=ec2), \
+            patch('planb.backup.list_backups', return_value={'my-cluster-1': [snapshot]}), \
+            patch('planb.backup.iter_instances', return_value=[peer]), \
+            patch('planb.backup.find_blocking_instance', return_value=None), \
+            patch('planb.backup.journal.open_journal'), \
+            patch('planb.replace_node.journal.find_instance_by_ip', return_value={'ImageId': 'ami-old'}), \
+            patch('planb.replace_node.derive_instance_spec', return_value={'SubnetId': 'sn-a'}) as derive, \
+            patch('planb.backup.restore_volume'), \
+            patch('planb.backup.launch_node') as launch_node, \
+            patch('planb.backup.jolokia.tunnels'), \
+            patch('planb.backup.info'):
+        restore_nodes(options)
+    assert derive.call_args[0][1:] == (peer, '172.31.1.23', '52.1.1.1')
+    assert launch_node.call_args[0][1] == {'SubnetId': 'sn-a'}
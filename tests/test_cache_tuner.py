@@ -0,0 +1,57 @@
+from planb.cache_tuner import parse_counters, sum_counters, hit_rate, \
+    CacheController, chunk_cache_capacity
+
+
+def cache_metric(scope: str, name: str) -> str:
+    return 'org.apache.cassandra.metrics:name={},scope={},type=Cache'.format(name, scope)
+
+
+def test_parse_and_sum_counters():
+    mib = 1024 ** 2
+    values = [
+        {cache_metric('KeyCache', 'Hits'): {'Count': 80}},
+        {cache_metric('KeyCache', 'Requests'): {'Count': 100}},
+        {cache_metric('KeyCache', 'Size'): {'Value': 50 * mib}},
+        {cache_metric('KeyCache', 'Capacity'): {'Value': 100 * mib}},
+        {'max': 4096 * mib},
+    ]
+    node = parse_counters(values)
+    assert node == {'KeyCache': {'hits': 80, 'requests': 100, 'size': 50, 'capacity': 100}}
+    total = sum_counters([node, node])
+    assert total['KeyCache'] == {'hits': 160, 'requests': 200, 'size': 50, 'capacity': 100}
+
+
+def test_hit_rate():
+    assert hit_rate({'hits': 0, 'requests': 0}, {'hits': 900, 'requests': 1000}) == 0.9
+    assert hit_rate({'hits': 0, 'requests': 0}, {'hits': 9, 'requests': 10}) is None
+
+
+def test_controller_stops_when_gain_flattens():
+    controller = CacheController(100, 1000, 0.01)
+    assert controller.step(0.70, 99) == 150
+    assert controller.step(0.80, 149) == 225
+    # the last step brought less than a point, keep the previous capacity
+    assert controller.step(0.805, 224) == 150
+    assert controller.settled == 150
+
+
+def test_controller_limits():
+    controller = CacheController(100, 120, 0.01)
+    assert controller.step(0.5, 100) == 120
+    assert controller.step(0.6, 120) == 120
+    assert controller.settled == 120
+
+    controller = CacheController(100, 1000, 0.01)
+    assert controller.step(0.9, 20) == 30
+    assert controller.settled == 30
+
+    controller = CacheController(0, 1000, 0.01)
+    assert controller.step(None, 0) == 0
+    assert controller.settled == 0
+
+
+def test_chunk_cache_capacity():
+    assert chunk_cache_capacity(0.5, 510, 512, 2048) == 768
+    assert chunk_cache_capacity(0.5, 510, 512, 600) == 600
+    assert chunk_cache_capacity(0.95, 510, 512, 2048) == 512
+    assert chunk_cache_capacity(0.5, 100, 512, 2048) == 150
@@ -0,0 +1,77 @@
+from unittest.mock import patch
+
+from planb.canary import sample_node, aggregate_latency, dropped_delta, \
+    find_regressions, select_nodes, soak
+
+options = {'max_latency_increase': 0.2, 'max_dropped_messages': 100,
+           'soak_time': 20, 'sample_interval': 10}
+
+
+def make_sample(read_p99, dropped=0):
+    return {'read_p50': 500, 'read_p99': read_p99,
+            'write_p50': 300, 'write_p99': 1000, 'dropped': dropped}
+
+
+def test_sample_node():
+    values = [
+        {'50thPercentile': 500.0, '99thPercentile': 2000.0},
+        {'50thPercentile': 300.0, '99thPercentile': 1000.0},
+        {'org.apache.cassandra.metrics:name=Dropped,scope=READ,type=DroppedMessage': {'Count': 3},
+         'org.apache.cassandra.metrics:name=Dropped,scope=MUTATION,type=DroppedMessage': {'Count': 4}}
+    ]
+    with patch('planb.jolokia.query', return_value=values):
+        assert sample_node('http://localhost:8778/jolokia/') == {
+            'read_p50': 500.0, 'read_p99': 2000.0,
+            'write_p50': 300.0, 'write_p99': 1000.0,
+            'dropped': 7
+        }
+    with patch('planb.jolokia.query', return_value=None):
+        assert sample_node('http://localhost:8778/jolokia/') is None
+
+
+def test_aggregate_latency():
+    samples = [{'10.0.0.1': make_sample(2000), '10.0.0.2': make_sample(4000)},
+               {'10.0.0.1': make_sample(3000)}]
+    assert aggregate_latency(samples)['read_p99'] == 3000
+    assert aggregate_latency([{}]) is None
+
+
+def test_dropped_delta():
+    first = {'10.0.0.1': make_sample(0, dropped=10), '10.0.0.2': make_sample(0, dropped=5)}
+    # 10.0.0.1 was restarted and its counters were reset
+    last = {'10.0.0.1': make_sample(0, dropped=2), '10.0.0.2': make_sample(0, dropped=25)}
+    assert dropped_delta(first, last) == 20
+
+
+def test_find_regressions():
+    baseline = make_sample(2000)
+    assert find_regressions(baseline, make_sample(2300), 0, options) == []
+
+    regressions = find_regressions(baseline, make_sample(4000), 101, options)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('read_p99')
+
+
+def test_select_nodes():
+    samples = [{'10.0.0.1': make_sample(2000), '10.0.0.2': make_sample(4000)}, {'10.0.0.2': make_sample(3000)}]
+    assert select_nodes(samples, {'10.0.0.1'}) == [{'10.0.0.1': make_sample(2000)}, {}]
+
+
+def test_soak_compares_canary_to_peers():
+    urls = {ip: 'http://{}/'.format(ip) for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']}
+    baseline = make_sample(2000)
+    # averaged with its peers, the canary would stay below the threshold
+    samples = [{'10.0.0.1': make_sample(3000, dropped=10), '10.0.0.2': make_sample(2000, dropped=0),
+                '10.0.0.3': make_sample(2000, dropped=0)},
+               {'10.0.0.1': make_sample(3000, dropped=20), '10.0.0.2': make_sample(2000, dropped=500),
+                '10.0.0.3': make_sample(2000, dropped=0)}]
+    with patch('planb.canary.collect_samples', return_value=samples):
+        regressions = soak(urls, '10.0.0.1', baseline, options)
+    assert regressions == ['read_p99 is 3000 microseconds, against 2000 of the baseline']
+
+    # without peers, the canary is compared to its own baseline
+    canary_samples = select_nodes(samples, {'10.0.0.1'})
+    with patch('planb.canary.collect_samples', return_value=canary_samples):
+        assert soak(urls, '10.0.0.1', make_sample(2800), options) == []
+    with patch('planb.canary.collect_samples', return_value=[{}, {}]):
+        assert soak(urls, '10.0.0.1', baseline, options) == ['No latency metrics of the canary could be collected']
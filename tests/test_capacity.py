@@ -0,0 +1,53 @@
+from planb.capacity import workload_per_dc, size_volume, volume_types, \
+    instance_types, evaluate, plan, create_command
+
+
+options = {
+    'cluster_name': 'mycluster', 'regions': ['eu-central-1'],
+    'reads': 10000, 'writes': 5000, 'row_size': 1000, 'data_size': 300,
+    'replication_factor': 3, 'growth': 0.0, 'years': 1, 'max_nodes': 30
+}
+
+gp2, io1 = volume_types
+m5_xlarge = next(i for i in instance_types if i['name'] == 'm5.xlarge')
+
+
+def test_workload_per_dc():
+    workload = workload_per_dc(dict(options, growth=1.0))
+    assert workload['replica_reads'] == 20000
+    assert workload['replica_writes'] == 15000
+    assert workload['data_gb'] == 1800
+
+
+def test_size_volume():
+    # space for the data and for compaction
+    assert size_volume(gp2, 100, 0) == (200, None)
+    # gp2 grows for the IOPS
+    assert size_volume(gp2, 100, 3000) == (1000, None)
+    assert size_volume(io1, 100, 3000) == (200, 3000)
+    assert size_volume(io1, 100, 100000) is None
+
+
+def test_evaluate_survives_node_down():
+    workload = workload_per_dc(options)
+    # 30000 disk reads/s at 70% of 6000 IOPS need 8 nodes serving
+    assert evaluate(m5_xlarge, gp2, 8, workload) is None
+    config = evaluate(m5_xlarge, gp2, 9, workload)
+    assert config['nodes'] == 9
+    assert config['cpu'] <= 0.7
+
+
+def test_plan_ranks_by_cost():
+    configs = plan(options)
+    assert configs
+    costs = [c['monthly_cost'] for c in configs]
+    assert costs == sorted(costs)
+    assert all(c['nodes'] >= 4 for c in configs)
+
+
+def test_create_command():
+    config = {'nodes': 5, 'instance_type': 'r5.xlarge', 'volume_type': 'io1',
+              'volume_size': 400, 'volume_iops': 5000}
+    assert create_command(config, dict(options, regions=['eu-central-1', 'eu-west-1'])) == \
+        'planb create --cluster-name mycluster --cluster-size 5 --instance-type r5.xlarge ' \
+        '--volume-type io1 --volume-size 400 --volume-iops 5000 --use-dmz eu-central-1 eu-west-1'
@@ -0,0 +1,55 @@
+import subprocess
+import time
+import sys
+import os
+
+import pytest
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+heavy_modules = ['boto3', 'botocore', 'requests', 'yaml', 'netaddr', 'clickclick']
+
+# seconds `planb --help` may take on top of the bare interpreter startup
+startup_budget = float(os.environ.get('PLANB_STARTUP_BUDGET', '0.25'))
+
+
+def run_python(code: str) -> float:
+    started = time.time()
+    subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    return time.time() - started
+
+
+def test_help_does_not_import_heavy_dependencies():
+    code = '''
+import sys
+from planb.cli import cli
+for args in [['--help'], ['nodes', '--help'], ['create']]:
+    try:
+        cli(args)
+    except SystemExit:
+        pass
+print(' '.join(m for m in {} if m in sys.modules))
+'''.format(heavy_modules)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root, stderr=subprocess.DEVNULL)
+    assert out.decode().split('\n')[-2] == ''
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='timings are calibrated on Linux')
+def test_help_startup_time():
+    # best of a few runs, to leave out noise from other processes
+    baseline = min(run_python('pass') for _ in range(3))
+    startup = min(run_python('from planb.cli import cli\ntry:\n    cli(["--help"])\nexcept SystemExit:\n    pass')
+                  for _ in range(3))
+    assert startup - baseline < startup_budget
+
+
+@pytest.mark.parametrize('args', [['--target-pending', '0'], ['--max-disk-util', '1.0'],
+                                  ['--max-disk-util', '0'], ['--max-read-latency', '0']])
+def test_autotune_compaction_rejects_bounds(args):
+    from click.testing import CliRunner
+    from planb.cli import cli
+    result = CliRunner().invoke(cli, ['autotune-compaction', '--cluster-name', 'my-cluster',
+                                      '--region', 'eu-central-1', '-O', 'odd'] + args)
+    assert result.exit_code == 2
+    assert 'Please specify' in result.output
@@ -0,0 +1,43 @@
+import base64
+import json
+
+from unittest.mock import MagicMock, patch
+
+from planb.common import dump_user_data_for_taupage, decode_user_data, template_user_data, \
+    store_secret_parameters, ensure_secrets_policy
+
+
+def test_user_data_roundtrip():
+    user_data = {'source': 'cassandra:3', 'environment': {'CLUSTER_NAME': 'my-cluster'}}
+    for gzipped in (False, True):
+        data = dump_user_data_for_taupage(user_data, gzipped)
+        raw = data if gzipped else data.encode('UTF-8')
+        assert decode_user_data(base64.b64encode(raw)) == (user_data, gzipped)
+
+
+def test_store_secret_parameters():
+    ssm = MagicMock()
+    with patch('planb.common.boto3.client', return_value=ssm):
+        environment = store_secret_parameters(['eu-central-1', 'eu-west-1'], 'my-cluster',
+                                              {'KEYSTORE': 'a2V5', 'TRUSTSTORE': 'dHJ1c3Q='})
+    assert environment == {'KEYSTORE_PARAMETER': '/planb/my-cluster/keystore',
+                           'TRUSTSTORE_PARAMETER': '/planb/my-cluster/truststore'}
+    assert ssm.put_parameter.call_count == 4
+    assert ssm.put_parameter.call_args[1]['Type'] == 'SecureString'
+
+
+def test_ensure_secrets_policy():
+    iam = MagicMock()
+    with patch('planb.common.boto3.client', return_value=iam):
+        ensure_secrets_policy('my-cluster')
+    params = iam.put_role_policy.call_args[1]
+    assert params['RoleName'] == 'role-my-cluster'
+    statement = json.loads(params['PolicyDocument'])['Statement'][0]
+    assert statement['Resource'] == 'arn:aws:ssm:*:*:parameter/planb/my-cluster/*'
+
+
+def test_template_user_data():
+    user_data = {'source': 'cassandra', 'environment': {'SEEDS': '10.0.0.1', 'REPLACE_ADDRESS': '10.0.0.2'}}
+    assert template_user_data(user_data) == {'source': 'cassandra', 'environment': {'SEEDS': '10.0.0.1'}}
+    assert user_data['environment']['REPLACE_ADDRESS'] == '10.0.0.2'
+    assert template_user_data({'source': 'cassandra'}) == {'source': 'cassandra'}
@@ -0,0 +1,91 @@
+import json
+
+from unittest.mock import patch
+
+from planb.compaction_tuner import PidController, Sample, control_error, \
+    compactors_for, disk_utilization, set_throughput, log_decision, \
+    replay_decisions, make_controller, decide, read_io_ticks, io_ticks_script
+
+
+options = {
+    'min_throughput': 16, 'max_throughput': 256,
+    'min_compactors': 1, 'max_compactors': 4,
+    'target_pending': 20, 'max_read_latency': 50.0, 'max_disk_util': 0.8,
+    'kp': 0.3, 'ki': 0.002, 'kd': 10.0, 'interval': 60,
+}
+
+
+def test_pid_controller_anti_windup():
+    pid = PidController(1.0, 0.1, 0.0, 50, 0, 100)
+    output, terms = pid.update(0.1, 1)
+    assert round(output, 2) == 61.0
+    assert round(pid.integral, 2) == 0.1
+    # saturated: the integral does not grow any further
+    output, _ = pid.update(10, 1)
+    assert output == 100
+    assert round(pid.integral, 2) == 0.1
+
+
+def test_control_error():
+    sample = Sample(time=0, pending=60, read_p99=10.0, write_p99=1.0, disk_util=None)
+    assert control_error(sample, options)['error'] == 2.0
+    busy = sample._replace(pending=20, disk_util=0.9, read_p99=100.0)
+    terms = control_error(busy, options)
+    assert round(terms['disk'], 2) == -0.5
+    assert terms['latency'] == -1.0
+    assert round(terms['error'], 2) == -1.5
+    assert control_error(sample._replace(pending=10000), options)['backlog'] == 3.0
+
+
+def test_compactors_for():
+    assert compactors_for(16, options) == 1
+    assert compactors_for(136, options) == 3
+    assert compactors_for(256, options) == 4
+
+
+def test_disk_utilization():
+    assert disk_utilization(None, (10, 500)) is None
+    assert disk_utilization((0, 1000), (10, 6000)) == 0.5
+    assert disk_utilization((0, 0), (10, None)) is None
+
+
+def test_read_io_ticks():
+    assert '/mounts/var/lib/cassandra' in io_ticks_script
+    with patch('planb.compaction_tuner.subprocess.check_output', return_value=b'123456\n') as check_output:
+        assert read_io_ticks('odd-host', '10.0.0.1') == 123456
+    assert check_output.call_args[0][0][:4] == ['ssh', 'odd-host', 'ssh', '10.0.0.1']
+    with patch('planb.compaction_tuner.subprocess.check_output', return_value=b'\n'), \
+            patch('planb.compaction_tuner.logger') as logger:
+        assert read_io_ticks('odd-host', '10.0.0.1') is None
+    assert logger.warning.called
+
+
+def test_set_throughput_orders_thread_writes():
+    with patch('planb.compaction_tuner.jolokia.query', return_value=[64, 2, 2]) as query:
+        assert set_throughput('url', 32, 1, 1, 2)
+    attributes = [q['attribute'] for q in query.call_args[0][1]]
+    assert attributes == ['CompactionThroughputMbPerSec', 'CoreCompactorThreads', 'MaximumCompactorThreads']
+
+    with patch('planb.compaction_tuner.jolokia.query', return_value=[64, None, 2]):
+        assert not set_throughput('url', 128, 3, 3, 2)
+
+
+def test_replay_decisions(tmpdir):
+    path = str(tmpdir.join('decisions.jsonl'))
+    controller = make_controller(64, options)
+    prev = 0
+    for t, pending in [(60, 40), (120, 80), (180, 10)]:
+        sample = Sample(time=t, pending=pending, read_p99=5.0, write_p99=1.0, disk_util=0.3)
+        record = dict(decide(controller, sample, prev, options),
+                      ip='10.0.0.1', region='eu-central-1', previous_throughput=64, applied=True)
+        record.update(sample._asdict())
+        log_decision(path, record)
+        prev = t
+
+    replayed = replay_decisions(path, options)
+    assert [r['throughput'] for _, r in replayed] == [r['throughput'] for r, _ in replayed]
+
+    slower = replay_decisions(path, dict(options, max_throughput=100))
+    assert max(r['throughput'] for _, r in slower) <= 100
+    with open(path) as fd:
+        assert json.loads(fd.readline())['pending'] == 40
@@ -1,8 +1,10 @@
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from planb.create_cluster import generate_private_ip_addresses, \
-    IpAddressPoolDepletedException, read_environment
+    IpAddressPoolDepletedException, read_environment, make_replication_map, \
+    scylla_environment, allocate_ip_addresses, release_address, create_tagged_volume
+from planb.undo import UndoStack
 
 
 def test_generate_private_ip_addresses():
@@ -63,3 +65,54 @@ def test_read_environment():
     parsed_dict = {'key': 'value', 'base64': 'dGVzdA=='}
     expected = {'environment': parsed_dict}
     assert read_environment({'environment': raw_list}) == expected
+
+
+def test_make_replication_map():
+    assert make_replication_map({'eu-west-1': 5, 'eu-central-1': 3}) == \
+        "{'class': 'NetworkTopologyStrategy', 'eu-central': 3, 'eu-west': 5}"
+
+
+def test_scylla_environment():
+    small = {'VCpuInfo': {'DefaultVCpus': 2}, 'MemoryInfo': {'SizeInMiB': 8192}}
+    assert scylla_environment(small) == {
+        'SCYLLA_PRODUCTION': 'true', 'SCYLLA_SMP': 2, 'SCYLLA_CPU_SET': '0-1', 'SCYLLA_MEMORY': '6656M'
+    }
+    large = {'VCpuInfo': {'DefaultVCpus': 16}, 'MemoryInfo': {'SizeInMiB': 131072}}
+    env = scylla_environment(large)
+    assert env['SCYLLA_SMP'] == 15
+    assert env['SCYLLA_CPU_SET'] == '1-15'
+
+
+def test_allocate_ip_addresses_pushes_undo():
+    ec2 = MagicMock()
+    ec2.describe_instances.return_value = {'Reservations': []}
+    ec2.allocate_address.side_effect = [
+        {'PublicIp': '52.0.0.{}'.format(i), 'AllocationId': 'eipalloc-{}'.format(i)} for i in range(2)
+    ]
+    undo = UndoStack()
+    node_ips = {'eu-west-1': []}
+    with patch('planb.create_cluster.boto3.client', return_value=ec2):
+        allocate_ip_addresses({'eu-west-1': [{'CidrBlock': '10.0.0.0/24'}]}, 2, node_ips, True, undo=undo)
+    assert [(a.kind, a.action, a.args) for a in undo.actions] == [
+        ('address', release_address, ('eu-west-1', 'eipalloc-0')),
+        ('address', release_address, ('eu-west-1', 'eipalloc-1')),
+    ]
+
+
+def test_create_tagged_volume_keeps_provisioned_performance():
+    ec2 = MagicMock()
+    ec2.create_volume.return_value = {'VolumeId': 'vol-1'}
+    options = {'volume_type': 'gp3', 'volume_size': 100, 'volume_iops': 6000, 'volume_throughput': 250}
+    assert create_tagged_volume(ec2, options, 'eu-central-1a', 'my-cluster-10.0.0.1') == 'vol-1'
+    assert ec2.create_volume.call_args[1] == {
+        'AvailabilityZone': 'eu-central-1a', 'VolumeType': 'gp3', 'Size': 100, 'Encrypted': False,
+        'Iops': 6000, 'Throughput': 250
+    }
+
+    create_tagged_volume(ec2, dict(options, volume_type='io2', volume_throughput=None), 'eu-central-1a', 'v')
+    assert ec2.create_volume.call_args[1]['Iops'] == 6000
+    assert 'Throughput' not in ec2.create_volume.call_args[1]
+
+    # gp2 volumes report their baseline IOPS, which cannot be set
+    create_tagged_volume(ec2, dict(options, volume_type='gp2', volume_throughput=None), 'eu-central-1a', 'v')
+    assert 'Iops' not in ec2.create_volume.call_args[1]
@@ -0,0 +1,35 @@
+from planb.exporter import metrics, metric_samples, mbean_key_property, \
+    render_metrics
+
+
+def test_mbean_key_property():
+    mbean = 'org.apache.cassandra.metrics:name=Dropped,scope=MUTATION,type=DroppedMessage'
+    assert mbean_key_property(mbean, 'scope') == 'MUTATION'
+    assert mbean_key_property(mbean, 'path') == ''
+
+
+def test_metric_samples():
+    metric = {'name': 'x', 'attribute': 'Count', 'label': 'scope'}
+    value = {
+        'org.apache.cassandra.metrics:name=Dropped,scope=READ,type=DroppedMessage': {'Count': 1},
+        'org.apache.cassandra.metrics:name=Dropped,scope=MUTATION,type=DroppedMessage': {'Count': 2}
+    }
+    assert metric_samples(metric, value) == [({'scope': 'MUTATION'}, 2), ({'scope': 'READ'}, 1)]
+    assert metric_samples({'name': 'y', 'scale': 1e-6}, 2000000) == [({}, 2.0)]
+    assert metric_samples(metric, None) == []
+
+
+def test_render_metrics():
+    values = [None] * len(metrics)
+    values[0] = 1024
+    node_values = {
+        ('eu-central-1', '10.0.0.1'): values,
+        ('eu-central-1', '10.0.0.2'): None
+    }
+    text = render_metrics('my-cluster', node_values)
+    lines = text.splitlines()
+    assert 'cassandra_up{cluster="my-cluster",instance="10.0.0.1",region="eu-central-1"} 1' in lines
+    assert 'cassandra_up{cluster="my-cluster",instance="10.0.0.2",region="eu-central-1"} 0' in lines
+    assert 'cassandra_load_bytes{cluster="my-cluster",instance="10.0.0.1",region="eu-central-1"} 1024' in lines
+    assert lines.count('# TYPE cassandra_client_request_latency_seconds gauge') == 1
+    assert text.endswith('\n')
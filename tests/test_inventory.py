@@ -0,0 +1,100 @@
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+
+from planb.inventory import iter_instances, iter_addresses, chunks, \
+    with_elastic_ips, stream_instances, regions_from_srv_records, regions_from_tags
+
+
+def make_ec2(pages):
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value = pages
+    return ec2
+
+
+def test_iter_instances():
+    pages = [
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]}]},
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-3'}]},
+                          {'Instances': [{'InstanceId': 'i-4'}]}]}
+    ]
+    ec2 = make_ec2(pages)
+    instances = list(iter_instances(ec2, 'my-cluster', ['running']))
+    assert [i['InstanceId'] for i in instances] == ['i-1', 'i-2', 'i-3', 'i-4']
+
+    ec2.get_paginator.assert_called_once_with('describe_instances')
+    filters = ec2.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert filters == [{'Name': 'tag:Name', 'Values': ['my-cluster']},
+                       {'Name': 'instance-state-name', 'Values': ['running']}]
+
+
+def test_iter_addresses():
+    ec2 = MagicMock()
+    ec2.describe_addresses.return_value = {'Addresses': [{'PublicIp': '1.2.3.4'}]}
+    instance_ids = ['i-{}'.format(n) for n in range(250)]
+    assert len(list(iter_addresses(ec2, instance_ids))) == 2
+    assert ec2.describe_addresses.call_count == 2
+
+
+def test_with_elastic_ips():
+    ec2 = MagicMock()
+    ec2.describe_addresses.return_value = {'Addresses': [{'InstanceId': 'i-1', 'PublicIp': '52.1.1.1'}]}
+    instances = iter([{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}])
+    assert list(with_elastic_ips(ec2, instances)) == [{'InstanceId': 'i-1', 'ElasticIp': '52.1.1.1'},
+                                                      {'InstanceId': 'i-2', 'ElasticIp': None}]
+    ec2.describe_addresses.assert_called_once_with(Filters=[{'Name': 'instance-id', 'Values': ['i-1', 'i-2']}])
+
+
+def test_chunks():
+    assert list(chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunks([], 2)) == []
+
+
+def test_stream_instances():
+    def client(service, region):
+        return make_ec2([{'Reservations': [{'Instances': [{'InstanceId': region}]}]}])
+
+    with patch('boto3.client', side_effect=client):
+        result = list(stream_instances('my-cluster', ['eu-central-1', 'eu-west-1']))
+    assert sorted(result) == [('eu-central-1', {'InstanceId': 'eu-central-1'}),
+                              ('eu-west-1', {'InstanceId': 'eu-west-1'})]
+
+
+def test_regions_from_srv_records():
+    r53 = MagicMock()
+    r53.list_hosted_zones_by_name.return_value = {'HostedZones': [{'Name': 'example.org.', 'Id': 'Z1'}]}
+    # in the order of Route53: by the labels reversed
+    r53.get_paginator.return_value.paginate.return_value = [
+        {'ResourceRecordSets': [
+            {'Name': '_abc-eu-west-1._tcp.example.org.', 'Type': 'SRV'},
+            {'Name': '_my-cluster-eu-central-1._tcp.example.org.', 'Type': 'SRV'},
+            {'Name': '_my-cluster-tools-eu-west-1._tcp.example.org.', 'Type': 'SRV'},
+        ]},
+        {'ResourceRecordSets': [
+            {'Name': '_my-cluster-eu-west-1._tcp.example.org.', 'Type': 'SRV'},
+            {'Name': 'www.example.org.', 'Type': 'A'},
+        ]},
+    ]
+    with patch('planb.inventory.boto3.client', return_value=r53):
+        assert regions_from_srv_records('my-cluster', 'example.org.') == ['eu-central-1', 'eu-west-1']
+    r53.get_paginator.return_value.paginate.assert_called_once_with(
+        HostedZoneId='Z1', StartRecordName='_tcp.example.org.')
+
+
+def test_regions_from_tags_skips_disabled_regions():
+    ec2 = MagicMock()
+    ec2.describe_regions.return_value = {'Regions': [{'RegionName': 'eu-central-1'},
+                                                     {'RegionName': 'eu-west-1'}]}
+
+    def iter_region_instances(client, cluster_name, states):
+        if client.region == 'eu-west-1':
+            raise ClientError({'Error': {'Code': 'AuthFailure', 'Message': 'not enabled'}},
+                              'DescribeInstances')
+        yield {'InstanceId': 'i-1'}
+
+    def client(service, region=None):
+        return MagicMock(describe_regions=ec2.describe_regions, region=region)
+
+    with patch('planb.inventory.boto3.client', side_effect=client), \
+            patch('planb.inventory.iter_instances', side_effect=iter_region_instances):
+        assert regions_from_tags('my-cluster') == ['eu-central-1']
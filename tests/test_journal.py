@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock
+
+from planb import journal
+
+
+def test_operation_lifecycle():
+    db = journal.open_journal(':memory:')
+    op = journal.start_operation(db, 'my-cluster', 'eu-central-1', 'vol-123', 'update')
+    assert op['volume_id'] == 'vol-123'
+    assert journal.load_instance(db, 'eu-central-1', 'vol-123') is None
+
+    # starting again returns the operation already in flight
+    again = journal.start_operation(db, 'my-cluster', 'eu-central-1', 'vol-123', 'update')
+    assert again['id'] == op['id']
+
+    instance = {'InstanceId': 'i-123', 'PrivateIpAddress': '172.31.128.11'}
+    journal.save_instance(db, 'eu-central-1', 'vol-123', instance)
+    assert journal.load_instance(db, 'eu-central-1', 'vol-123') == instance
+
+    journal.record_state(db, 'eu-central-1', 'vol-123', 'init')
+    journal.record_state(db, 'eu-central-1', 'vol-123', 'init')
+    journal.record_state(db, 'eu-central-1', 'vol-123', 'prepared')
+    history = journal.state_history(db, op['id'])
+    assert [h['state'] for h in history] == ['init', 'prepared']
+
+    journal.finish_operation(db, 'eu-central-1', 'vol-123')
+    assert journal.list_active_operations(db, 'my-cluster', 'eu-central-1') == []
+
+
+def test_concurrent_operations():
+    db = journal.open_journal(':memory:')
+    for volume_id in ['vol-1', 'vol-2']:
+        journal.start_operation(db, 'my-cluster', 'eu-central-1', volume_id, 'update')
+    journal.start_operation(db, 'my-cluster', 'eu-west-1', 'vol-3', 'update')
+    journal.start_operation(db, 'other-cluster', 'eu-central-1', 'vol-4', 'update')
+
+    active = journal.list_active_operations(db, 'my-cluster', 'eu-central-1')
+    assert [op['volume_id'] for op in active] == ['vol-1', 'vol-2']
+
+
+def test_reconcile():
+    db = journal.open_journal(':memory:')
+    for volume_id in ['vol-1', 'vol-2']:
+        journal.start_operation(db, 'my-cluster', 'eu-central-1', volume_id, 'update')
+
+    def describe_volumes(Filters):
+        volume_id = Filters[0]['Values'][0]
+        tags = [{'Key': 'planb:operation', 'Value': 'update'}]
+        if volume_id == 'vol-1':
+            tags.append({'Key': 'planb:operation:state', 'Value': 'drained'})
+        return {'Volumes': [{'VolumeId': volume_id, 'Tags': tags}]}
+
+    ec2 = MagicMock()
+    ec2.describe_volumes.side_effect = describe_volumes
+
+    active = journal.reconcile(db, ec2, 'my-cluster', 'eu-central-1')
+    assert [(op['volume_id'], op['state']) for op in active] == [('vol-1', 'drained')]
+    assert journal.find_operation(db, 'eu-central-1', 'vol-2') is None
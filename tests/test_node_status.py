@@ -0,0 +1,43 @@
+from unittest.mock import patch
+
+from planb import node_status
+from planb.node_status import parse_status, format_bytes, sort_rows, \
+    load_cached_status, save_cached_status
+
+
+def test_format_bytes():
+    assert format_bytes(512) == '512.0 B'
+    assert format_bytes(3 * 1024 ** 3) == '3.0 GiB'
+
+
+def test_parse_status():
+    values = [
+        {'Load': 2 * 1024 ** 3, 'OperationMode': 'NORMAL',
+         'Ownership': {'/10.0.0.1': 0.25, '/10.0.0.2': 0.75}},
+        {'used': 512, 'max': 1024},
+        7,
+        {'org.apache.cassandra.metrics:name=Dropped,scope=READ,type=DroppedMessage': {'Count': 3}},
+        2500.0,
+        None
+    ]
+    assert parse_status('10.0.0.1', values) == {
+        'ip': '10.0.0.1', 'mode': 'NORMAL', 'load': '2.0 GiB', 'owns': '25.0%',
+        'heap': '50%', 'pending': 7, 'dropped': 3, 'read_p99': '2.5 ms'
+    }
+
+
+def test_sort_rows():
+    rows = [{'region': 'eu-west-1', 'ip': '10.0.0.1'},
+            {'region': 'eu-central-1', 'ip': '10.0.0.10'},
+            {'region': 'eu-central-1', 'ip': '10.0.0.9'}]
+    assert [r['ip'] for r in sort_rows(rows)] == ['10.0.0.9', '10.0.0.10', '10.0.0.1']
+
+
+def test_status_cache(tmpdir):
+    rows = [{'region': 'eu-central-1', 'ip': '10.0.0.1', 'mode': 'NORMAL'}]
+    with patch.object(node_status, 'cache_dir', str(tmpdir)):
+        assert load_cached_status('my-cluster', ['eu-central-1'], 10) is None
+        save_cached_status('my-cluster', ['eu-central-1'], rows)
+        assert load_cached_status('my-cluster', ['eu-central-1'], 10) == rows
+        assert load_cached_status('my-cluster', ['eu-west-1'], 10) is None
+        assert load_cached_status('my-cluster', ['eu-central-1'], -1) is None
@@ -0,0 +1,88 @@
+import pytest
+
+from unittest.mock import MagicMock, patch
+from botocore.exceptions import ClientError
+
+from planb.preflight import nodes_per_subnet, vcpu_quota_code, check_subnets, \
+    check_instance_type, check_vcpus, check_elastic_ips, run_check, run_preflight, \
+    OK, FAILED, UNKNOWN
+
+
+def subnet(subnet_id: str, zone: str, free: int) -> dict:
+    return {'SubnetId': subnet_id, 'AvailabilityZone': zone, 'AvailableIpAddressCount': free}
+
+
+def test_nodes_per_subnet():
+    assert nodes_per_subnet(5, 3) == [2, 2, 1]
+    assert nodes_per_subnet(2, 3) == [1, 1, 0]
+
+
+def test_vcpu_quota_code():
+    assert vcpu_quota_code('m5.xlarge') == 'L-1216C47A'
+    assert vcpu_quota_code('i3en.large') == 'L-1216C47A'
+    assert vcpu_quota_code('x1e.xlarge') == 'L-7295265B'
+    assert vcpu_quota_code('inf1.xlarge') == 'L-1945791B'
+
+
+def test_check_subnets():
+    subnets = [subnet('subnet-a', 'eu-central-1a', 100), subnet('subnet-b', 'eu-central-1b', 11)]
+    assert check_subnets(subnets, 3)[0] == OK
+    status, detail = check_subnets(subnets, 4)
+    assert status == FAILED
+    assert detail == 'subnet-b has 11 free IPs, 2 needed'
+    assert check_subnets([], 3) == (FAILED, 'no subnets found')
+
+
+def test_check_instance_type():
+    ec2 = MagicMock()
+    ec2.describe_instance_type_offerings.return_value = {
+        'InstanceTypeOfferings': [{'Location': 'eu-central-1a'}, {'Location': 'eu-central-1b'}]
+    }
+    subnets = [subnet('subnet-a', 'eu-central-1a', 100), subnet('subnet-c', 'eu-central-1c', 100)]
+    assert check_instance_type(ec2, 'i3.large', subnets) == (FAILED, 'i3.large is not offered in eu-central-1c')
+
+    ec2.describe_instance_types.side_effect = ClientError(
+        {'Error': {'Code': 'InvalidInstanceType', 'Message': 'invalid'}}, 'DescribeInstanceTypes')
+    assert check_instance_type(ec2, 'i9.large', subnets) == (FAILED, 'unknown instance type i9.large')
+
+
+def test_check_vcpus():
+    ec2 = MagicMock()
+    ec2.describe_instance_types.return_value = {'InstanceTypes': [{'VCpuInfo': {'DefaultVCpus': 4}}]}
+    ec2.get_paginator.return_value.paginate.return_value = [{'Reservations': [{'Instances': [
+        {'InstanceType': 'm5.2xlarge', 'CpuOptions': {'CoreCount': 4, 'ThreadsPerCore': 2}},
+        {'InstanceType': 'p3.2xlarge', 'CpuOptions': {'CoreCount': 4, 'ThreadsPerCore': 2}},
+    ]}]}]
+    quotas = MagicMock()
+    quotas.get_service_quota.return_value = {'Quota': {'Value': 20.0}}
+    assert check_vcpus(ec2, quotas, 'm5.xlarge', 3) == (OK, '8 of 20 vCPUs used, 12 needed')
+    assert check_vcpus(ec2, quotas, 'm5.xlarge', 4)[0] == FAILED
+
+
+def test_check_elastic_ips():
+    ec2 = MagicMock()
+    ec2.describe_account_attributes.return_value = {
+        'AccountAttributes': [{'AttributeName': 'vpc-max-elastic-ips', 'AttributeValues': [{'AttributeValue': '5'}]}]
+    }
+    ec2.describe_addresses.return_value = {'Addresses': [{}, {}, {}]}
+    assert check_elastic_ips(ec2, 2)[0] == OK
+    assert check_elastic_ips(ec2, 3) == (FAILED, '3 of 5 Elastic IPs used, 3 needed')
+
+
+def test_run_check_reports_denied_calls():
+    def denied():
+        raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'not allowed'}}, 'GetServiceQuota')
+    assert run_check('eu-west-1', 'vCPU quota', denied) == ('eu-west-1', 'vCPU quota', UNKNOWN, 'not allowed')
+
+
+def test_run_preflight_fails_before_creating_anything():
+    options = {'regions': ['eu-central-1', 'eu-west-1'], 'hosted_zone': None}
+    checks = {
+        'eu-central-1': [run_check('eu-central-1', 'subnet IPs', lambda: (OK, ''))],
+        'eu-west-1': [run_check('eu-west-1', 'Elastic IPs', lambda: (FAILED, '5 of 5 Elastic IPs used, 3 needed'))],
+    }
+    with patch('planb.preflight.check_region', side_effect=lambda r, o: checks[r]), \
+            patch('planb.preflight.print_table'):
+        with pytest.raises(Exception) as e:
+            run_preflight(options)
+    assert 'eu-west-1 Elastic IPs: 5 of 5 Elastic IPs used, 3 needed' in str(e.value)
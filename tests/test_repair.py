@@ -0,0 +1,148 @@
+from unittest.mock import MagicMock, patch
+import time
+
+from planb import journal
+from planb.repair import MIN_TOKEN, RING_SIZE, range_width, split_range, \
+    parse_range_key, plan_subranges, repair_status, repair_progress, RepairScheduler
+
+
+def test_range_width():
+    assert range_width(0, 10) == 10
+    # wrapping around the ring
+    assert range_width(2 ** 63 - 10, MIN_TOKEN + 10) == 20
+    # a single token owns the whole ring
+    assert range_width(5, 5) == RING_SIZE
+
+
+def test_split_range():
+    assert split_range(0, 100, 4) == [(0, 25), (25, 50), (50, 75), (75, 100)]
+    parts = split_range(2 ** 63 - 10, MIN_TOKEN + 10, 3)
+    assert parts[0][0] == 2 ** 63 - 10
+    assert parts[-1][1] == MIN_TOKEN + 10
+    assert sum(range_width(s, e) for s, e in parts) == 20
+
+
+def test_parse_range_key():
+    assert parse_range_key('[-9223372036854775808, 42]') == (-2 ** 63, 42)
+
+
+def test_plan_subranges():
+    quarter = 2 ** 61
+    range_map = {
+        (MIN_TOKEN, 0): ['10.0.0.1'],
+        (0, MIN_TOKEN): ['10.0.0.2']
+    }
+    # 10.0.0.2 holds 4 times as many partitions on the same ring width
+    partitions = {'10.0.0.1': 1000, '10.0.0.2': 4000}
+    subranges = plan_subranges(range_map, partitions, 1000)
+    assert len(subranges) == 5
+    assert subranges[0] == (MIN_TOKEN, 0, ['10.0.0.1'])
+    assert subranges[1] == (0, quarter, ['10.0.0.2'])
+
+
+def make_scheduler(db, urls):
+    options = {
+        'cluster_name': 'my-cluster', 'node_parallelism': 1, 'dc_parallelism': 2,
+        'parallelism': 'sequential', 'max_pending_compactions': 20,
+        'poll_interval': 0, 'max_backoff': 0, 'range_timeout': 3600, 'max_attempts': 2
+    }
+    datacenters = {'10.0.0.1': 'eu-central', '10.0.0.2': 'eu-central', '10.0.0.3': 'eu-central'}
+    return RepairScheduler(db, options, urls, datacenters)
+
+
+def test_repair_scheduler():
+    db = journal.open_journal(':memory:')
+    subranges = [(0, 10, ['10.0.0.1', '10.0.0.2']),
+                 (10, 20, ['10.0.0.2', '10.0.0.3']),
+                 (20, 30, ['10.0.0.3', '10.0.0.1'])]
+    journal.save_repair_plan(db, 'my-cluster', 'ks', subranges)
+    urls = {ip: 'http://{}/'.format(ip) for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']}
+    scheduler = make_scheduler(db, urls)
+
+    started = []
+
+    def start_repair(url, keyspace, start, end, parallelism):
+        started.append(start)
+        return len(started)
+
+    with patch('planb.repair.start_repair', side_effect=start_repair), \
+            patch('planb.repair.subscribe_notifications', return_value=None), \
+            patch('planb.repair.repair_status', return_value='done'), \
+            patch('planb.repair.read_node_load', return_value=(0, 0)), \
+            patch('time.sleep'):
+        states = scheduler.run('ks')
+
+    assert states == {'done': 3}
+    assert sorted(started) == [0, 10, 20]
+
+
+def test_repair_scheduler_limits():
+    db = journal.open_journal(':memory:')
+    subranges = [(0, 10, ['10.0.0.1', '10.0.0.2']),
+                 (10, 20, ['10.0.0.2', '10.0.0.3'])]
+    journal.save_repair_plan(db, 'my-cluster', 'ks', subranges)
+    urls = {ip: 'http://{}/'.format(ip) for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']}
+    scheduler = make_scheduler(db, urls)
+    scheduler.started = {}
+
+    with patch('planb.repair.start_repair', return_value=1), \
+            patch('planb.repair.subscribe_notifications', return_value=None):
+        scheduler.start_ranges('ks', journal.list_repair_ranges(db, 'my-cluster', 'ks'))
+
+    # 10.0.0.2 is a replica of both subranges, so only one can run
+    states = [r['state'] for r in journal.list_repair_ranges(db, 'my-cluster', 'ks')]
+    assert states == ['running', 'pending']
+
+
+def test_repair_scheduler_backs_off():
+    scheduler = make_scheduler(MagicMock(), {'10.0.0.1': 'http://10.0.0.1/'})
+    with patch('planb.repair.read_node_load', return_value=(0, 5)):
+        assert not scheduler.is_overloaded(['10.0.0.1'])
+    with patch('planb.repair.read_node_load', return_value=(0, 7)):
+        assert scheduler.is_overloaded(['10.0.0.1'])
+    with patch('planb.repair.read_node_load', return_value=(50, 7)):
+        assert scheduler.is_overloaded(['10.0.0.1'])
+
+
+def test_repair_status():
+    with patch('planb.jolokia.query', return_value=[['COMPLETED', 'repair finished'], None]):
+        assert repair_status('http://10.0.0.1/', 1) == 'done'
+    with patch('planb.jolokia.query', return_value=[None, ['org.apache.cassandra.internal:type=Repair#1']]):
+        assert repair_status('http://10.0.0.1/', 1) == 'running'
+    # before 4.0, a missing pool does not tell whether the repair succeeded
+    with patch('planb.jolokia.query', return_value=[None, []]):
+        assert repair_status('http://10.0.0.1/', 1) is None
+
+
+def progress(command, event):
+    return {'type': 'progress', 'source': 'repair:{}'.format(command),
+            'userData': {'type': event, 'progressCount': 1, 'total': 1}}
+
+
+def test_repair_progress():
+    notifications = [progress(1, 0), progress(1, 5), progress(2, 2), progress(2, 5), progress(3, 1),
+                     {'type': 'jmx.attribute.change', 'source': 'StorageService'}]
+    assert repair_progress(notifications) == ({2}, {1, 2})
+
+
+def test_repair_scheduler_confirms_with_notifications():
+    db = journal.open_journal(':memory:')
+    journal.save_repair_plan(db, 'my-cluster', 'ks', [(0, 10, ['10.0.0.1', '10.0.0.2']),
+                                                      (10, 20, ['10.0.0.3'])])
+    urls = {ip: 'http://{}/'.format(ip) for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']}
+    scheduler = make_scheduler(db, urls)
+    scheduler.started = {}
+
+    with patch('planb.repair.start_repair', side_effect=[1, 2]), \
+            patch('planb.repair.subscribe_notifications', return_value={'client': 'c', 'handle': 'h'}):
+        scheduler.start_ranges('ks', journal.list_repair_ranges(db, 'my-cluster', 'ks'))
+
+    ranges = [dict(r, started=time.time()) for r in journal.list_repair_ranges(db, 'my-cluster', 'ks')]
+    notifications = [progress(1, 2), progress(1, 5), progress(2, 5)]
+    with patch('planb.repair.pull_notifications', return_value=notifications), \
+            patch('planb.repair.repair_status', return_value=None):
+        scheduler.check_running(ranges)
+
+    # the first repair reported an error before completing, and is retried
+    states = [r['state'] for r in journal.list_repair_ranges(db, 'my-cluster', 'ks')]
+    assert states == ['pending', 'done']
@@ -0,0 +1,119 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from planb import journal
+from planb.replace_node import broadcast_address, find_subnet_for_ip, \
+    derive_instance_spec, find_instance_spec, replacement_user_data, \
+    set_stream_throughput, restart_replacement
+
+
+def test_broadcast_address():
+    assert broadcast_address({'PrivateIpAddress': '172.31.1.1'}) == '172.31.1.1'
+    assert broadcast_address({'PrivateIpAddress': '172.31.1.1',
+                              'PublicIpAddress': '52.1.1.1'}) == '52.1.1.1'
+
+
+def test_find_subnet_for_ip():
+    ec2 = MagicMock()
+    ec2.describe_subnets.return_value = {'Subnets': [
+        {'SubnetId': 'sn-a', 'CidrBlock': '172.31.0.0/24'},
+        {'SubnetId': 'sn-b', 'CidrBlock': '172.31.1.0/24'},
+    ]}
+    assert find_subnet_for_ip(ec2, 'vpc-1', '172.31.1.23')['SubnetId'] == 'sn-b'
+    with pytest.raises(Exception):
+        find_subnet_for_ip(ec2, 'vpc-1', '10.0.0.1')
+
+
+def test_derive_instance_spec():
+    ec2 = MagicMock()
+    ec2.describe_subnets.return_value = {'Subnets': [
+        {'SubnetId': 'sn-b', 'CidrBlock': '172.31.1.0/24'},
+    ]}
+    peer = {'InstanceId': 'i-1', 'VpcId': 'vpc-1', 'SubnetId': 'sn-a',
+            'PrivateIpAddress': '172.31.0.5', 'PublicIpAddress': '52.1.1.1'}
+    user_data = {'source': 'cassandra', 'environment': {'REPLACE_ADDRESS': '52.9.9.9'}}
+    with patch('planb.replace_node.fetch_user_data', return_value=(user_data, True)), \
+            patch('planb.replace_node.is_api_termination_disabled', return_value=True):
+        with pytest.raises(Exception):
+            derive_instance_spec(ec2, peer, '172.31.1.23', None)
+        spec = derive_instance_spec(ec2, peer, '172.31.1.23', '52.2.2.2')
+    assert spec['PrivateIpAddress'] == '172.31.1.23'
+    assert spec['PublicIpAddress'] == '52.2.2.2'
+    assert spec['SubnetId'] == 'sn-b'
+    # the address the peer took over when it replaced a node is not copied
+    assert spec['UserData'] == {'source': 'cassandra', 'environment': {}}
+    assert spec['UserDataGzipped']
+    assert spec['DisableApiTermination']
+
+
+def test_find_instance_spec_prefers_peers():
+    db = journal.open_journal(':memory:')
+    journal.start_operation(db, 'my-cluster', 'eu-central-1', 'vol-1', 'update')
+    saved = {'InstanceId': 'i-old', 'PrivateIpAddress': '172.31.1.23', 'PublicIpAddress': '52.1.1.1',
+             'ImageId': 'ami-old', 'UserData': {'source': 'cassandra:old'}}
+    journal.save_instance(db, 'eu-central-1', 'vol-1', saved)
+    options = {'cluster_name': 'my-cluster', 'region': 'eu-central-1',
+               'ip': '172.31.1.23', 'public_ip': None}
+    peer = {'InstanceId': 'i-peer'}
+    with patch('planb.replace_node.derive_instance_spec') as derive:
+        find_instance_spec(MagicMock(), db, options, [peer])
+        # the Elastic IP is still taken from the journal
+        assert derive.call_args[0][1:] == (peer, '172.31.1.23', '52.1.1.1')
+
+        # nothing left to model on
+        assert find_instance_spec(MagicMock(), db, options, []) == saved
+        assert derive.call_count == 1
+        with pytest.raises(Exception):
+            find_instance_spec(MagicMock(), db, dict(options, ip='172.31.1.99'), [])
+
+
+def test_replacement_user_data():
+    spec = {'UserData': {'environment': {'CLUSTER_NAME': 'my-cluster'}}}
+    user_data = replacement_user_data(spec, '52.1.1.1')
+    assert user_data['environment'] == {'CLUSTER_NAME': 'my-cluster',
+                                        'REPLACE_ADDRESS': '52.1.1.1'}
+    assert 'REPLACE_ADDRESS' not in spec['UserData']['environment']
+
+
+def test_replacement_user_data_of_seed():
+    spec = {'UserData': {'environment': {'SEEDS': '52.1.1.1,52.2.2.2,52.3.3.3'}}}
+    user_data = replacement_user_data(spec, '52.2.2.2')
+    assert user_data['environment'] == {'SEEDS': '52.1.1.1,52.3.3.3',
+                                        'REPLACE_ADDRESS': '52.2.2.2'}
+    # the seed is back once restart_replacement applies the spec
+    assert spec['UserData']['environment']['SEEDS'] == '52.1.1.1,52.2.2.2,52.3.3.3'
+    with pytest.raises(Exception):
+        replacement_user_data({'UserData': {'environment': {'SEEDS': '52.2.2.2'}}}, '52.2.2.2')
+
+
+def test_set_stream_throughput():
+    query = MagicMock()
+    with patch('planb.replace_node.jolokia.query', query):
+        set_stream_throughput({'172.31.0.5': 'http://localhost:1234/jolokia/'},
+                              {'172.31.0.5': 400})
+    request = query.call_args[0][1][0]
+    assert request['type'] == 'write'
+    assert request['attribute'] == 'StreamThroughputMbPerSec'
+    assert request['value'] == 400
+
+
+def test_restart_replacement():
+    ec2 = MagicMock()
+    spec = {'PrivateIpAddress': '172.31.1.23', 'UserData': {'environment': {'SEEDS': '172.31.0.5'}}}
+    urls = {'172.31.0.5': 'http://localhost:1234/jolokia/'}
+    tunnels = MagicMock()
+    tunnels.return_value.__enter__.return_value = {'172.31.1.23': 'http://localhost:1235/jolokia/'}
+    with patch('planb.replace_node.jolokia.tunnels', tunnels), \
+            patch('planb.replace_node.drain_cassandra') as drain, \
+            patch('planb.replace_node.wait_drained', return_value=True), \
+            patch('planb.replace_node.wait_until_normal') as wait:
+        restart_replacement(ec2, 'i-new', spec, urls, {'odd_host': 'odd', 'join_timeout': 60})
+
+    drain.assert_called_once_with('http://localhost:1235/jolokia/')
+    ec2.stop_instances.assert_called_once_with(InstanceIds=['i-new'])
+    user_data = ec2.modify_instance_attribute.call_args[1]['UserData']['Value']
+    assert b'SEEDS: 172.31.0.5' in user_data
+    assert b'REPLACE_ADDRESS' not in user_data
+    ec2.start_instances.assert_called_once_with(InstanceIds=['i-new'])
+    wait.assert_called_once_with(urls, '172.31.1.23', 60)
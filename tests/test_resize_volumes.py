@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+import shlex
+
+from planb.resize_volumes import volume_changes, modification_blocked_until, \
+    wait_for_optimizing, resize_node, grow_filesystem
+
+
+options = {'size': None, 'volume_type': None, 'iops': None, 'throughput': None}
+
+
+def test_volume_changes():
+    volume = {'VolumeId': 'vol-1', 'Size': 100, 'VolumeType': 'gp2', 'Iops': 300}
+    assert volume_changes(volume, dict(options, size=100)) == {}
+    assert volume_changes(volume, dict(options, size=200, volume_type='gp3', iops=3000)) == {
+        'Size': 200, 'VolumeType': 'gp3', 'Iops': 3000
+    }
+    with pytest.raises(Exception):
+        volume_changes(volume, dict(options, size=50))
+
+
+def test_modification_blocked_until():
+    now = datetime.now(timezone.utc)
+    assert modification_blocked_until(None) is None
+    old = {'StartTime': now - timedelta(hours=7), 'ModificationState': 'completed'}
+    assert modification_blocked_until(old) is None
+    recent = {'StartTime': now - timedelta(hours=1), 'ModificationState': 'optimizing'}
+    assert modification_blocked_until(recent) == recent['StartTime'] + timedelta(hours=6)
+
+
+def test_wait_for_optimizing():
+    now = datetime.now(timezone.utc)
+    ec2 = MagicMock()
+    ec2.describe_volumes_modifications.side_effect = [
+        {'VolumesModifications': [{'StartTime': now, 'ModificationState': 'modifying'}]},
+        {'VolumesModifications': [{'StartTime': now, 'ModificationState': 'optimizing'}]},
+    ]
+    with patch('planb.resize_volumes.time.sleep') as sleep:
+        wait_for_optimizing(ec2, 'vol-1')
+    assert sleep.call_count == 1
+
+    ec2.describe_volumes_modifications.side_effect = None
+    ec2.describe_volumes_modifications.return_value = {'VolumesModifications': [
+        {'StartTime': now, 'ModificationState': 'failed', 'StatusMessage': 'nope'}
+    ]}
+    with pytest.raises(Exception):
+        wait_for_optimizing(ec2, 'vol-1')
+
+
+def test_resize_node():
+    instance = {'PrivateIpAddress': '172.31.1.1',
+                'BlockDeviceMappings': [{'DeviceName': '/dev/xvdf', 'Ebs': {'VolumeId': 'vol-1'}}]}
+    ec2 = MagicMock()
+    ec2.describe_volumes.return_value = {'Volumes': [
+        {'VolumeId': 'vol-1', 'Size': 100, 'VolumeType': 'gp2'}
+    ]}
+    ec2.describe_volumes_modifications.side_effect = [
+        Exception('InvalidVolumeModification.NotFound'),
+        {'VolumesModifications': [{'StartTime': datetime.now(timezone.utc),
+                                   'ModificationState': 'optimizing'}]},
+    ]
+    opts = dict(options, size=200, odd_hosts={'eu-central-1': 'odd'})
+    with patch('planb.resize_volumes.ec2_client', return_value=ec2), \
+            patch('planb.resize_volumes.grow_filesystem', return_value=True) as grow:
+        assert resize_node('eu-central-1', instance, opts) == 'modified'
+    ec2.modify_volume.assert_called_once_with(VolumeId='vol-1', Size=200)
+    grow.assert_called_once_with('odd', '172.31.1.1')
+
+
+def test_grow_filesystem_uses_host_mount_point():
+    with patch('planb.resize_volumes.subprocess.call', return_value=0) as call:
+        assert grow_filesystem('odd-host', '10.0.0.1')
+    cmd = call.call_args[0][0]
+    assert cmd[:4] == ['ssh', 'odd-host', 'ssh', '10.0.0.1']
+    script = shlex.split(cmd[4])[0]
+    assert 'findmnt -n -o FSTYPE /mounts/var/lib/cassandra' in script
+    assert 'sudo xfs_growfs /mounts/var/lib/cassandra' in script
+    assert ' /var/lib/cassandra' not in script
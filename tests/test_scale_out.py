@@ -0,0 +1,68 @@
+from unittest.mock import MagicMock, patch
+
+from planb.create_cluster import dc_name
+from planb.scale_out import system_auth_replication, \
+    least_populated_subnets, group_by_subnet, allocate_region_ips, \
+    has_joined, cleanup_node
+
+
+def test_dc_name():
+    assert dc_name('eu-central-1') == 'eu-central'
+    assert dc_name('ap-southeast-2') == 'ap-southeast-2'
+
+
+def test_system_auth_replication():
+    cql = system_auth_replication({'eu-west-1': 5, 'eu-central-1': 4})
+    assert cql == "ALTER KEYSPACE system_auth WITH replication = " \
+                  "{'class': 'NetworkTopologyStrategy', 'eu-central': 4, 'eu-west': 5};"
+
+
+def test_least_populated_subnets():
+    subnets = [
+        {'SubnetId': 'sn-a', 'AvailabilityZone': 'eu-central-1a'},
+        {'SubnetId': 'sn-b', 'AvailabilityZone': 'eu-central-1b'},
+        {'SubnetId': 'sn-c', 'AvailabilityZone': 'eu-central-1c'},
+    ]
+    instances = [
+        {'Placement': {'AvailabilityZone': 'eu-central-1a'}},
+        {'Placement': {'AvailabilityZone': 'eu-central-1a'}},
+        {'Placement': {'AvailabilityZone': 'eu-central-1b'}},
+    ]
+    picked = least_populated_subnets(subnets, instances, 3)
+    assert [s['SubnetId'] for s in picked] == ['sn-c', 'sn-b', 'sn-c']
+
+
+def test_allocate_region_ips():
+    a = {'SubnetId': 'sn-a', 'AvailabilityZone': 'eu-central-1a'}
+    c = {'SubnetId': 'sn-c', 'AvailabilityZone': 'eu-central-1c'}
+    assert group_by_subnet([c, a, c]) == [[c, c], [a]]
+
+    def allocate(region_subnets, count, node_ips, take_elastic_ips):
+        subnet = region_subnets['eu-central-1'][0]
+        for n in range(count):
+            node_ips['eu-central-1'].append({'PrivateIp': '{}-{}'.format(subnet['SubnetId'], n)})
+
+    with patch('planb.scale_out.allocate_ip_addresses', side_effect=allocate) as mock:
+        result = allocate_region_ips('eu-central-1', [c, a, c], False)
+    assert mock.call_count == 2
+    assert [(ip['PrivateIp'], s['SubnetId']) for ip, s in result] == [
+        ('sn-c-0', 'sn-c'), ('sn-c-1', 'sn-c'), ('sn-a-0', 'sn-a')
+    ]
+
+
+def test_has_joined():
+    ring = {'LiveNodes': ['10.0.0.1', '10.0.0.2'], 'JoiningNodes': ['10.0.0.3']}
+    assert has_joined(ring, {'10.0.0.2'})
+    assert not has_joined(ring, {'10.0.0.3'})
+    assert not has_joined(ring, {'10.0.0.4'})
+
+
+def test_cleanup_node_waits_for_compactions():
+    query = MagicMock(side_effect=[[50], [3], None])
+    with patch('planb.scale_out.jolokia.query', query), \
+            patch('planb.scale_out.time.sleep') as sleep:
+        cleanup_node('10.0.0.1', 'http://localhost:1234/jolokia/', ['ks'], 20)
+    assert sleep.call_count == 1
+    operation = query.call_args_list[2][0][1][0]
+    assert operation['operation'].startswith('forceKeyspaceCleanup')
+    assert operation['arguments'] == [0, 'ks', []]
@@ -0,0 +1,124 @@
+from unittest.mock import patch
+
+import pytest
+
+from planb.table_advisor import table_name, merge_node, chunk_length, \
+    suggested_chunk_length, compression_options, advise_table, advise, new_table_stats, \
+    parse_version, has_twcs, collect_table_stats
+
+
+def metric(name: str, keyspace: str, table: str) -> str:
+    return 'org.apache.cassandra.metrics:keyspace={},name={},scope={},type=Table'.format(keyspace, name, table)
+
+
+def node_values(keyspace: str, table: str, reads: int, writes: int, sstables: float) -> list:
+    def one(name, value):
+        return {metric(name, keyspace, table): value,
+                metric(name, 'system', 'local'): value}
+    settings = 'org.apache.cassandra.db:columnfamily={},keyspace={},type=ColumnFamilies'.format(table, keyspace)
+    return [
+        one('ReadLatency', {'Count': reads}),
+        one('WriteLatency', {'Count': writes}),
+        one('SSTablesPerReadHistogram', {'Mean': 1.5, '99thPercentile': sstables}),
+        one('TombstoneScannedHistogram', {'Mean': 0, '99thPercentile': 0}),
+        one('MeanPartitionSize', {'Value': 2048}),
+        one('MaxPartitionSize', {'Value': 8192}),
+        one('CompressionRatio', {'Value': -1}),
+        {settings: {'CompactionParameters': {'class': 'org.apache.cassandra.db.compaction.'
+                                                      'SizeTieredCompactionStrategy'},
+                    'CompressionParameters': {'class': 'org.apache.cassandra.io.compress.LZ4Compressor',
+                                              'chunk_length_in_kb': '64'}}},
+    ]
+
+
+def test_table_name():
+    assert table_name(metric('ReadLatency', 'ks', 't')) == ('ks', 't')
+    assert table_name('org.apache.cassandra.db:columnfamily=t,keyspace=ks,type=ColumnFamilies') == ('ks', 't')
+
+
+def test_merge_node():
+    tables = {}
+    merge_node(tables, node_values('ks', 't', 100, 10, 3))
+    merge_node(tables, node_values('ks', 't', 50, 20, 7))
+    merge_node(tables, [None] * 8)
+    assert list(tables) == [('ks', 't')]
+    stats = tables[('ks', 't')]
+    assert (stats['reads'], stats['writes'], stats['sstables_p99']) == (150, 30, 7)
+    assert stats['partition_sizes'] == [2048, 2048]
+    assert stats['compression_ratios'] == []
+    assert chunk_length(stats['compression']) == 64
+
+
+def test_chunk_length():
+    assert chunk_length(None) == 64
+    assert chunk_length({'enabled': 'false'}) is None
+    assert chunk_length({'sstable_compression': 'LZ4Compressor', 'chunk_length_kb': '16'}) == 16
+    assert suggested_chunk_length(300) == 4
+    assert suggested_chunk_length(6000) == 8
+    assert suggested_chunk_length(10 ** 6) == 64
+
+
+def test_advise_table():
+    tables = {}
+    merge_node(tables, node_values('ks', 't', 900, 100, 8))
+    recommendations = advise_table(('ks', 't'), tables[('ks', 't')], 7, 1, (3, 11, 4))
+    assert [r['setting'] for r in recommendations] == ['compaction', 'chunk_length_in_kb']
+    assert recommendations[0]['cql'] == \
+        "ALTER TABLE ks.t WITH compaction = {'class': 'LeveledCompactionStrategy'};"
+    assert recommendations[1]['recommended'] == 4
+    assert recommendations[1]['cql'] == "ALTER TABLE ks.t WITH compression = " \
+        "{'class': 'org.apache.cassandra.io.compress.LZ4Compressor', 'chunk_length_in_kb': '4'};"
+
+    stats = dict(new_table_stats(), reads=10, writes=1000, tombstones_p99=5000,
+                 compaction={'class': 'LeveledCompactionStrategy'})
+    recommendations = advise_table(('ks', 'events'), stats, 7, 1, (3, 11, 4))
+    assert [r['recommended'] for r in recommendations] == ['TimeWindowCompactionStrategy', '9d']
+    assert recommendations[1]['current'] == '10d (assumed)'
+    assert recommendations[1]['cql'] == 'ALTER TABLE ks.events WITH gc_grace_seconds = 777600;'
+    # no TWCS before 3.0.8
+    recommendations = advise_table(('ks', 'events'), stats, 7, 1, (3, 0, 7))
+    assert [r['recommended'] for r in recommendations] == ['SizeTieredCompactionStrategy', '9d']
+    # no margin left below the default
+    recommendations = advise_table(('ks', 'events'), stats, 7, 2, (3, 11, 4))
+    assert [r['setting'] for r in recommendations] == ['compaction']
+
+
+def test_compression_options():
+    assert compression_options({'class': 'DeflateCompressor', 'chunk_length_in_kb': '64',
+                                'crc_check_chance': '0.5'}, 16) == \
+        "{'class': 'DeflateCompressor', 'crc_check_chance': '0.5', 'chunk_length_in_kb': '16'}"
+    assert compression_options({'sstable_compression': 'org.apache.cassandra.io.compress.SnappyCompressor',
+                                'chunk_length_kb': '64'}, 8) == \
+        "{'sstable_compression': 'org.apache.cassandra.io.compress.SnappyCompressor', 'chunk_length_kb': '8'}"
+
+
+def test_advise_ranks_by_traffic():
+    tables = {}
+    merge_node(tables, node_values('ks', 'busy', 9000, 1000, 6))
+    merge_node(tables, node_values('ks', 'idle', 90, 10, 20))
+    ranked = [(r['table'], r['setting']) for r in advise(tables, 7, 1, (3, 11, 4))]
+    assert ranked[0] == ('ks.busy', 'compaction')
+    assert ranked[-1][0] == 'ks.idle'
+
+
+def test_versions():
+    assert parse_version('3.0.15') == (3, 0, 15)
+    assert parse_version('3.11.4-SNAPSHOT') == (3, 11, 4)
+    assert [has_twcs(v) for v in [(2, 1, 20), (3, 0, 7), (3, 0, 8), (3, 7), (3, 8), (4, 0, 1)]] == \
+        [False, False, True, False, True, True]
+
+
+def test_collect_table_stats_rejects_old_versions():
+    options = {'cluster_name': 'my-cluster', 'odd_hosts': {'eu-central-1': 'odd'}}
+    instances = [('eu-central-1', {'PrivateIpAddress': '10.0.0.1'})]
+    with patch('planb.jolokia.tunnels') as t, \
+            patch('planb.table_advisor.stream_instances', return_value=instances):
+        t.return_value.__enter__.return_value = {'10.0.0.1': 'http://localhost:1234/jolokia/'}
+        with patch('planb.jolokia.query', return_value=node_values('ks', 't', 10, 10, 1) + ['3.11.4']):
+            tables, version = collect_table_stats(options)
+        assert list(tables) == [('ks', 't')]
+        assert version == (3, 11, 4)
+        # Cassandra 2.x has neither the Table metrics nor CompactionParameters
+        with patch('planb.jolokia.query', return_value=[None] * 8 + ['2.1.20']):
+            with pytest.raises(Exception, match='needs Cassandra 3.0 or newer'):
+                collect_table_stats(options)
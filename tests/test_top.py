@@ -0,0 +1,50 @@
+from planb.top import NodeSample, NodeHistory, parse_sample, rates, \
+    top_table_rows, node_rows
+
+
+def make_values(reads, writes, table_reads=0):
+    return [
+        {'Count': reads, '99thPercentile': 2000.0},
+        {'Count': writes, '99thPercentile': 1000.0},
+        1024 ** 2,
+        {'java.lang:name=G1 Young Generation,type=GarbageCollector': {'CollectionTime': 100}},
+        0,
+        0,
+        {'org.apache.cassandra.metrics:keyspace=ks,name=ReadLatency,scope=t1,type=Table': {'Count': table_reads}},
+        {'org.apache.cassandra.metrics:keyspace=ks,name=WriteLatency,scope=t1,type=Table': {'Count': 5}},
+        0
+    ]
+
+
+def test_parse_sample():
+    sample, tables = parse_sample(10.0, make_values(100, 50, table_reads=7))
+    assert sample.reads == 100
+    assert sample.gc_ms == 100
+    assert tables == {('ks', 't1'): (7, 5)}
+
+
+def test_rates():
+    prev = NodeSample(0.0, 100, 0, 50, 0, 0, 0, 0, 0)
+    cur = NodeSample(10.0, 200, 0, 40, 0, 0, 0, 0, 0)
+    r = rates(prev, cur)
+    assert r['reads'] == 10
+    # counter reset after restart
+    assert r['writes'] is None
+
+
+def test_node_history_is_bounded():
+    history = NodeHistory(3)
+    for t in range(10):
+        sample, tables = parse_sample(float(t), make_values(t * 10, 0, table_reads=t))
+        history.append(sample, tables)
+    assert len(history.samples) == 3
+    assert len(history.tables) == 2
+    assert history.current_rates()['reads'] == 10
+    assert history.average_rates()['reads'] == 10
+
+    histories = {('eu-central-1', '10.0.0.1'): history,
+                 ('eu-central-1', '10.0.0.2'): NodeHistory(3)}
+    assert top_table_rows(histories, 5) == [{'table': 'ks.t1', 'reads': '1', 'writes': '0'}]
+    rows = node_rows(histories)
+    assert rows[0]['reads'] == '10'
+    assert rows[1]['reads'] == '?'
@@ -0,0 +1,46 @@
+import threading
+import pytest
+
+from unittest.mock import MagicMock
+
+from planb.undo import UndoStack
+
+
+def test_unwind_in_dependency_order():
+    undone = []
+    lock = threading.Lock()
+
+    def delete(name):
+        with lock:
+            undone.append(name)
+
+    undo = UndoStack()
+    undo.push('address', 'eu-west-1', 'IP address 1.2.3.4', delete, 'address')
+    undo.push('security_group', 'eu-west-1', 'security group sg-1', delete, 'security_group')
+    undo.push('volume', 'eu-west-1', 'volume vol-1', delete, 'volume')
+    undo.push('instance', 'eu-west-1', 'instance i-1', delete, 'instance-1')
+    undo.push('instance', 'eu-central-1', 'instance i-2', delete, 'instance-2')
+    undo.push('alarm', 'eu-west-1', 'alarm of i-1', delete, 'alarm')
+
+    assert undo.unwind() == []
+    assert set(undone[:3]) == {'instance-1', 'instance-2', 'alarm'}
+    assert set(undone[3:]) == {'address', 'security_group', 'volume'}
+    assert undo.actions == []
+
+
+def test_unwind_continues_after_failures():
+    failing = MagicMock(side_effect=Exception('DependencyViolation'))
+    later = MagicMock()
+    undo = UndoStack()
+    undo.push('instance', 'eu-west-1', 'instance i-1', failing, 'eu-west-1', 'i-1')
+    undo.push('security_group', 'eu-west-1', 'security group sg-1', later, 'eu-west-1', 'sg-1')
+
+    leftovers = undo.unwind()
+    assert [a.description for a in leftovers] == ['instance i-1']
+    failing.assert_called_once_with('eu-west-1', 'i-1')
+    later.assert_called_once_with('eu-west-1', 'sg-1')
+
+
+def test_push_unknown_kind():
+    with pytest.raises(Exception):
+        UndoStack().push('bucket', 'eu-west-1', 'bucket', print)
@@ -1,6 +1,11 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from planb.update_cluster import select_keys, tags_as_dict, \
-    get_user_data, build_run_instances_params
+    get_user_data, build_run_instances_params, is_in_place_update, \
+    stop_instance, start_instance, check_node_status, flush_cassandra, \
+    ClusterHealthGate, jolokia_url, build_user_data, wait_drained, \
+    tuned_environment, format_tuned_environment, move_keystores, \
+    import_instance_dump_files
+from planb import journal
 
 
 def test_select_keys():
@@ -80,3 +85,197 @@ def test_build_run_instances_params():
     }
     actual = build_run_instances_params(ec2, volume, saved_instance, options)
     assert actual == expected
+
+
+def test_is_in_place_update():
+    options = {'docker_image': 'docker.registry/cassandra:123',
+               'taupage_ami_id': None,
+               'instance_type': None}
+    assert is_in_place_update(options)
+    assert not is_in_place_update(dict(options, taupage_ami_id='ami-654321'))
+    assert not is_in_place_update(dict(options, instance_type='m4.xlarge'))
+    assert not is_in_place_update(dict(options, docker_image=None))
+
+
+def test_stop_instance():
+    ec2 = MagicMock()
+    volume = {'VolumeId': 'vol-123'}
+    saved_instance = {'InstanceId': 'i-123'}
+
+    ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': [{'State': {'Name': 'running'}}]}]
+    }
+    stop_instance(ec2, volume, saved_instance)
+    ec2.stop_instances.assert_called_once_with(InstanceIds=['i-123'])
+    ec2.create_tags.assert_not_called()
+
+    ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': [{'State': {'Name': 'stopped'}}]}]
+    }
+    stop_instance(ec2, volume, saved_instance)
+    tags = ec2.create_tags.call_args[1]['Tags']
+    assert {'Key': 'planb:operation:state', 'Value': 'stopped'} in tags
+
+
+def test_start_instance():
+    ec2 = MagicMock()
+    volume = {'VolumeId': 'vol-123'}
+    saved_instance = {
+        'InstanceId': 'i-123',
+        'PrivateIpAddress': '172.31.128.11',
+        'UserData': {'source': 'docker.registry/cassandra:101'}
+    }
+    options = {
+        'cluster_name': 'my-cluster-name',
+        'docker_image': 'docker.registry/cassandra:123'
+    }
+    start_instance(ec2, volume, saved_instance, options)
+
+    user_data = ec2.modify_instance_attribute.call_args[1]['UserData']['Value']
+    assert user_data.startswith(b'#taupage-ami-config\n')
+    assert b'source: docker.registry/cassandra:123' in user_data
+    ec2.start_instances.assert_called_once_with(InstanceIds=['i-123'])
+    # the saved instance spec must stay intact for resuming
+    assert saved_instance['UserData'] == {'source': 'docker.registry/cassandra:101'}
+
+
+def test_flush_cassandra():
+    with patch('requests.post') as post:
+        post.return_value.json.return_value = [{'value': ['system', 'myschema']}]
+        flush_cassandra()
+        queries = post.call_args[1]['json']
+        assert [q['arguments'] for q in queries] == [['system', []], ['myschema', []]]
+        assert all(q['type'] == 'exec' for q in queries)
+
+
+def test_check_node_status_records_downtime():
+    ec2 = MagicMock()
+    volume = {
+        'VolumeId': 'vol-123',
+        'Tags': [{'Key': 'planb:operation:drain-time', 'Value': '2017-01-01T00:00:00Z'}]
+    }
+    saved_instance = {'PrivateIpAddress': '172.31.128.11'}
+    gate = ClusterHealthGate()
+    gate.enter({'172.31.128.11'})
+    options = {'jolokia_url': jolokia_url, 'health_gate': gate}
+    with patch('planb.update_cluster.get_cluster_status') as status:
+        status.return_value = {'DownEndpointCount': 1,
+                               'SimpleStates': {'/172.31.128.11': 'DOWN'}}
+        check_node_status(ec2, volume, saved_instance, options)
+        ec2.create_tags.assert_not_called()
+
+        status.return_value = {'DownEndpointCount': 0,
+                               'SimpleStates': {'/172.31.128.11': 'UP'}}
+        check_node_status(ec2, volume, saved_instance, options)
+        tags = tags_as_dict(ec2.create_tags.call_args[1]['Tags'])
+        assert tags['planb:operation:state'] == 'completed'
+        assert int(tags['planb:operation:downtime']) > 0
+
+
+def test_cluster_health_gate():
+    gate = ClusterHealthGate()
+    healthy = {'SimpleStates': {'/10.0.0.1': 'UP', '/10.0.1.1': 'UP'}}
+    assert gate.try_enter({'10.0.0.1'}, healthy)
+
+    # the node being updated in another region is expected to be DOWN
+    one_down = {'SimpleStates': {'/10.0.0.1': 'DOWN', '/10.0.1.1': 'UP'}}
+    assert gate.try_enter({'10.0.1.1'}, one_down)
+    gate.leave({'10.0.1.1'})
+
+    # but any other DOWN node pauses progress everywhere
+    other_down = {'SimpleStates': {'/10.0.0.1': 'DOWN', '/10.0.2.1': 'DOWN'}}
+    assert not gate.try_enter({'10.0.1.1'}, other_down)
+    assert gate.unexpected_down(other_down) == {'10.0.2.1'}
+    assert gate.unexpected_down(one_down, exclude={'10.0.0.1'}) == {'10.0.0.1'}
+
+    # unknown status is never healthy
+    assert not gate.try_enter({'10.0.1.1'}, {})
+    gate.leave({'10.0.0.1'})
+    assert gate.is_idle()
+
+
+def test_build_user_data_rescales_scylla_shards():
+    saved_instance = {
+        'PrivateIpAddress': '10.0.0.1',
+        'UserData': {'source': 'scylla:1', 'environment': {'SCYLLA_SMP': 1, 'SEEDS': '10.0.0.1'}}
+    }
+    instance_type = {'VCpuInfo': {'DefaultVCpus': 8}, 'MemoryInfo': {'SizeInMiB': 65536}}
+    options = {'cluster_name': 'my-cluster', 'region': 'eu-central-1', 'instance_type': 'r5.2xlarge'}
+    with patch('planb.update_cluster.describe_instance_type', return_value=instance_type):
+        user_data = build_user_data(saved_instance, options)
+    assert user_data['environment']['SCYLLA_SMP'] == 7
+    assert user_data['environment']['SCYLLA_CPU_SET'] == '1-7'
+    assert user_data['environment']['SEEDS'] == '10.0.0.1'
+
+    # Cassandra nodes are left alone
+    cassandra = dict(saved_instance, UserData={'environment': {'SEEDS': '10.0.0.1'}})
+    assert build_user_data(cassandra, options)['environment'] == {'SEEDS': '10.0.0.1'}
+
+
+def test_build_user_data_applies_tuned_environment():
+    saved_instance = {
+        'PrivateIpAddress': '10.0.0.1',
+        'Tags': [{'Key': 'planb:tuned-environment', 'Value': 'KEY_CACHE_SIZE_MB=150 ROW_CACHE_SIZE_MB=0'}],
+        'UserData': {'environment': {'SEEDS': '10.0.0.1', 'KEY_CACHE_SIZE_MB': '100'}}
+    }
+    user_data = build_user_data(saved_instance, {'cluster_name': 'my-cluster'})
+    assert user_data['environment'] == {
+        'SEEDS': '10.0.0.1', 'KEY_CACHE_SIZE_MB': '150', 'ROW_CACHE_SIZE_MB': '0'
+    }
+    assert format_tuned_environment(tuned_environment(saved_instance)) == \
+        'KEY_CACHE_SIZE_MB=150 ROW_CACHE_SIZE_MB=0'
+
+
+def test_build_user_data_moves_keystores():
+    saved_instance = {
+        'PrivateIpAddress': '10.0.0.1',
+        'UserData': {'environment': {'SEEDS': '10.0.0.1', 'KEYSTORE': 'a2V5', 'TRUSTSTORE': 'dHJ1c3Q='}}
+    }
+    references = {'KEYSTORE_PARAMETER': '/planb/my-cluster/keystore',
+                  'TRUSTSTORE_PARAMETER': '/planb/my-cluster/truststore'}
+    options = {'cluster_name': 'my-cluster', 'keystore_parameters': references}
+    user_data = build_user_data(saved_instance, options)
+    assert user_data['environment'] == dict(references, SEEDS='10.0.0.1')
+
+    # references are carried forward as they are
+    saved_instance['UserData'] = user_data
+    assert build_user_data(saved_instance, {'cluster_name': 'my-cluster'})['environment'] == \
+        user_data['environment']
+
+
+def test_move_keystores():
+    environment = {'REGIONS': 'eu-central-1 eu-west-1', 'KEYSTORE': 'a2V5', 'TRUSTSTORE': 'dHJ1c3Q='}
+    region_instances = {'eu-west-1': [{'InstanceId': 'i-1'}]}
+    with patch('planb.update_cluster.ec2_client'), \
+            patch('planb.update_cluster.get_user_data', return_value={'environment': environment}), \
+            patch('planb.update_cluster.ensure_secrets_policy') as policy, \
+            patch('planb.update_cluster.store_secret_parameters', return_value={'x': 'y'}) as store:
+        assert move_keystores('my-cluster', region_instances) == {'x': 'y'}
+    policy.assert_called_once_with('my-cluster')
+    store.assert_called_once_with(['eu-central-1', 'eu-west-1'], 'my-cluster',
+                                  {'KEYSTORE': 'a2V5', 'TRUSTSTORE': 'dHJ1c3Q='})
+
+
+def test_wait_drained():
+    with patch('planb.update_cluster.jolokia.query', side_effect=[['DRAINING'], ['DRAINED']]), \
+            patch('planb.update_cluster.time.sleep') as sleep:
+        assert wait_drained(jolokia_url)
+    assert sleep.call_count == 1
+
+
+def test_import_instance_dump_files(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('vol-1234.json').write('{"InstanceId": "i-1234"}')
+    tmpdir.join('vol-5678.json').write('{"InstanceId": "i-5678"}')
+    ec2 = MagicMock()
+    ec2.describe_volumes.return_value = {'Volumes': [{'VolumeId': 'vol-1234'}]}
+    db = journal.open_journal(':memory:')
+
+    import_instance_dump_files(ec2, db, 'my-cluster', 'eu-central-1')
+
+    ec2.describe_volumes.assert_called_once_with(
+        Filters=[{'Name': 'volume-id', 'Values': ['vol-1234', 'vol-5678']}])
+    assert journal.load_instance(db, 'eu-central-1', 'vol-1234') == {'InstanceId': 'i-1234'}
+    assert journal.load_instance(db, 'eu-central-1', 'vol-5678') is None
+    # the volume of another region keeps its file
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['vol-5678.json']